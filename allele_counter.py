@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import multiprocessing
+
+parser = argparse.ArgumentParser(
+    description="count ref and alt alleles per cell at each variant, an in process alternative to vartrix --umi --scoring-method coverage")
+parser.add_argument("-b", "--bam", required = True, nargs = '+',
+    help = "bam with CB and UB tags, coordinate sorted and indexed. with several bams (a library and its top up sequencing) " +
+    "a cell barcode and UMI is counted once over all of them")
+parser.add_argument("-c", "--barcodes", required = True, help = "barcodes.tsv, matrix columns are in this order")
+parser.add_argument("--barcode_index", required = False, default = None,
+    help = "barcode index built from the barcodes file (barcode_index.py), memory mapped by each worker instead of sending it the barcodes")
+parser.add_argument("-v", "--vcf", required = True, help = "variant vcf (plain or gzipped), matrix rows are in record order")
+parser.add_argument("-o", "--out", required = True, help = "output allele count store (.npz)")
+parser.add_argument("-t", "--threads", required = False, default = 1, type = int, help = "processes to shard chromosomes over, default = 1")
+parser.add_argument("--mapq", required = False, default = 30, type = int, help = "minimum mapping quality, default = 30")
+parser.add_argument("--min_baseq", required = False, default = 0, type = int,
+    help = "minimum base quality at the variant, default = 0 (vartrix does not filter on base quality)")
+parser.add_argument("--ref_matrix", required = False, default = None, help = "also write the ref counts as a text mtx")
+parser.add_argument("--alt_matrix", required = False, default = None, help = "also write the alt counts as a text mtx")
+parser.add_argument("--compare_ref", required = False, default = None, help = "vartrix ref.mtx to check these counts against")
+parser.add_argument("--compare_alt", required = False, default = None, help = "vartrix alt.mtx to check these counts against")
+
+max_depth = 10000000
+# variants closer than this share one pileup
+group_gap = 1000
+
+def load_variants(fn):
+    # chrom -> [(locus, 0 based pos, ref, alts)], locus is the 0 based record index in the vcf
+    chrom_variants = {}
+    loci = 0
+    with (gzip.open(fn, 'rt') if fn.endswith(".gz") else open(fn)) as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            toks = line.split("\t", 5)
+            chrom_variants.setdefault(toks[0], [])
+            chrom_variants[toks[0]].append((loci, int(toks[1]) - 1, toks[3].upper(), toks[4].upper().split(",")))
+            loci += 1
+    return (loci, chrom_variants)
+
+def init_worker(bam_fns, barcodes, mapq, min_baseq):
+    global worker
+    if isinstance(barcodes, str):
+        import barcode_index
+        barcodes = barcode_index.BarcodeIndex(barcodes)
+    worker = {"bams": bam_fns, "barcodes": barcodes, "mapq": mapq, "min_baseq": min_baseq}
+
+def snv(ref, alt_alleles):
+    # only single base substitutions can be read off the pileup directly
+    return len(ref) == 1 and all([len(alt) == 1 for alt in alt_alleles])
+
+def groups(variants):
+    # runs of variants (sorted by position) close enough together that one pileup over the run reads each read once
+    group = []
+    for variant in variants:
+        if len(group) > 0 and variant[1] - group[-1][1] > group_gap:
+            yield group
+            group = []
+        group.append(variant)
+    if len(group) > 0:
+        yield group
+
+def pileup_columns(bams, chrom, start, end):
+    # the columns from start to end in each bam in turn, a column is only valid until its pileup moves on
+    for bam in bams:
+        for column in bam.pileup(chrom, start, end, truncate = True, stepper = "nofilter", max_depth = max_depth,
+                min_mapping_quality = worker["mapq"], min_base_quality = worker["min_baseq"], ignore_overlaps = False,
+                ignore_orphans = False):
+            yield column
+
+def count_chrom(job):
+    # returns the entries found and how many of the chromosome's loci were not single base substitutions, and
+    # how many were on a chromosome none of the bams has
+    import pysam
+    (chrom, variants) = job
+    bams = [pysam.AlignmentFile(fn) for fn in worker["bams"]]
+    bams = [bam for bam in bams if chrom in bam.references]
+    barcodes = worker["barcodes"]
+    loci = []
+    cells = []
+    refs = []
+    alts = []
+    if len(bams) == 0:
+        return (chrom, loci, cells, refs, alts, 0, len(variants))
+    snvs = sorted([variant for variant in variants if snv(variant[2], variant[3])], key = lambda variant: variant[1])
+    for group in groups(snvs):
+        at = {} # position -> variants there, a position can have several records
+        for variant in group:
+            at.setdefault(variant[1], []).append(variant)
+        umis = {} # (locus, cell) -> (ref umis, alt umis), so each cell barcode and UMI is counted once per allele over all bams
+        for column in pileup_columns(bams, chrom, group[0][1], group[-1][1] + 1):
+            here = at.get(column.reference_pos)
+            if here == None:
+                continue
+            for pileupread in column.pileups:
+                if pileupread.is_del or pileupread.is_refskip:
+                    continue
+                read = pileupread.alignment
+                if read.is_unmapped or read.is_secondary or read.is_supplementary or read.is_qcfail or read.is_duplicate:
+                    continue
+                # the nofilter stepper does not apply the pileup's quality thresholds, so they are checked here
+                if read.mapping_quality < worker["mapq"]:
+                    continue
+                if worker["min_baseq"] > 0 and read.query_qualities[pileupread.query_position] < worker["min_baseq"]:
+                    continue
+                if not read.has_tag("CB") or not read.has_tag("UB"):
+                    continue
+                cell = barcodes.get(read.get_tag("CB"))
+                if cell == None:
+                    continue
+                base = read.query_sequence[pileupread.query_position]
+                for (locus, pos, ref, alt_alleles) in here:
+                    if base == ref:
+                        allele = 0
+                    elif base in alt_alleles:
+                        allele = 1
+                    else:
+                        continue
+                    umis.setdefault((locus, cell), (set(), set()))[allele].add(read.get_tag("UB"))
+        for ((locus, cell), (ref_umis, alt_umis)) in sorted(umis.items()):
+            loci.append(locus)
+            cells.append(cell)
+            refs.append(len(ref_umis))
+            alts.append(len(alt_umis))
+    return (chrom, loci, cells, refs, alts, len(variants) - len(snvs), 0)
+
+def compare(counts, ref_fn, alt_fn):
+    # returns (identical entries, entries in either)
+    import mtx
+    (loci, cells, locus, cell, ref, alt) = counts
+    (other_loci, other_cells, other_locus, other_cell, other_ref, other_alt) = mtx.load_pair(ref_fn, alt_fn)
+    assert loci == other_loci and cells == other_cells, "matrix dimensions differ from the comparison matrices"
+    ours = {key: (r, a) for (key, r, a) in zip(locus * cells + cell, ref, alt)}
+    theirs = {key: (r, a) for (key, r, a) in zip(other_locus * cells + other_cell, other_ref, other_alt)}
+    keys = set(ours.keys()) | set(theirs.keys())
+    same = sum([1 for key in keys if ours.get(key, (0, 0)) == theirs.get(key, (0, 0))])
+    print("entries " + str(len(ours)) + " vs " + str(len(theirs)) + " in comparison")
+    print("identical entries " + str(same) + " of " + str(len(keys)) + " (" + str(100.0 * same / max(len(keys), 1)) + "%)")
+    print("total ref " + str(ref.sum()) + " vs " + str(other_ref.sum()) + ", total alt " + str(alt.sum()) + " vs " + str(other_alt.sum()))
+    return (same, len(keys))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    import numpy as np
+    import mtx
+
+    barcodes = {}
+    cells = 0
+    with open(args.barcodes) as bcs:
+        for line in bcs:
+            if not args.barcode_index:
+                barcodes.setdefault(line.strip().split()[0], cells)
+            cells += 1
+    if args.barcode_index:
+        barcodes = args.barcode_index
+    (total_loci, chrom_variants) = load_variants(args.vcf)
+    print("counting alleles at " + str(total_loci) + " loci on " + str(len(chrom_variants)) + " chromosomes")
+    # biggest chromosomes first so the pool is not left waiting on one long shard
+    jobs = sorted(chrom_variants.items(), key = lambda kv: len(kv[1]), reverse = True)
+    parts = []
+    not_snv = 0
+    missing = 0
+    pool = multiprocessing.Pool(args.threads, initializer = init_worker, initargs = (args.bam, barcodes, args.mapq, args.min_baseq))
+    for (chrom, loci, chrom_cells, refs, alts, chrom_not_snv, chrom_missing) in pool.imap_unordered(count_chrom, jobs):
+        parts.append((0, np.array(loci, dtype = np.int64), np.array(chrom_cells, dtype = np.int64),
+            np.array(refs, dtype = np.int64), np.array(alts, dtype = np.int64)))
+        not_snv += chrom_not_snv
+        missing += chrom_missing
+    pool.close()
+    pool.join()
+    if not_snv > 0:
+        print("WARNING: " + str(not_snv) + " loci are not single base substitutions and are left empty, vartrix would count them")
+    if missing > 0:
+        print(str(missing) + " loci are on chromosomes not in the bam and are left empty")
+    counts = mtx.combine(parts, total_loci, cells)
+    mtx.save_store(args.out, *counts)
+    if args.ref_matrix or args.alt_matrix:
+        assert args.ref_matrix and args.alt_matrix, "must specify both --ref_matrix and --alt_matrix"
+        mtx.write_pair(args.ref_matrix, args.alt_matrix, *counts)
+    if args.compare_ref or args.compare_alt:
+        assert args.compare_ref and args.compare_alt, "must specify both --compare_ref and --compare_alt"
+        compare(counts, args.compare_ref, args.compare_alt)
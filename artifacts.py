@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+
+# cache of stage outputs shared between runs (souporcell_pipeline.py --cache_dir). an entry is keyed by a hash of
+# what the stage read (input file fingerprints or the keys of the stages that made them), the tool versions and
+# the parameters that change its output, so rerunning a library with only downstream changes (-k, --restarts,
+# --ploidy) gets the remapped bam, variants and allele counts back without recomputing them.
+# files are put into out_dir by reflink where the filesystem can, else by hard link, else copied. hard linked
+# files share their inode with the cache, so cached files are made read only and a stage that runs again
+# unlinks them (unshare) before writing. entries are evicted least recently used first above max_bytes
+
+# bump when stage outputs change in a way the keys below do not capture
+format_version = 1
+sample_bytes = 1 << 16
+samples = 16
+
+def fingerprint(fn):
+    # size plus the first and last MB and blocks spread through the middle, cheap even for a large bam
+    size = os.path.getsize(fn)
+    digest = hashlib.sha256(str(size).encode())
+    with open(fn, 'rb') as f:
+        digest.update(f.read(1 << 20))
+        for sample in range(samples):
+            f.seek(size * (sample + 1) // (samples + 1))
+            digest.update(f.read(sample_bytes))
+        f.seek(max(0, size - (1 << 20)))
+        digest.update(f.read(1 << 20))
+    return(digest.hexdigest())
+
+tool_versions = {}
+
+def tool_version(tool):
+    if not tool in tool_versions:
+        try:
+            output = subprocess.run([tool, "--version"], stdout = subprocess.PIPE, stderr = subprocess.STDOUT).stdout
+            tool_versions[tool] = output.decode(errors = "replace").strip().split("\n")[0]
+        except OSError:
+            tool_versions[tool] = "missing"
+    return(tool_versions[tool])
+
+def script_version(name):
+    # the helper scripts next to this file are versioned by their content
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), name), 'rb') as script:
+        return(hashlib.sha256(script.read()).hexdigest())
+
+def key(stage, inputs, params):
+    description = json.dumps({"format": format_version, "stage": stage, "inputs": inputs, "params": params}, sort_keys = True)
+    return(hashlib.sha256(description.encode()).hexdigest())
+
+def materialize(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if subprocess.call(["cp", "--reflink=always", src, dest], stderr = subprocess.DEVNULL) == 0:
+        return
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+def unshare(fns):
+    # a stage about to rewrite its outputs must not write through a hard link into the cache
+    for fn in fns:
+        try:
+            if os.stat(fn).st_nlink > 1 or not os.access(fn, os.W_OK):
+                os.remove(fn)
+        except FileNotFoundError:
+            pass
+
+class ArtifactCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.objects = os.path.join(cache_dir, "objects")
+        self.max_bytes = max_bytes
+        os.makedirs(self.objects, exist_ok = True)
+
+    def fetch(self, entry_key, out_dir):
+        # the cached file names now in out_dir, or None on a miss
+        entry = os.path.join(self.objects, entry_key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as meta_file:
+                meta = json.load(meta_file)
+            for name in meta["files"]:
+                dest = os.path.join(out_dir, name)
+                materialize(os.path.join(entry, name), dest)
+                if os.stat(dest).st_nlink == 1:
+                    os.chmod(dest, 0o644) # a reflink or copy of its own, no need to keep it read only
+            os.utime(os.path.join(entry, "meta.json"))
+        except (OSError, ValueError):
+            return(None) # missing, or evicted by another run part way through
+        print("reusing cached " + meta["stage"] + " outputs " + entry_key[:12])
+        return(meta["files"])
+
+    def store(self, entry_key, stage, fns):
+        entry = os.path.join(self.objects, entry_key)
+        if os.path.exists(entry):
+            return
+        tmp = entry + ".tmp." + str(os.getpid())
+        os.makedirs(tmp, exist_ok = True)
+        total = 0
+        for fn in fns:
+            dest = os.path.join(tmp, os.path.basename(fn))
+            materialize(fn, dest)
+            os.chmod(dest, 0o444)
+            total += os.path.getsize(dest)
+        with open(os.path.join(tmp, "meta.json"), 'w') as meta:
+            json.dump({"stage": stage, "files": [os.path.basename(fn) for fn in fns], "bytes": total, "created": time.time()}, meta)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors = True) # another run stored the same entry first
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.objects):
+            meta_fn = os.path.join(self.objects, name, "meta.json")
+            try:
+                with open(meta_fn) as meta:
+                    entries.append((os.path.getmtime(meta_fn), json.load(meta)["bytes"], name))
+            except (OSError, ValueError):
+                continue # being written
+        total = sum([size for (used, size, name) in entries])
+        for (used, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print("evicting cached " + name[:12] + " from the artifact cache")
+            shutil.rmtree(os.path.join(self.objects, name), ignore_errors = True)
+            total -= size
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+
+parser = argparse.ArgumentParser(
+    description="assign new cells to the clusters of an existing souporcell run with a single E step (no reclustering)")
+parser.add_argument("-a", "--alt_matrix", required = True, help = "alt matrix for the new cells, counted against the same vcf as the existing run")
+parser.add_argument("-r", "--ref_matrix", required = True, help = "ref matrix for the new cells, counted against the same vcf as the existing run")
+parser.add_argument("-b", "--barcodes", required = True, help = "barcodes.tsv for the new cells")
+parser.add_argument("-g", "--cluster_genotypes", required = False, default = None,
+    help = "cluster_genotypes.vcf from the existing run")
+parser.add_argument("-v", "--vcf", required = False, default = None,
+    help = "variant vcf the allele matrices were counted against (souporcell_merged_sorted_vcf.vcf.gz or common_variants_covered.vcf of the existing run)")
+parser.add_argument("--centers", required = False, default = None,
+    help = "tsv of cluster alt allele fractions (locus then one column per cluster), alternative to --cluster_genotypes")
+parser.add_argument("--centers_out", required = False, default = None,
+    help = "write the cluster centers used to this tsv so later lanes can skip parsing the genotype vcf")
+parser.add_argument("--ambient_rna", required = False, default = None, help = "ambient_rna.txt from the existing run")
+parser.add_argument("-d", "--doublet_prior", required = False, default = 0.5, type = float, help = "prior on doublets, default = 0.5")
+parser.add_argument("--doublet_threshold", required = False, default = 0.9, type = float, help = "doublet posterior threshold, default = 0.9")
+parser.add_argument("--singlet_threshold", required = False, default = 0.9, type = float, help = "singlet posterior threshold, default = 0.9")
+parser.add_argument("-o", "--out", required = True, help = "output clusters tsv (same format as clusters.tsv)")
+args = parser.parse_args()
+
+assert not(args.cluster_genotypes == None) or not(args.centers == None), "must specify --cluster_genotypes or --centers"
+assert args.cluster_genotypes == None or args.centers == None, "cannot set both --cluster_genotypes and --centers"
+if args.cluster_genotypes:
+    assert args.vcf, "--cluster_genotypes requires --vcf so genotype records can be matched to matrix loci"
+
+import numpy as np
+from scipy.io import mmread
+from scipy.special import gammaln, logsumexp
+
+min_fraction = 0.01
+max_fraction = 0.99
+cells_per_chunk = 10000
+
+def myopen(fname): return gzip.open(fname, 'rt') if fname.endswith('.gz') else open(fname)
+
+def load_centers_from_genotypes(vcf_fn, genotypes_fn):
+    # matrix loci are numbered by record order in the vcf they were counted against
+    locus_keys = {}
+    with myopen(vcf_fn) as vcf:
+        locus = 0
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            locus += 1
+            toks = line.split("\t", 5)
+            locus_keys[(toks[0], toks[1], toks[3], toks[4])] = locus
+    loci = []
+    centers = []
+    with myopen(genotypes_fn) as genotypes:
+        for line in genotypes:
+            if line.startswith("#"):
+                continue
+            toks = line.strip().split("\t")
+            key = (toks[0], toks[1], toks[3], toks[4])
+            if not key in locus_keys:
+                continue
+            gn_index = toks[8].split(":").index("GN")
+            fractions = []
+            for call in toks[9:]:
+                # GN is log posterior of hom ref, hom alt and (diploid) het
+                log_post = np.array([float(x) for x in call.split(":")[gn_index].split(",")])
+                if np.isnan(log_post).any():
+                    break
+                post = np.exp(log_post - logsumexp(log_post))
+                fraction = post[1]
+                if len(post) == 3:
+                    fraction += 0.5 * post[2]
+                fractions.append(fraction)
+            if len(fractions) < len(toks) - 9:
+                continue
+            loci.append(locus_keys[key])
+            centers.append(fractions)
+    return (np.array(loci), np.array(centers))
+
+def load_centers_tsv(fn):
+    loci = []
+    centers = []
+    with open(fn) as tsv:
+        tsv.readline() # header
+        for line in tsv:
+            toks = line.strip().split("\t")
+            loci.append(int(toks[0]))
+            centers.append([float(x) for x in toks[1:]])
+    return (np.array(loci), np.array(centers))
+
+def load_ambient(fn):
+    with open(fn) as soup:
+        # "ambient RNA estimated as X%"
+        return float(soup.read().strip().split()[-1].rstrip("%")) / 100.0
+
+if args.cluster_genotypes:
+    print("loading cluster genotypes")
+    (center_loci, centers) = load_centers_from_genotypes(args.vcf, args.cluster_genotypes)
+else:
+    print("loading cluster centers")
+    (center_loci, centers) = load_centers_tsv(args.centers)
+assert len(center_loci) > 0, "no loci shared between the cluster genotypes and the allele matrices"
+K = centers.shape[1]
+print(str(len(center_loci)) + " loci with cluster genotypes for " + str(K) + " clusters")
+
+if args.centers_out:
+    with open(args.centers_out, 'w') as out:
+        out.write("locus\t" + "\t".join(["cluster" + str(c) for c in range(K)]) + "\n")
+        for (locus, fractions) in zip(center_loci, centers):
+            out.write(str(locus) + "\t" + "\t".join([str(x) for x in fractions]) + "\n")
+
+p_soup = 0.0
+if args.ambient_rna:
+    p_soup = load_ambient(args.ambient_rna)
+    print("using ambient RNA fraction " + str(p_soup))
+
+barcodes = []
+with open(args.barcodes) as bcs:
+    for line in bcs:
+        barcodes.append(line.strip().split()[0])
+
+# mtx files are loci x cells
+alt = mmread(args.alt_matrix).tocsc()
+ref = mmread(args.ref_matrix).tocsc()
+assert alt.shape == ref.shape, "ref and alt matrices dont match?"
+assert alt.shape[1] == len(barcodes), "number of barcodes does not match the number of cells in the matrices"
+assert center_loci.max() <= alt.shape[0], "cluster loci beyond the end of the allele matrices, were they counted against a different vcf?"
+rows = center_loci - 1
+alt = alt[rows, :].T.tocsr().astype(np.float64)
+ref = ref[rows, :].T.tocsr().astype(np.float64)
+
+total_alt = np.asarray(alt.sum(axis = 0)).ravel()
+total_ref = np.asarray(ref.sum(axis = 0)).ravel()
+depth = total_alt + total_ref
+soup = np.where(depth > 0, total_alt / np.maximum(depth, 1.0), 0.5)
+
+def allele_fractions(p):
+    p = (1.0 - p_soup) * p + p_soup * soup[:, None]
+    return np.clip(p, min_fraction, max_fraction)
+
+singlet_p = allele_fractions(centers)
+pairs = [(c1, c2) for c1 in range(K) for c2 in range(c1 + 1, K)]
+
+# binomial coefficient per cell, identical for every hypothesis
+coef = (alt + ref).tocsr()
+coef.data = gammaln(coef.data + 1.0)
+alt_coef = alt.copy()
+alt_coef.data = gammaln(alt_coef.data + 1.0)
+ref_coef = ref.copy()
+ref_coef.data = gammaln(ref_coef.data + 1.0)
+log_coef = np.asarray(coef.sum(axis = 1) - alt_coef.sum(axis = 1) - ref_coef.sum(axis = 1)).ravel()
+
+singlet = alt.dot(np.log(singlet_p)) + ref.dot(np.log(1.0 - singlet_p))
+singlet += log_coef[:, None] + np.log(1.0 - args.doublet_prior)
+
+best_doublet = np.full(len(barcodes), -np.inf)
+best_pair = np.zeros(len(barcodes), dtype = np.int64)
+if len(pairs) > 0:
+    doublet_p = allele_fractions(np.stack([(centers[:, c1] + centers[:, c2]) / 2.0 for (c1, c2) in pairs], axis = 1))
+    log_doublet_p = np.log(doublet_p)
+    log_doublet_q = np.log(1.0 - doublet_p)
+    for start in range(0, len(barcodes), cells_per_chunk):
+        end = min(start + cells_per_chunk, len(barcodes))
+        doublet = alt[start:end].dot(log_doublet_p) + ref[start:end].dot(log_doublet_q)
+        best_pair[start:end] = np.argmax(doublet, axis = 1)
+        best_doublet[start:end] = doublet[np.arange(end - start), best_pair[start:end]]
+    best_doublet += log_coef + np.log(args.doublet_prior)
+
+best_singlet = np.argmax(singlet, axis = 1)
+best_singlet_lp = singlet[np.arange(len(barcodes)), best_singlet]
+singlet_posterior = np.exp(best_singlet_lp - logsumexp(singlet, axis = 1))
+doublet_posterior = np.exp(best_doublet - np.logaddexp(best_singlet_lp, best_doublet))
+
+status_counts = {"singlet": 0, "doublet": 0, "unassigned": 0}
+with open(args.out, 'w') as out:
+    out.write("barcode\tstatus\tassignment\tlog_prob_singleton\tlog_prob_doublet\t" +
+        "\t".join(["cluster" + str(c) for c in range(K)]) + "\n")
+    for cell in range(len(barcodes)):
+        pair = pairs[best_pair[cell]] if len(pairs) > 0 else None
+        if best_singlet_lp[cell] > best_doublet[cell]:
+            assignment = str(best_singlet[cell])
+            status = "singlet" if singlet_posterior[cell] > args.singlet_threshold else "unassigned"
+        else:
+            assignment = str(pair[0]) + "/" + str(pair[1])
+            status = "doublet" if doublet_posterior[cell] >= args.doublet_threshold else "unassigned"
+        status_counts[status] += 1
+        out.write("\t".join([barcodes[cell], status, assignment, str(best_singlet_lp[cell]), str(best_doublet[cell])] +
+            [str(x) for x in singlet[cell]]) + "\n")
+print("\t".join([status + " " + str(count) for (status, count) in status_counts.items()]))
@@ -0,0 +1,98 @@
+import functools
+import hashlib
+import os
+
+import numpy as np
+
+# barcodes.tsv as a sorted array of 2 bit packed uint64 keys with the barcode's column (line number)
+# alongside, saved as one .npy that every worker memory maps instead of building its own set of strings.
+# key layout: sequence (up to 24 bases, 2 bits each) << 16 | sequence length << 8 | gem group suffix + 1 (0 if none)
+
+max_bases = 24
+bases = str.maketrans("ACGT", "0123")
+
+def encode(barcode):
+    (seq, dash, suffix) = barcode.partition("-")
+    if len(seq) == 0 or len(seq) > max_bases:
+        return None
+    try:
+        packed = int(seq.translate(bases), 4)
+        group = int(suffix) + 1 if dash else 0
+    except ValueError:
+        return None
+    if group > 255:
+        return None
+    return (packed << 16) | (len(seq) << 8) | group
+
+def parse(barcodes_fn):
+    # returns the index table, or None if some barcode cannot be packed (callers fall back to a set)
+    with open(barcodes_fn) as barcodes:
+        return table([line.strip().split()[0] for line in barcodes])
+
+def table(barcodes):
+    # the index table of a list of barcodes, each one's column being its position in the list
+    keys = []
+    for barcode in barcodes:
+        key = encode(barcode)
+        if key == None:
+            return None
+        keys.append(key)
+    keys = np.array(keys, dtype = np.uint64)
+    columns = np.arange(len(keys), dtype = np.uint64)
+    order = np.argsort(keys, kind = "stable")
+    keys = keys[order]
+    columns = columns[order]
+    # a barcode listed twice keeps its first column
+    first = np.ones(len(keys), dtype = bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return np.stack([keys[first], columns[first]])
+
+def checksum(barcodes_fn):
+    md5 = hashlib.md5()
+    with open(barcodes_fn, 'rb') as barcodes:
+        for chunk in iter(lambda: barcodes.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def save(table, index_fn, barcodes_fn = None):
+    # with the checksum of the barcodes file it was built from next to it, see current()
+    np.save(index_fn, table)
+    if barcodes_fn:
+        with open(index_fn + ".md5", 'w') as out:
+            out.write(checksum(barcodes_fn) + "\n")
+
+def current(index_fn, barcodes_fn):
+    # whether index_fn was built from the barcodes file as it is now
+    if not os.path.exists(index_fn) or not os.path.exists(index_fn + ".md5"):
+        return False
+    with open(index_fn + ".md5") as saved:
+        return saved.read().strip() == checksum(barcodes_fn)
+
+class BarcodeIndex:
+    def __init__(self, table, cache_size = 1 << 16):
+        if isinstance(table, str):
+            table = np.load(table, mmap_mode = 'r')
+        self.keys = table[0]
+        self.columns = table[1]
+        # the same barcodes come up read after read, a small cache per process saves packing and searching
+        # for them again without copying the table out of the shared mapping
+        self.column = functools.lru_cache(maxsize = cache_size)(self.search)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, barcode):
+        return not(self.column(barcode) == None)
+
+    def search(self, barcode):
+        key = encode(barcode)
+        if key == None:
+            return None
+        index = int(np.searchsorted(self.keys, np.uint64(key)))
+        if index < len(self.keys) and int(self.keys[index]) == key:
+            return int(self.columns[index])
+        return None
+
+    def get(self, barcode, default = None):
+        column = self.column(barcode)
+        return default if column == None else column
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="run souporcell_pipeline.py one stage at a time on a dataset from simulate.py, recording time, peak memory and accuracy against the truth")
+parser.add_argument("-d", "--data", required = True, help = "simulate.py output directory")
+parser.add_argument("-o", "--out_dir", required = True, help = "pipeline output directory, must not exist yet")
+parser.add_argument("-t", "--threads", required = False, default = 4, type = int, help = "threads, default = 4")
+parser.add_argument("-k", "--clusters", required = False, default = None, help = "clusters, default = number of simulated donors")
+parser.add_argument("--pipeline_args", required = False, default = "",
+    help = "extra souporcell_pipeline.py arguments as one quoted string, e.g. \"--allele_counter native --overlap\"")
+parser.add_argument("--results", required = False, default = None, help = "results json, default = out_dir/benchmark.json")
+args = parser.parse_args()
+
+import json
+import os
+import shlex
+import subprocess
+import time
+import numpy as np
+
+assert os.path.exists(args.data + "/possorted_genome_bam.bam"), "no simulated bam in " + args.data + ", run benchmark/simulate.py first"
+assert not os.path.exists(args.out_dir), args.out_dir + " already exists, stages that are done would not be timed"
+with open(args.data + "/truth.json") as truth_json:
+    simulation = json.load(truth_json)
+clusters = args.clusters or str(simulation["donors"])
+extra_args = shlex.split(args.pipeline_args)
+results_fn = args.results or args.out_dir + "/benchmark.json"
+
+# the pipeline is run once per stage with --stop_after, every run resuming from the last one's .done files
+stages = ["variants", "counts", "clustering", "doublets", "consensus"]
+if not("--skip_remap" in extra_args):
+    stages = ["fastqs", "remap", "retag"] + stages
+
+def tree_rss_kb(root):
+    # resident memory of a process and all its descendants on this host, from /proc
+    children = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/" + pid + "/stat") as stat:
+                # the command name can hold spaces, the fields after its closing paren cannot
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(pid))
+    total = 0
+    stack = [root]
+    while len(stack) > 0:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open("/proc/" + str(pid) + "/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+def disk_bytes(dirs):
+    total = 0
+    for top in dirs:
+        for (root, subdirs, files) in os.walk(top):
+            for fn in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, fn))
+                except OSError:
+                    pass
+    return total
+
+# intermediates are counted wherever the pipeline puts them
+disk_dirs = [args.out_dir]
+if "--scratch_dir" in extra_args:
+    disk_dirs.append(extra_args[extra_args.index("--scratch_dir") + 1])
+
+def pipeline_cmd():
+    return(["souporcell_pipeline.py", "-i", args.data + "/possorted_genome_bam.bam", "-b", args.data + "/barcodes.tsv",
+        "-f", args.data + "/reference.fa", "-t", str(args.threads), "-o", args.out_dir, "-k", clusters] + extra_args)
+
+def run_stage(stage):
+    cmd = pipeline_cmd()
+    if not stage == "consensus":
+        cmd.extend(["--stop_after", stage])
+    log_fn = args.out_dir + "." + stage + ".log"
+    start = time.time()
+    peak = 0
+    start_disk = disk_bytes(disk_dirs)
+    peak_disk = start_disk
+    with open(log_fn, 'w') as log:
+        p = subprocess.Popen(cmd, stdout = log, stderr = subprocess.STDOUT)
+        while p.poll() == None:
+            peak = max(peak, tree_rss_kb(p.pid))
+            peak_disk = max(peak_disk, disk_bytes(disk_dirs))
+            time.sleep(0.2)
+    assert not(p.returncode), "souporcell_pipeline.py failed in " + stage + ", see " + log_fn
+    # growth over what earlier stages left behind, about what this stage needed for its intermediates
+    return({"stage": stage, "seconds": round(time.time() - start, 2), "peak_rss_mb": round(peak / 1024.0, 1),
+        "peak_disk_mb": round((peak_disk - start_disk) / 1048576.0, 1)})
+
+def run_plan():
+    # the pipeline's own prediction, kept next to the measurements so planner.py --fit can calibrate against them
+    plan_fn = args.out_dir + ".plan.json"
+    subprocess.check_call(pipeline_cmd() + ["--plan", "--plan_json", plan_fn], stdout = subprocess.DEVNULL)
+    with open(plan_fn) as plan_json:
+        return(json.load(plan_json))
+
+def read_clusters(fn):
+    calls = {}
+    with open(fn) as clusters_file:
+        clusters_file.readline()
+        for line in clusters_file:
+            toks = line.strip().split("\t")
+            calls[toks[0]] = (toks[1], toks[2])
+    return(calls)
+
+def accuracy():
+    from scipy.optimize import linear_sum_assignment
+    truth = {}
+    with open(args.data + "/truth.tsv") as truth_file:
+        truth_file.readline()
+        for line in truth_file:
+            (barcode, status, donors) = line.strip().split("\t")
+            truth[barcode] = (status, donors)
+    calls = read_clusters(args.out_dir + "/clusters.tsv")
+    # clusters are numbered arbitrarily, pair them with donors to maximize agreement on true singlets
+    confusion = np.zeros((int(clusters), simulation["donors"]), dtype = np.int64)
+    for (barcode, (status, donors)) in truth.items():
+        if status == "singlet" and barcode in calls and calls[barcode][0] == "singlet":
+            confusion[int(calls[barcode][1]), int(donors)] += 1
+    (rows, cols) = linear_sum_assignment(-confusion)
+    donor_of = dict(zip(rows.tolist(), cols.tolist()))
+    singlets = [barcode for barcode in truth if truth[barcode][0] == "singlet"]
+    correct = len([barcode for barcode in singlets if barcode in calls and calls[barcode][0] == "singlet" and
+        donor_of.get(int(calls[barcode][1])) == int(truth[barcode][1])])
+    true_doublets = set([barcode for barcode in truth if truth[barcode][0] == "doublet"])
+    called_doublets = set([barcode for barcode in calls if calls[barcode][0] == "doublet"])
+    results = {"singlet_accuracy": round(correct / max(len(singlets), 1), 4),
+        "doublet_precision": round(len(true_doublets & called_doublets) / max(len(called_doublets), 1), 4),
+        "doublet_recall": round(len(true_doublets & called_doublets) / max(len(true_doublets), 1), 4),
+        "ambient_true": simulation["ambient"]}
+    if os.path.exists(args.out_dir + "/ambient_rna.txt"):
+        with open(args.out_dir + "/ambient_rna.txt") as soup:
+            # "ambient RNA estimated as X%"
+            results["ambient_estimated"] = round(float(soup.read().strip().split()[-1].rstrip("%")) / 100.0, 4)
+    return(results)
+
+plan = run_plan()
+timings = []
+for stage in stages:
+    print("running " + stage)
+    timings.append(run_stage(stage))
+    print("\t".join([stage, str(timings[-1]["seconds"]) + "s", str(timings[-1]["peak_rss_mb"]) + "MB"]))
+results = {"data": args.data, "simulation": simulation, "threads": args.threads, "clusters": clusters,
+    "pipeline_args": extra_args, "plan": plan, "stages": timings, "total_seconds": round(sum([timing["seconds"] for timing in timings]), 2),
+    "accuracy": accuracy()}
+with open(results_fn, 'w') as out:
+    json.dump(results, out, indent = 1)
+
+predicted = dict([(estimate["stage"], estimate) for estimate in plan["stages"]])
+print("stage\tseconds\tpeak_rss_mb\tpeak_disk_mb\tplanned_seconds\tplanned_rss_mb\tplanned_disk_mb")
+for timing in timings:
+    estimate = predicted.get(timing["stage"], {})
+    print("\t".join([timing["stage"], str(timing["seconds"]), str(timing["peak_rss_mb"]), str(timing["peak_disk_mb"]),
+        str(estimate.get("seconds")), str(estimate.get("rss_mb")), str(estimate.get("disk_mb"))]))
+print("total\t" + str(results["total_seconds"]))
+for (metric, value) in results["accuracy"].items():
+    print(metric + "\t" + str(value))
+print("results written to " + results_fn)
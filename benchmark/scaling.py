@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="scaling benchmark of the compute stages (souporcell clustering, troublet, consensus.py) on synthetic " +
+    "allele count matrices over a grid of cells, loci, clusters and threads")
+parser.add_argument("-o", "--out_dir", required = True, help = "output directory for the matrices, stage outputs and results")
+parser.add_argument("--cells", required = False, default = "1000,10000", help = "comma separated cell counts, default = 1000,10000")
+parser.add_argument("--loci", required = False, default = "1000,10000", help = "comma separated locus counts, default = 1000,10000")
+parser.add_argument("--clusters", required = False, default = "2,8", help = "comma separated K values, default = 2,8")
+parser.add_argument("--threads", required = False, default = "1,4",
+    help = "comma separated thread counts for clustering, default = 1,4 (troublet and consensus.py are single threaded)")
+parser.add_argument("--stages", required = False, default = "souporcell,troublet,consensus",
+    help = "comma separated stages to run, default = souporcell,troublet,consensus")
+parser.add_argument("--loci_per_cell", required = False, default = 300, type = int, help = "mean covered loci per cell, default = 300")
+parser.add_argument("--doublet_rate", required = False, default = 0.05, type = float, help = "default = 0.05")
+parser.add_argument("--ambient", required = False, default = 0.05, type = float, help = "default = 0.05")
+parser.add_argument("--restarts", required = False, default = 10, type = int, help = "clustering restarts, default = 10")
+parser.add_argument("--seed", required = False, default = 1, type = int, help = "random seed, default = 1")
+args = parser.parse_args()
+
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_dir)
+import mtx
+
+def tool(name):
+    # the built binary in the repo if there is one, else whatever is on the PATH
+    built = os.path.join(repo_dir, name, "target", "release", name)
+    return(built if os.path.exists(built) else name)
+
+def grid(values):
+    return([int(value) for value in values.split(",")])
+
+def simulate(point_dir, cells, loci, clusters, seed):
+    # vartrix style ref/alt matrices, barcodes, a vcf for the loci and the truth, written a chunk of cells at a time
+    # so the largest grid points never hold all entries in memory
+    rng = np.random.default_rng(np.random.SeedSequence([seed, cells, loci, clusters]))
+    centers = rng.choice([0.0, 0.5, 1.0], size = (clusters, loci), p = [0.5, 0.3, 0.2])
+    donor1 = rng.integers(0, clusters, cells)
+    donor2 = (donor1 + rng.integers(1, max(clusters, 2), cells)) % clusters
+    doublet = rng.random(cells) < args.doublet_rate
+    soup = centers.mean(axis = 0)
+    with open(point_dir + "/barcodes.tsv", 'w') as out:
+        for cell in range(cells):
+            out.write("CELL" + str(cell) + "-1\n")
+    with open(point_dir + "/truth.tsv", 'w') as out:
+        for cell in range(cells):
+            out.write("\t".join(["CELL" + str(cell) + "-1", "doublet" if doublet[cell] else "singlet", str(donor1[cell]),
+                str(donor2[cell]) if doublet[cell] else ""]) + "\n")
+    with open(point_dir + "/loci.vcf", 'w') as vcf:
+        vcf.write("##fileformat=VCFv4.2\n##contig=<ID=chr1,length=" + str(loci * 10 + 100) + ">\n")
+        vcf.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO"]) + "\n")
+        for locus in range(loci):
+            vcf.write("chr1\t" + str(locus * 10 + 1) + "\t.\tA\tC\t100\tPASS\t.\n")
+    entries = 0
+    with open(point_dir + "/ref.body", 'w') as ref_body, open(point_dir + "/alt.body", 'w') as alt_body:
+        for first in range(0, cells, 20000):
+            chunk = np.arange(first, min(first + 20000, cells))
+            covered = np.minimum(rng.poisson(args.loci_per_cell, len(chunk)), loci)
+            cell = np.repeat(chunk, covered)
+            locus = rng.integers(0, loci, len(cell))
+            depth = 1 + rng.poisson(0.3, len(cell))
+            p_alt = centers[donor1[cell], locus]
+            mixed = doublet[cell]
+            p_alt[mixed] = 0.5 * (p_alt[mixed] + centers[donor2[cell[mixed]], locus[mixed]])
+            p_alt = (1.0 - args.ambient) * p_alt + args.ambient * soup[locus]
+            p_alt = 0.01 + 0.98 * p_alt # sequencing error
+            alt = rng.binomial(depth, p_alt)
+            (chunk_loci, chunk_cells, locus, cell, ref, alt) = mtx.combine([(0, locus, cell, depth - alt, alt)], loci, cells)
+            np.savetxt(ref_body, np.column_stack([locus + 1, cell + 1, ref]), fmt = "%d")
+            np.savetxt(alt_body, np.column_stack([locus + 1, cell + 1, alt]), fmt = "%d")
+            entries += len(locus)
+    for name in ["ref", "alt"]:
+        with open(point_dir + "/" + name + ".mtx", 'w') as out:
+            out.write("%%MatrixMarket matrix coordinate integer general\n% written by souporcell\n")
+            out.write(str(loci) + " " + str(cells) + " " + str(entries) + "\n")
+            with open(point_dir + "/" + name + ".body") as body:
+                shutil.copyfileobj(body, out)
+        os.remove(point_dir + "/" + name + ".body")
+    return(entries)
+
+def run(cmd, point_dir, stdout_fn, stderr_fn):
+    # wall time and the peak resident memory of the stage's own process
+    start = time.time()
+    with open(stdout_fn, 'w') as out, open(stderr_fn, 'w') as err:
+        p = subprocess.Popen(cmd, stdout = out, stderr = err, cwd = point_dir)
+        (pid, status, usage) = os.wait4(p.pid, 0)
+    assert status == 0, " ".join(cmd) + " failed, see " + stderr_fn
+    return(round(time.time() - start, 3), round(usage.ru_maxrss / 1024.0, 1))
+
+def read_truth(point_dir):
+    truth = []
+    with open(point_dir + "/truth.tsv") as truth_file:
+        for line in truth_file:
+            toks = line.rstrip("\n").split("\t")
+            truth.append((toks[1], int(toks[2])))
+    return(truth)
+
+def singlet_accuracy(truth, assignments, clusters):
+    # fraction of true singlets in the cluster of their donor, clusters paired with donors for the best agreement
+    confusion = np.zeros((clusters, clusters), dtype = np.int64)
+    for ((status, donor), assignment) in zip(truth, assignments):
+        if status == "singlet" and not(assignment == None):
+            confusion[assignment, donor] += 1
+    (rows, cols) = linear_sum_assignment(-confusion)
+    singlets = len([status for (status, donor) in truth if status == "singlet"])
+    return(round(confusion[rows, cols].sum() / max(singlets, 1), 4))
+
+def cell_of(barcode):
+    # barcodes are CELL<index>-1, outputs are matched to the truth by barcode rather than by line
+    return(int(barcode[len("CELL"):-len("-1")]))
+
+def souporcell_metrics(point_dir, clusters):
+    truth = read_truth(point_dir)
+    assignments = [None for cell in truth]
+    with open(point_dir + "/clusters_tmp.tsv") as calls:
+        for line in calls:
+            toks = line.split("\t")
+            assignments[cell_of(toks[0])] = int(toks[1])
+    return({"singlet_accuracy": singlet_accuracy(truth, assignments, clusters)})
+
+def troublet_metrics(point_dir, clusters):
+    truth = read_truth(point_dir)
+    assignments = [None for cell in truth]
+    called_doublet = np.zeros(len(truth), dtype = bool)
+    with open(point_dir + "/clusters.tsv") as calls:
+        calls.readline()
+        for line in calls:
+            toks = line.split("\t")
+            cell = cell_of(toks[0])
+            called_doublet[cell] = toks[1] == "doublet"
+            if toks[1] == "singlet":
+                assignments[cell] = int(toks[2])
+    true_doublet = np.array([status == "doublet" for (status, donor) in truth])
+    both = (true_doublet & called_doublet).sum()
+    return({"singlet_accuracy": singlet_accuracy(truth, assignments, clusters),
+        "doublet_precision": round(both / max(called_doublet.sum(), 1), 4),
+        "doublet_recall": round(both / max(true_doublet.sum(), 1), 4)})
+
+def consensus_metrics(point_dir, clusters):
+    with open(point_dir + "/ambient_rna.txt") as soup:
+        # "ambient RNA estimated as X%"
+        estimate = float(soup.read().strip().split()[-1].rstrip("%")) / 100.0
+    return({"ambient_error": round(abs(estimate - args.ambient), 4)})
+
+stages = args.stages.split(",")
+thread_counts = grid(args.threads)
+results = []
+columns = ["stage", "cells", "loci", "clusters", "threads", "entries", "seconds", "peak_rss_mb",
+    "singlet_accuracy", "doublet_precision", "doublet_recall", "ambient_error"]
+os.makedirs(args.out_dir, exist_ok = True)
+results_fn = args.out_dir + "/scaling_results.tsv"
+with open(results_fn, 'w') as out:
+    out.write("\t".join(columns) + "\n")
+
+def record(result):
+    results.append(result)
+    with open(results_fn, 'a') as out:
+        out.write("\t".join([str(result.get(column, "")) for column in columns]) + "\n")
+    print("\t".join([column + "=" + str(result[column]) for column in columns if column in result]))
+
+for (cells, loci, clusters) in itertools.product(grid(args.cells), grid(args.loci), grid(args.clusters)):
+    point_dir = args.out_dir + "/cells" + str(cells) + "_loci" + str(loci) + "_k" + str(clusters)
+    os.makedirs(point_dir, exist_ok = True)
+    entries = simulate(point_dir, cells, loci, clusters, args.seed)
+    point = {"cells": cells, "loci": loci, "clusters": clusters, "entries": entries}
+    for (index, threads) in enumerate(thread_counts):
+        if not "souporcell" in stages:
+            break
+        cmd = [tool("souporcell"), "-a", "alt.mtx", "-r", "ref.mtx", "-b", "barcodes.tsv", "-k", str(clusters),
+            "--restarts", str(args.restarts), "--threads", str(threads), "--seed", str(args.seed % 256), "--min_ref", "4", "--min_alt", "4"]
+        (seconds, rss) = run(cmd, point_dir, point_dir + "/clusters_tmp.tsv", point_dir + "/clusters.err")
+        record(dict(point, stage = "souporcell", threads = threads, seconds = seconds, peak_rss_mb = rss,
+            **souporcell_metrics(point_dir, clusters)))
+        # troublet and consensus.py run on the first clustering of each grid point only
+        if index > 0:
+            continue
+        if "troublet" in stages:
+            cmd = [tool("troublet"), "--alts", "alt.mtx", "--refs", "ref.mtx", "--clusters", "clusters_tmp.tsv"]
+            (seconds, rss) = run(cmd, point_dir, point_dir + "/clusters.tsv", point_dir + "/troublet.err")
+            record(dict(point, stage = "troublet", threads = 1, seconds = seconds, peak_rss_mb = rss, **troublet_metrics(point_dir, clusters)))
+        if "troublet" in stages and "consensus" in stages:
+            cmd = [sys.executable, os.path.join(repo_dir, "consensus.py"), "-c", "clusters.tsv", "-a", "alt.mtx", "-r", "ref.mtx",
+                "-p", "2", "--soup_out", "ambient_rna.txt", "--vcf_out", "cluster_genotypes.vcf", "--vcf", "loci.vcf"]
+            (seconds, rss) = run(cmd, point_dir, point_dir + "/consensus.out", point_dir + "/consensus.err")
+            record(dict(point, stage = "consensus", threads = 1, seconds = seconds, peak_rss_mb = rss, **consensus_metrics(point_dir, clusters)))
+
+def plot():
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib not installed, skipping plots")
+        return
+    for stage in sorted(set([result["stage"] for result in results])):
+        stage_results = [result for result in results if result["stage"] == stage]
+        (fig, axes) = plt.subplots(1, 2, figsize = (12, 5))
+        for (ax, metric, label) in [(axes[0], "seconds", "wall time (s)"), (axes[1], "peak_rss_mb", "peak RSS (MB)")]:
+            series = sorted(set([(result["loci"], result["clusters"], result["threads"]) for result in stage_results]))
+            for (loci, clusters, threads) in series:
+                points = sorted([(result["cells"], result[metric]) for result in stage_results
+                    if (result["loci"], result["clusters"], result["threads"]) == (loci, clusters, threads)])
+                ax.plot([x for (x, y) in points], [y for (x, y) in points], marker = "o",
+                    label = "loci " + str(loci) + " k " + str(clusters) + " threads " + str(threads))
+            ax.set_xscale("log")
+            ax.set_yscale("log")
+            ax.set_xlabel("cells")
+            ax.set_ylabel(label)
+        axes[1].legend(fontsize = "small")
+        fig.suptitle(stage)
+        fig.savefig(args.out_dir + "/scaling_" + stage + ".png", dpi = 100, bbox_inches = "tight")
+        plt.close(fig)
+
+plot()
+print("results written to " + results_fn)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="simulate a small mixed donor 10x dataset (reference, cellranger style bam, barcodes and ground truth) for benchmarking souporcell")
+parser.add_argument("-o", "--out_dir", required = True, help = "output directory")
+parser.add_argument("-k", "--donors", required = False, default = 4, type = int, help = "number of donors, default = 4")
+parser.add_argument("--cells", required = False, default = 500, type = int, help = "cell barcodes in barcodes.tsv, default = 500")
+parser.add_argument("--sites", required = False, default = 3000, type = int, help = "variant sites, default = 3000")
+parser.add_argument("--contigs", required = False, default = 2, type = int, help = "reference contigs, default = 2")
+parser.add_argument("--contig_length", required = False, default = 500000, type = int,
+    help = "length of each contig, default = 500000 (freebayes region planning skips contigs under 250kb)")
+parser.add_argument("--umis_per_cell", required = False, default = 1000, type = int, help = "mean molecules per cell, default = 1000")
+parser.add_argument("--read_length", required = False, default = 90, type = int, help = "read length, default = 90")
+parser.add_argument("--site_fraction", required = False, default = 0.8, type = float,
+    help = "fraction of molecules overlapping a variant site, the rest land anywhere, default = 0.8")
+parser.add_argument("--doublet_rate", required = False, default = 0.1, type = float, help = "fraction of barcodes that are doublets, default = 0.1")
+parser.add_argument("--ambient", required = False, default = 0.05, type = float,
+    help = "fraction of each cell's molecules drawn from the ambient pool of all cells, default = 0.05")
+parser.add_argument("--empty_droplets", required = False, default = 50, type = int,
+    help = "barcodes left out of barcodes.tsv that only hold ambient molecules, default = 50")
+parser.add_argument("--duplicates", required = False, default = 0.5, type = float, help = "mean extra reads per molecule, default = 0.5")
+parser.add_argument("--error_rate", required = False, default = 0.001, type = float, help = "per base sequencing error rate, default = 0.001")
+parser.add_argument("--seed", required = False, default = 1, type = int, help = "random seed, default = 1")
+args = parser.parse_args()
+
+import json
+import os
+import numpy as np
+import pysam
+
+# writes to out_dir:
+#   reference.fa(.fai)           random sequence
+#   possorted_genome_bam.bam     coordinate sorted, CB/UB tagged, already aligned at the true positions
+#   barcodes.tsv                 called cells (singlets and doublets, not the empty droplets)
+#   truth.tsv                    barcode, singlet/doublet, donor(s) (comma separated for doublets)
+#   truth_genotypes.vcf          every site with each donor's GT, usable as --known_genotypes or --common_variants
+#   truth.json                   the parameters above
+
+rng = np.random.default_rng(args.seed)
+bases = np.frombuffer(b"ACGT", dtype = np.uint8)
+os.makedirs(args.out_dir, exist_ok = True)
+
+contig_names = ["chr" + str(contig + 1) for contig in range(args.contigs)]
+reference = [bases[rng.integers(0, 4, args.contig_length)] for contig in range(args.contigs)]
+with open(args.out_dir + "/reference.fa", 'w') as fasta:
+    for (name, seq) in zip(contig_names, reference):
+        fasta.write(">" + name + "\n")
+        text = seq.tobytes().decode()
+        for start in range(0, len(text), 60):
+            fasta.write(text[start:start + 60] + "\n")
+pysam.faidx(args.out_dir + "/reference.fa")
+
+# sites away from contig ends, each with an alt base, a population allele frequency and an expression
+# level (log normal, so coverage is as uneven as it is across genes)
+margin = args.read_length
+site_index = np.sort(rng.choice(args.contigs * (args.contig_length - 2 * margin), size = args.sites, replace = False))
+site_contig = site_index // (args.contig_length - 2 * margin)
+site_pos = site_index % (args.contig_length - 2 * margin) + margin
+site_ref = np.array([reference[contig][pos] for (contig, pos) in zip(site_contig, site_pos)], dtype = np.uint8)
+site_alt = np.array([bases[(np.searchsorted(bases, ref) + rng.integers(1, 4)) % 4] for ref in site_ref], dtype = np.uint8)
+allele_freq = rng.uniform(0.05, 0.5, args.sites)
+haplotypes = rng.random((args.donors, 2, args.sites)) < allele_freq # True is alt
+expression = rng.lognormal(0.0, 1.0, args.sites)
+expression /= expression.sum()
+
+with open(args.out_dir + "/truth_genotypes.vcf", 'w') as vcf:
+    vcf.write("##fileformat=VCFv4.2\n")
+    for (name, seq) in zip(contig_names, reference):
+        vcf.write("##contig=<ID=" + name + ",length=" + str(len(seq)) + ">\n")
+    vcf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    vcf.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] +
+        ["donor" + str(donor) for donor in range(args.donors)]) + "\n")
+    for site in range(args.sites):
+        gts = [str(int(haplotypes[donor, 0, site])) + "|" + str(int(haplotypes[donor, 1, site])) for donor in range(args.donors)]
+        vcf.write("\t".join([contig_names[site_contig[site]], str(site_pos[site] + 1), ".", chr(site_ref[site]), chr(site_alt[site]),
+            "100", "PASS", ".", "GT"] + gts) + "\n")
+
+def random_seq(length):
+    return bases[rng.integers(0, 4, length)].tobytes().decode()
+
+barcodes = set()
+while len(barcodes) < args.cells + args.empty_droplets:
+    barcodes.add(random_seq(16) + "-1")
+barcodes = sorted(barcodes)
+rng.shuffle(barcodes)
+cell_barcodes = barcodes[:args.cells]
+empty_barcodes = barcodes[args.cells:]
+cell_donors = []
+for cell in range(args.cells):
+    if rng.random() < args.doublet_rate:
+        cell_donors.append(sorted(rng.choice(args.donors, size = 2, replace = False).tolist()))
+    else:
+        cell_donors.append([int(rng.integers(0, args.donors))])
+# the ambient pool is every cell's molecules mixed together, so donors contribute by how many cells they have
+donor_weights = np.zeros(args.donors)
+for donors in cell_donors:
+    for donor in donors:
+        donor_weights[donor] += 1.0 / len(donors)
+donor_weights /= donor_weights.sum()
+
+def molecules(barcode, donors, umis, ambient):
+    # reads for one droplet as (contig, start, reverse, name, sequence, barcode, umi)
+    reads = []
+    source = rng.choice(donors, size = umis)
+    from_soup = rng.random(umis) < ambient
+    source[from_soup] = rng.choice(args.donors, size = int(from_soup.sum()), p = donor_weights)
+    on_site = rng.random(umis) < args.site_fraction
+    sites = rng.choice(args.sites, size = umis, p = expression)
+    for molecule in range(umis):
+        if on_site[molecule]:
+            site = sites[molecule]
+            contig = site_contig[site]
+            start = site_pos[site] - int(rng.integers(0, args.read_length))
+        else:
+            contig = int(rng.integers(0, args.contigs))
+            start = int(rng.integers(0, args.contig_length - args.read_length))
+        seq = reference[contig][start:start + args.read_length].copy()
+        # every site under the read gets the allele of one of the source donor's haplotypes
+        offset = contig * (args.contig_length - 2 * margin) - margin
+        first = np.searchsorted(site_index, max(offset + start, offset + margin))
+        last = np.searchsorted(site_index, min(offset + start + args.read_length, offset + args.contig_length - margin))
+        haplotype = haplotypes[source[molecule], int(rng.integers(0, 2))]
+        for site in range(first, last):
+            if haplotype[site]:
+                seq[site_pos[site] - start] = site_alt[site]
+        umi = random_seq(12)
+        reverse = bool(rng.random() < 0.5)
+        for copy in range(1 + rng.poisson(args.duplicates)):
+            read_seq = seq.copy()
+            errors = rng.random(args.read_length) < args.error_rate
+            read_seq[errors] = bases[rng.integers(0, 4, int(errors.sum()))]
+            name = barcode[:16] + ":" + str(molecule) + ":" + str(copy)
+            reads.append((int(contig), int(start), reverse, name, read_seq.tobytes().decode(), barcode, umi))
+    return reads
+
+print("simulating reads")
+reads = []
+for (barcode, donors) in zip(cell_barcodes, cell_donors):
+    reads.extend(molecules(barcode, donors, max(1, rng.poisson(args.umis_per_cell)), args.ambient))
+for barcode in empty_barcodes:
+    reads.extend(molecules(barcode, list(range(args.donors)), max(1, rng.poisson(args.umis_per_cell // 10)), 1.0))
+reads.sort(key = lambda read: (read[0], read[1]))
+
+print("writing " + str(len(reads)) + " reads")
+header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+    "SQ": [{"SN": name, "LN": args.contig_length} for name in contig_names]}
+bam_fn = args.out_dir + "/possorted_genome_bam.bam"
+qualities = pysam.qualitystring_to_array("I" * args.read_length)
+with pysam.AlignmentFile(bam_fn, "wb", header = header) as bam:
+    for (contig, start, reverse, name, seq, barcode, umi) in reads:
+        read = pysam.AlignedSegment()
+        read.query_name = name
+        read.query_sequence = seq
+        read.flag = 16 if reverse else 0
+        read.reference_id = contig
+        read.reference_start = start
+        read.mapping_quality = 255
+        read.cigartuples = [(0, args.read_length)]
+        read.query_qualities = qualities
+        read.set_tags([("CB", barcode), ("UB", umi)])
+        bam.write(read)
+pysam.index(bam_fn)
+
+with open(args.out_dir + "/barcodes.tsv", 'w') as out:
+    for barcode in cell_barcodes:
+        out.write(barcode + "\n")
+with open(args.out_dir + "/truth.tsv", 'w') as out:
+    out.write("barcode\tstatus\tdonors\n")
+    for (barcode, donors) in zip(cell_barcodes, cell_donors):
+        out.write(barcode + "\t" + ("singlet" if len(donors) == 1 else "doublet") + "\t" + ",".join([str(donor) for donor in donors]) + "\n")
+with open(args.out_dir + "/truth.json", 'w') as out:
+    json.dump(vars(args), out, indent = 1)
+print("done")
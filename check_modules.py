@@ -1,14 +1,27 @@
-import numpy as np
-import tensorflow as tf
-import scipy
-import gzip
-import math
-import pystan
-import vcf
-import pysam
-import pyfasta
-import subprocess
-import time
-import os
-
-print("check successful"_)
+#!/usr/bin/env python
+
+import importlib
+import sys
+
+# python modules needed by each part of souporcell_pipeline.py, imported here only to check they are installed
+modules = [
+    ("numpy", "barcode index, allele matrices, assign.py, consensus.py"),
+    ("scipy", "assign.py, consensus.py"),
+    ("pysam", "bam checks, renamer.py, retag.py, allele_counter.py"),
+    ("vcf", "consensus.py (pyvcf)"),
+    ("pystan", "consensus.py"),
+]
+
+missing = []
+for (module, used_by) in modules:
+    try:
+        importlib.import_module(module)
+        print("found " + module)
+    except ImportError:
+        print("missing " + module + " (used by " + used_by + ")")
+        missing.append(module)
+
+if len(missing) > 0:
+    print("check failed, missing " + " ".join(missing))
+    sys.exit(1)
+print("check successful")
@@ -10,6 +10,7 @@ parser.add_argument("-r","--ref_matrix",required=True,help="ref matrix file")
 parser.add_argument("-p","--ploidy",required=False, help="ploidy, must be 1 or 2, defaults to 2")
 parser.add_argument("--soup_out",required=True, help="soup output")
 parser.add_argument("--vcf_out",required=True, help="vcf output")
+parser.add_argument("--store_dir",required=False, default=None, help="also write the ambient RNA fraction and genotype posteriors as arrays to this results store (results.py)")
 #parser.add_argument("-d","--doublets",required=True, help="doublet calls")
 parser.add_argument("-v","--vcf",required=True,help="vcf file from which alt and ref matrix were created")
 args = parser.parse_args()
@@ -359,14 +360,24 @@ import gzip
 vcftemplate = vcf.Reader(myopen(args.vcf))
 vcfreader = vcf.Reader(myopen(args.vcf))
 import math
-with open("tempsouporcell.vcf",'w') as geno:
+# next to the output rather than in the working directory, which batch channels share
+tmp_vcf = args.vcf_out + ".tmp"
+with open(tmp_vcf,'w') as geno:
     vcfwriter = vcf.Writer(geno,vcftemplate)
     samples = [str(cluster) for cluster in range(max_cluster+1)]
     vcfwriter.template.samples = samples
     locus = -1
+    store_loci = []
+    store_chrom = []
+    store_pos = []
+    store_posteriors = []
     for rec in vcfreader:
         locus += 1
         if locus in locus_index:
+            store_loci.append(locus)
+            store_chrom.append(rec.CHROM)
+            store_pos.append(rec.POS)
+            store_posteriors.append([])
             newrec = vcf.model._Record(rec.CHROM, rec.POS, rec.ID, rec.REF, rec.ALT, rec.QUAL, rec.FILTER, rec.INFO, 'GT:AO:RO:T:E:GO:GN', {str(x):x for x in range(max_cluster+1)})
             calls = []
             
@@ -393,6 +404,7 @@ with open("tempsouporcell.vcf",'w') as geno:
                 #print(err)
                 logpost = [x - sumexp for x in genotypes]
                 posteriors = np.exp(logpost)
+                store_posteriors[-1].append(posteriors)
                 gn = []
                 for g in logpost:
                     if math.isnan(g):
@@ -430,7 +442,7 @@ with open("tempsouporcell.vcf",'w') as geno:
                 calls.append(vcf.model._Call(newrec, str(cluster), CallData(gt, ao, ro, truth, err, go, gn)))
             newrec.samples = calls
             vcfwriter.write_record(newrec)
-with open("tempsouporcell.vcf") as tmp:
+with open(tmp_vcf) as tmp:
     with open(args.vcf_out,'w') as out:
         for line in tmp:
             if line.startswith("#"):
@@ -440,4 +452,9 @@ with open("tempsouporcell.vcf") as tmp:
                     out.write(line)
             else:
                 out.write(line)
-subprocess.check_call(["rm","tempsouporcell.vcf"])
+subprocess.check_call(["rm",tmp_vcf])
+if args.store_dir:
+    import results
+    results.write_ambient(args.store_dir, float(fit['p_soup']))
+    results.write_genotypes(args.store_dir, store_loci, store_chrom, store_pos,
+        np.array(store_posteriors).reshape((len(store_loci), max_cluster + 1, len(results.genotype_names[int(args.ploidy)]))), args.ploidy)
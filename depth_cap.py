@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="copy the reads of one region to a bam with the depth at hotspots capped, for variant calling only. " +
+    "reads are sampled per window of read starts, spread as evenly as the reads allow over the cell barcodes (CB)")
+parser.add_argument("-i", "--bam", required = True, help = "sorted and indexed bam")
+parser.add_argument("-r", "--region", required = True, help = "chrom:start-end, 0 based start and end included, as freebayes -r takes it")
+parser.add_argument("-o", "--out", required = True, help = "capped bam, indexed as well")
+parser.add_argument("-d", "--max_depth", required = True, type = int, help = "depth to cap positions at")
+parser.add_argument("--window", required = False, default = 50, type = int, help = "bases of read starts sampled together, default = 50")
+parser.add_argument("--seed", required = False, default = 4, type = int, help = "random seed")
+args = parser.parse_args()
+
+import random
+import sys
+import pysam
+import progress
+
+# reads are taken a window of read starts at a time. a window whose reads are few enough is copied as is.
+# at a hotspot each barcode's reads go through a reservoir sample and the window's quota of reads is shared
+# out between barcodes by water filling, every barcode keeping all of its reads up to an equal share, so the
+# per cell allele evidence survives while the pileup shrinks. a position is covered by the reads of about
+# (aligned read length / window + 1) windows, which sets the quota per window from max_depth
+
+rng = random.Random(args.seed)
+
+def water_fill(counts, quota):
+    # reads to take from each barcode, in the order of counts, adding up to min(quota, sum(counts))
+    takes = [0] * len(counts)
+    remaining = quota
+    order = sorted(range(len(counts)), key = lambda index: counts[index])
+    for (position, index) in enumerate(order):
+        share = remaining // (len(order) - position)
+        takes[index] = min(counts[index], share)
+        remaining -= takes[index]
+    # what floor division left over goes to the barcodes with reads to spare
+    for index in reversed(order):
+        if remaining == 0:
+            break
+        if takes[index] < counts[index]:
+            takes[index] += 1
+            remaining -= 1
+    return(takes)
+
+class Window:
+    def __init__(self):
+        self.reads = 0
+        self.aligned = 0
+        self.reservoirs = {} # barcode -> [reads seen, sampled reads]
+
+    def add(self, read, limit):
+        self.reads += 1
+        self.aligned += read.query_alignment_length
+        barcode = read.get_tag("CB") if read.has_tag("CB") else None
+        reservoir = self.reservoirs.setdefault(barcode, [0, []])
+        reservoir[0] += 1
+        if len(reservoir[1]) < limit:
+            reservoir[1].append(read)
+        else:
+            # reservoir sampling, each of the barcode's reads so far is in the sample with equal chance
+            slot = rng.randrange(reservoir[0])
+            if slot < limit:
+                reservoir[1][slot] = read
+
+    def quota(self):
+        read_length = self.aligned / float(max(self.reads, 1))
+        return(max(1, int(args.max_depth * args.window / (read_length + args.window))))
+
+    def kept(self, quota):
+        if self.reads <= quota:
+            return([read for (seen, sample) in self.reservoirs.values() for read in sample])
+        barcodes = list(self.reservoirs.keys())
+        takes = water_fill([self.reservoirs[barcode][0] for barcode in barcodes], quota)
+        reads = []
+        for (barcode, take) in zip(barcodes, takes):
+            reads.extend(rng.sample(self.reservoirs[barcode][1], take))
+        return(reads)
+
+def flush(window, out):
+    quota = window.quota()
+    selected = window.kept(quota)
+    selected.sort(key = lambda read: read.reference_start)
+    for read in selected:
+        out.write(read)
+    return((len(selected), window.reads > quota))
+
+(chrom, span) = args.region.rsplit(":", 1)
+(start, end) = [int(x) for x in span.replace(",", "").split("-")]
+bam = pysam.AlignmentFile(args.bam)
+out = pysam.AlignmentFile(args.out, 'wb', template = bam)
+throughput = progress.Throughput("depth cap", out = args.out)
+# no barcode needs to keep more than a whole window's quota, which bounds the reservoirs at a hotspot
+limit = max(1, args.max_depth)
+reads = 0
+kept = 0
+hotspots = 0
+window = Window()
+window_start = None
+for read in bam.fetch(chrom, start, end + 1):
+    reads += 1
+    if reads & 0xffff == 0:
+        throughput.update(reads)
+    if window_start == None or read.reference_start >= window_start + args.window:
+        if window.reads > 0:
+            (written, capped) = flush(window, out)
+            kept += written
+            hotspots += capped
+        window = Window()
+        window_start = read.reference_start - read.reference_start % args.window
+    window.add(read, limit)
+if window.reads > 0:
+    (written, capped) = flush(window, out)
+    kept += written
+    hotspots += capped
+out.close()
+pysam.index(args.out)
+throughput.done(reads)
+sys.stderr.write(args.region + ": kept " + str(kept) + " of " + str(reads) + " reads, " + str(hotspots) + " windows capped\n")
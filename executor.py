@@ -0,0 +1,101 @@
+import json
+import os
+import socket
+import subprocess
+import time
+import progress
+import slots
+
+# where shard jobs run. stages start every job through popen/check_call here and get back something
+# that behaves like a subprocess.Popen (poll, wait, returncode), without knowing which host ran it.
+#   local: a subprocess on this host, queued for the batch's shared slots if there are any (slots.py)
+#   queue: a json job file in a directory on shared storage, claimed and run by souporcell_worker.py
+#          daemons on any host that can see it. jobs run in the submitter's working directory and their
+#          stdout/stderr must be files, so every path a job touches has to be on the shared storage too
+# SOUPORCELL_QUEUE picks the queue backend so child processes and whole batches follow the same choice
+
+env_var = "SOUPORCELL_QUEUE"
+poll_seconds = 0.5
+# a running job whose worker has not touched it for this long is assumed lost with its host and requeued
+lost_after = 120.0
+# settings a queued job takes along to whichever host runs it
+forwarded_env = [progress.env_var]
+
+def queue_dirs(queue_dir):
+    return([os.path.join(queue_dir, sub) for sub in ["pending", "running", "done", "logs"]])
+
+def create_queue(queue_dir):
+    for sub in queue_dirs(queue_dir):
+        os.makedirs(sub, exist_ok = True)
+
+job_counter = 0
+
+def new_job_id():
+    # names sort in submission order, workers take the oldest first
+    global job_counter
+    job_counter += 1
+    return("%020d_%s_%d_%d" % (time.time_ns(), socket.gethostname(), os.getpid(), job_counter))
+
+def appends(handle):
+    # whether the submitter opened the file for append, a log shared by several jobs, rather than for writing
+    return(isinstance(getattr(handle, "mode", None), str) and "a" in handle.mode)
+
+def output_path(handle, name):
+    if handle == None:
+        return(None)
+    if handle == subprocess.STDOUT and name == "stderr":
+        return("stdout")
+    if hasattr(handle, "name") and isinstance(handle.name, str):
+        handle.flush()
+        return(os.path.abspath(handle.name))
+    raise ValueError("queue executor jobs need " + name + " to be a file on shared storage")
+
+class QueuedJob:
+    def __init__(self, queue_dir, cmd, threads, stdout = None, stderr = None):
+        create_queue(queue_dir)
+        self.queue_dir = queue_dir
+        self.job_id = new_job_id()
+        self.cmd = [str(tok) for tok in cmd]
+        self.returncode = None
+        job = {"cmd": self.cmd, "threads": int(threads), "cwd": os.getcwd(),
+            "stdout": output_path(stdout, "stdout"), "stderr": output_path(stderr, "stderr"),
+            "stdout_append": appends(stdout), "stderr_append": appends(stderr),
+            "env": dict([(name, os.environ[name]) for name in forwarded_env if name in os.environ])}
+        pending = os.path.join(queue_dir, "pending", self.job_id + ".json")
+        with open(pending + ".tmp", 'w') as out:
+            json.dump(job, out)
+        os.rename(pending + ".tmp", pending)
+
+    def poll(self):
+        if not(self.returncode == None):
+            return(self.returncode)
+        done = os.path.join(self.queue_dir, "done", self.job_id + ".json")
+        if os.path.exists(done):
+            with open(done) as result:
+                self.returncode = json.load(result)["returncode"]
+            os.remove(done)
+            return(self.returncode)
+        running = os.path.join(self.queue_dir, "running", self.job_id + ".json")
+        try:
+            if time.time() - os.path.getmtime(running) > lost_after:
+                os.rename(running, os.path.join(self.queue_dir, "pending", self.job_id + ".json"))
+        except OSError:
+            pass # pending, or finished since the check above
+        return(None)
+
+    def wait(self):
+        while self.poll() == None:
+            time.sleep(poll_seconds)
+        return(self.returncode)
+
+def popen(cmd, threads = 1, stdout = None, stderr = None):
+    queue_dir = os.environ.get(env_var)
+    if queue_dir:
+        return(QueuedJob(queue_dir, cmd, threads, stdout = stdout, stderr = stderr))
+    return(slots.popen(cmd, threads = threads, stdout = stdout, stderr = stderr))
+
+def check_call(cmd, threads = 1, stdout = None, stderr = None):
+    p = popen(cmd, threads = threads, stdout = stdout, stderr = stderr)
+    p.wait()
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import subprocess
+
+import artifacts
+import reference
+
+# known genotypes from population vcfs that can be tens of GB: plain, bgzipped or bcf, ideally indexed.
+# only the loci with coverage are pulled out of the panel (bcftools with the tabix/csi index, or streaming
+# without one), only the requested sample columns are decoded, and the genotype matrix of a vcf is cached
+# per file, samples and loci in the souporcell cache directory (SOUPORCELL_CACHE)
+
+def indexed(vcf_fn):
+    return(os.path.exists(vcf_fn + ".csi") or (vcf_fn.endswith(".gz") and os.path.exists(vcf_fn + ".tbi")))
+
+def covered_cmd(vcf_fn, bed_fn, out_fn, samples = None):
+    # bcftools command writing the records of vcf_fn within the bed regions to out_fn as plain vcf, keeping only
+    # the named sample columns (none at all without samples, the loci are all that is needed then)
+    cmd = ["bcftools", "view", "-Ov", "-o", out_fn]
+    # -R jumps to each region with the index, -T reads the whole file and keeps what falls in the regions
+    cmd.extend(["-R" if indexed(vcf_fn) else "-T", bed_fn])
+    if samples:
+        cmd.extend(["-s", ",".join(samples)])
+    else:
+        cmd.append("-G")
+    cmd.append(vcf_fn)
+    return(cmd)
+
+def records(vcf_fn, samples):
+    # (record index, [sample fields]) for every record, with the fields of the requested samples in their order
+    if vcf_fn.endswith(".vcf"):
+        stream = open(vcf_fn)
+        p = None
+    else:
+        # bcftools decodes only the requested columns of a bcf or bgzipped vcf
+        p = subprocess.Popen(["bcftools", "view", "-Ov", "-s", ",".join(samples), vcf_fn], stdout = subprocess.PIPE, universal_newlines = True)
+        stream = p.stdout
+    columns = None
+    index = 0
+    with stream:
+        for line in stream:
+            if line.startswith("##"):
+                continue
+            toks = line.rstrip("\n").split("\t")
+            if line.startswith("#CHROM"):
+                header = dict([(sample, column) for (column, sample) in enumerate(toks) if column > 8])
+                for sample in samples:
+                    assert sample in header, "sample " + sample + " is not in " + vcf_fn
+                columns = [header[sample] for sample in samples]
+                continue
+            yield((index, [toks[column] for column in columns]))
+            index += 1
+    if p:
+        p.wait()
+        assert not(p.returncode), "bcftools could not read " + vcf_fn
+
+def decode(fields):
+    # reference allele fraction of GT fields, rows of loci by sample columns: 1.0 for 0/0, 0.5 for 0/1,
+    # 0.0 for 1/1 (any non reference allele counts as alt), nan for missing. haploid calls count twice
+    import numpy as np
+    if len(fields) == 0:
+        return(np.zeros((0, 0), dtype = np.float32))
+    gt = np.array(fields, dtype = "S3") # 0|1:... -> 0|1, longer allele numbers are rare enough to cut short
+    gt = gt.view(np.uint8).reshape(gt.shape + (3,))
+    first = gt[..., 0]
+    separated = (gt[..., 1] == ord("/")) | (gt[..., 1] == ord("|"))
+    second = np.where(separated, gt[..., 2], first)
+    missing = (first == ord(".")) | (second == ord(".")) | (first == 0)
+    alt = (first != ord("0")).astype(np.float32) + (second != ord("0")).astype(np.float32)
+    fraction = 1.0 - alt / 2.0
+    fraction[missing] = np.nan
+    return(fraction)
+
+def genotype_matrix(vcf_fn, samples, loci = None):
+    # loci x samples reference allele fractions (nan where missing) for the record indices in loci, all records without
+    import numpy as np
+    loci_array = None if loci is None else np.asarray(loci, dtype = np.int64)
+    digest = hashlib.sha256((artifacts.fingerprint(vcf_fn) + "\t" + "\t".join(samples)).encode())
+    if not(loci_array is None):
+        digest.update(loci_array.tobytes())
+    cached = os.path.join(reference.cache_dir, digest.hexdigest() + ".genotypes.npy")
+    if os.path.exists(cached):
+        return(np.load(cached))
+    wanted = None if loci_array is None else set(loci_array.tolist())
+    rows = {}
+    fields = []
+    for (index, sample_fields) in records(vcf_fn, samples):
+        if wanted is None or index in wanted:
+            rows[index] = len(fields)
+            fields.append([field.split(":", 1)[0] for field in sample_fields])
+    fractions = decode(fields)
+    if not(loci_array is None):
+        # loci past the end of the vcf stay missing
+        matrix = np.full((len(loci_array), len(samples)), np.nan, dtype = np.float32)
+        found = [(out_row, rows[locus]) for (out_row, locus) in enumerate(loci_array.tolist()) if locus in rows]
+        if len(found) > 0:
+            (out_rows, in_rows) = zip(*found)
+            matrix[list(out_rows)] = fractions[list(in_rows)]
+        fractions = matrix
+    try:
+        os.makedirs(reference.cache_dir, exist_ok = True)
+        np.save(cached + ".tmp.npy", fractions)
+        os.rename(cached + ".tmp.npy", cached)
+    except OSError:
+        pass # the cache is only an optimization
+    return(fractions)
+
+def write_alt_fractions(vcf_fn, samples, out_fn):
+    # what the souporcell binary's --known_genotypes reads: a header of sample names, then the alt allele fraction
+    # of each sample for every record (matrix row) of vcf_fn, tab separated, "." where the genotype is missing
+    fractions = genotype_matrix(vcf_fn, samples)
+    with open(out_fn + ".tmp", 'w') as out:
+        out.write("\t".join(samples) + "\n")
+        for row in (1.0 - fractions).tolist():
+            out.write("\t".join(["." if fraction != fraction else "%g" % fraction for fraction in row]) + "\n")
+    os.rename(out_fn + ".tmp", out_fn)
@@ -0,0 +1,59 @@
+import numpy as np
+
+# helpers for the vartrix style ref.mtx/alt.mtx pairs (loci x cells, 1 based, 3 header lines)
+# every reader in souporcell expects both matrices to list the same entries in the same order,
+# so the pair is always loaded and written together
+
+def load_mtx(fn):
+    with open(fn) as mtx:
+        mtx.readline()
+        mtx.readline()
+        (loci, cells) = [int(x) for x in mtx.readline().strip().split()[0:2]]
+        entries = np.loadtxt(mtx, dtype = np.int64, ndmin = 2)
+    if len(entries) == 0:
+        entries = np.zeros((0, 3), dtype = np.int64)
+    return (loci, cells, entries)
+
+def load_pair(ref_fn, alt_fn):
+    # returns (loci, cells, locus, cell, ref, alt) with 0 based locus and cell
+    (loci, cells, ref_entries) = load_mtx(ref_fn)
+    (alt_loci, alt_cells, alt_entries) = load_mtx(alt_fn)
+    assert loci == alt_loci and cells == alt_cells, "ref and alt matrices dont match?"
+    locus = np.concatenate([ref_entries[:, 0], alt_entries[:, 0]]) - 1
+    cell = np.concatenate([ref_entries[:, 1], alt_entries[:, 1]]) - 1
+    ref = np.concatenate([ref_entries[:, 2], np.zeros(len(alt_entries), dtype = np.int64)])
+    alt = np.concatenate([np.zeros(len(ref_entries), dtype = np.int64), alt_entries[:, 2]])
+    return combine([(0, locus, cell, ref, alt)], loci, cells)
+
+def combine(parts, loci, cells):
+    # parts are (locus_offset, locus, cell, ref, alt), counts for the same locus and cell are summed
+    if len(parts) == 0:
+        empty = np.zeros(0, dtype = np.int64)
+        return (loci, cells, empty, empty, empty, empty)
+    locus = np.concatenate([part[1] + part[0] for part in parts]).astype(np.int64)
+    cell = np.concatenate([part[2] for part in parts]).astype(np.int64)
+    assert len(locus) == 0 or (locus.max() < loci and cell.max() < cells), "matrix entries outside of matrix dimensions"
+    keys = locus * cells + cell
+    (keys, inverse) = np.unique(keys, return_inverse = True)
+    ref = np.bincount(inverse, weights = np.concatenate([part[3] for part in parts]), minlength = len(keys))
+    alt = np.bincount(inverse, weights = np.concatenate([part[4] for part in parts]), minlength = len(keys))
+    return (loci, cells, keys // cells, keys % cells, ref.astype(np.int64), alt.astype(np.int64))
+
+def write_pair(ref_fn, alt_fn, loci, cells, locus, cell, ref, alt):
+    for (fn, counts) in [(ref_fn, ref), (alt_fn, alt)]:
+        with open(fn, 'w') as out:
+            out.write("%%MatrixMarket matrix coordinate integer general\n")
+            out.write("% written by souporcell\n")
+            out.write(str(loci) + " " + str(cells) + " " + str(len(locus)) + "\n")
+            np.savetxt(out, np.column_stack([locus + 1, cell + 1, counts]), fmt = "%d")
+
+# compact binary store of the same counts, one npz holding the coordinate arrays
+def save_store(fn, loci, cells, locus, cell, ref, alt):
+    np.savez(fn, shape = np.array([loci, cells], dtype = np.int64), locus = locus.astype(np.uint32),
+        cell = cell.astype(np.uint32), ref = ref.astype(np.uint32), alt = alt.astype(np.uint32))
+
+def load_store(fn):
+    store = np.load(fn)
+    (loci, cells) = [int(x) for x in store["shape"]]
+    return (loci, cells, store["locus"].astype(np.int64), store["cell"].astype(np.int64),
+        store["ref"].astype(np.int64), store["alt"].astype(np.int64))
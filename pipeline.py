@@ -0,0 +1,1104 @@
+import argparse
+import gzip
+import subprocess
+import time
+import os
+import preflight
+import reference
+import executor
+import progress
+import scratch
+import artifacts
+import known_genotypes
+import preview
+
+# the souporcell pipeline as functions. make_parser and options give a run's settings, each stage function takes
+# its inputs and returns its outputs, and run() strings the stages together, resuming from the .done files in
+# out_dir. souporcell_pipeline.py is the command line wrapper around run(). a driver can import this module and
+# call run() for many samples or parameter sets in one interpreter: barcode sets, contig tables and bam checks
+# are kept for the life of the process, and the settings it is given are never changed.
+# heavy modules (pysam, numpy) are imported by the stages that use them,
+# so restarting a finished or nearly finished run does not pay for them up front
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="single cell RNAseq mixed genotype clustering using sparse mixture model clustering with tensorflow.")
+    parser.add_argument("-i", "--bam", required = True, help = "cellranger bam")
+    parser.add_argument("-b", "--barcodes", required = True, help = "barcodes.tsv from cellranger")
+    parser.add_argument("-f", "--fasta", required = True, help = "reference fasta file")
+    parser.add_argument("-t", "--threads", required = True, type = int, help = "max threads to use")
+    parser.add_argument("-o", "--out_dir", required = True, help = "name of directory to place souporcell files")
+    parser.add_argument("-k", "--clusters", required = True, help = "number cluster, or auto with --preview_from to use the k a --preview run suggested")
+    parser.add_argument("-p", "--ploidy", required = False, default = "2", help = "ploidy, must be 1 or 2, default = 2")
+    parser.add_argument("--min_alt", required = False, default = "4", help = "min alt to use locus, default = 10.")
+    parser.add_argument("--min_ref", required = False, default = "4", help = "min ref to use locus, default = 10.")
+    parser.add_argument("--max_loci", required = False, default = "2048", help = "max loci per cell, affects speed, default = 2048.")
+    parser.add_argument("--restarts", required = False, default = 100, type = int, 
+        help = "number of restarts in clustering, when there are > 12 clusters we recommend increasing this to avoid local minima")
+    parser.add_argument("--common_variants", required = False, default = None, 
+        help = "common variant loci or known variant loci vcf, must be vs same reference fasta")
+    parser.add_argument("--known_genotypes", required = False, default = None, 
+        help = "known variants per clone in population vcf mode, .vcf, .vcf.gz or .bcf, index it (tabix or bcftools index) if it is large")
+    parser.add_argument("--known_genotypes_sample_names", required = False, nargs = '+', default = None, 
+        help = "which samples in population vcf from known genotypes option represent the donors in your sample")
+    parser.add_argument("--skip_remap", required = False, default = False, type = bool, 
+        help = "don't remap with minimap2 (not recommended unless in conjunction with --common_variants")
+    parser.add_argument("--allele_counter", required = False, default = "vartrix", choices = ["vartrix", "native"],
+        help = "allele counting backend, vartrix or the in process pysam counter (allele_counter.py), default = vartrix")
+    parser.add_argument("--max_depth", required = False, default = None, type = int,
+        help = "cap the depth freebayes sees at hotspots (highly expressed genes, chrM) near this many reads per position, " +
+        "sampling reads evenly over cell barcodes (depth_cap.py). allele counting still uses every read. default = no cap")
+    parser.add_argument("--overlap", required = False, default = False, action = "store_true",
+        help = "count alleles on each variant shard as soon as freebayes finishes it instead of waiting for all shards")
+    parser.add_argument("--ignore", required = False, default = "False", help = "set to True to ignore data error assertions")
+    parser.add_argument("--assign_from", required = False, default = None,
+        help = "souporcell output directory of an existing run on the same donor pool. Reuses its variants and cluster genotypes and only assigns this run's cells (no clustering)")
+    parser.add_argument("--topup_from", required = False, default = None,
+        help = "souporcell output directory of a previous run on the same library. --bam is then only the top up sequencing, " +
+        "which is remapped and counted on its own and added to the previous run's allele counts. with the default vartrix counter " +
+        "a cell barcode and UMI sequenced in both runs is counted twice, --allele_counter native counts both runs' reads together once")
+    parser.add_argument("--mapping_index", required = False, default = None,
+        help = "prebuilt minimap2 index of the fasta (souporcell_batch.py builds one per batch), used instead of the fasta for remapping")
+    parser.add_argument("--stop_after", required = False, default = None, choices = ["fastqs", "remap", "retag", "variants", "counts", "clustering", "doublets"],
+        help = "stop once this stage is done, a later run in the same out_dir picks up from there")
+    parser.add_argument("--queue_dir", required = False, default = None,
+        help = "run shard jobs through this job queue directory on shared storage instead of on this host, " +
+        "with souporcell_worker.py daemons on each host taking the jobs. out_dir must be on the shared storage too")
+    parser.add_argument("--scratch_dir", required = False, default = None,
+        help = "directory for intermediate files (fastqs, sams, temporary bams and vcfs), ideally fast local disk. " +
+        "only final outputs are copied to out_dir. with --queue_dir it has to be on storage every worker can see")
+    parser.add_argument("--max_scratch", required = False, default = None, type = float,
+        help = "GB of intermediate files to allow at once, jobs that would go over wait for earlier intermediates to be cleaned up. default = no limit")
+    parser.add_argument("--cache_dir", required = False, default = None,
+        help = "artifact cache shared between runs. the remapped bam, variants and allele counts are stored there under a hash of " +
+        "their inputs, tool versions and parameters, and a later run with the same upstream inputs reuses them instead of recomputing. default = no cache")
+    parser.add_argument("--cache_max", required = False, default = 200.0, type = float,
+        help = "GB the artifact cache may hold, least recently used entries are evicted above it. default = 200")
+    parser.add_argument("--plan", required = False, default = False, action = "store_true",
+        help = "only print the shard plan and estimated time, memory and scratch space per stage, then exit without running anything")
+    parser.add_argument("--plan_json", required = False, default = None, help = "with --plan, also write the plan to this json file")
+    parser.add_argument("--cost_model", required = False, default = None,
+        help = "cost model json from planner.py --fit for --plan, default = the built in rough model")
+    parser.add_argument("--preview", required = False, default = False, action = "store_true",
+        help = "count alleles as usual, then only run a quick k sweep of clustering and doublet calling on a subsample of cells and loci " +
+        "(preview.py) and report cluster sizes, doublet rate and log likelihood per k in out_dir/preview. a later run in the same out_dir picks up from the counts")
+    parser.add_argument("--preview_k", required = False, nargs = '+', type = int, default = None,
+        help = "values of k for --preview, default = 2 to twice -k")
+    parser.add_argument("--preview_cells", required = False, default = 2000, type = int, help = "cells in the --preview subsample, default = 2000")
+    parser.add_argument("--preview_loci", required = False, default = 4000, type = int, help = "loci in the --preview subsample, default = 4000")
+    parser.add_argument("--preview_restarts", required = False, default = 8, type = int, help = "clustering restarts per k for --preview, default = 8")
+    parser.add_argument("--preview_from", required = False, default = None,
+        help = "preview directory of an earlier --preview run (out_dir/preview). clustering starts from that preview's singlet assignments " +
+        "and seed for this k, set -k auto to take the k it suggested")
+    return(parser)
+
+def options(**settings):
+    # settings for run() without a command line, the same names and defaults as the command line options, e.g.
+    # options(bam = "possorted_genome_bam.bam", barcodes = "barcodes.tsv", fasta = "genome.fa", threads = 8, out_dir = "out", clusters = 4)
+    parser = make_parser()
+    actions = [action for action in parser._actions if not action.dest == "help"]
+    args = argparse.Namespace(**dict([(action.dest, action.default) for action in actions]))
+    for action in actions:
+        if not action.dest in settings:
+            assert not action.required, "souporcell option " + action.dest + " is required"
+            continue
+        value = settings.pop(action.dest)
+        # the stages expect what the command line would give them, strings unless the option has a type
+        if value == None or isinstance(value, bool):
+            pass
+        elif isinstance(value, (list, tuple)):
+            value = [item if action.type == None else action.type(item) for item in value]
+        elif not(action.type == None):
+            value = action.type(value)
+        elif isinstance(value, (int, float)):
+            value = str(value)
+        setattr(args, action.dest, value)
+    assert len(settings) == 0, "unknown souporcell options " + ", ".join(settings.keys())
+    return(args)
+
+# state loaded once per process and shared by every run in it
+barcode_sets = {}
+contig_tables = {}
+checked_bams = {}
+
+def load_barcodes(barcodes_fn):
+    # (packed barcode table or None, set like of barcodes)
+    key = (os.path.abspath(barcodes_fn), os.path.getmtime(barcodes_fn))
+    if not key in barcode_sets:
+        import barcode_index
+        # parsed once here and saved to the output directory for every worker to memory map
+        bc_table = barcode_index.parse(barcodes_fn)
+        if not(bc_table is None):
+            bc_set = barcode_index.BarcodeIndex(bc_table)
+        else:
+            bc_set = set()
+            with open(barcodes_fn) as barcodes:
+                for (index, line) in enumerate(barcodes):
+                    bc = line.strip()
+                    bc_set.add(bc)
+        barcode_sets[key] = (bc_table, bc_set)
+    return(barcode_sets[key])
+
+def known_sample_names(args):
+    # the donors to cluster against in --known_genotypes mode, all of the vcf's samples unless some are named
+    if args.known_genotypes == None:
+        return(None)
+    return(args.known_genotypes_sample_names or preflight.vcf_samples(args.known_genotypes))
+
+def resolve_clusters(args):
+    # -k auto takes the k a --preview run suggested
+    if not args.clusters == "auto":
+        return(args)
+    assert args.preview_from, "-k auto needs --preview_from"
+    summary = preview.load(args.preview_from)
+    assert not(summary["chosen_k"] == None), "the preview in " + args.preview_from + " did not suggest a k"
+    print("using k = " + str(summary["chosen_k"]) + " from the preview in " + args.preview_from)
+    resolved = argparse.Namespace(**vars(args))
+    resolved.clusters = str(summary["chosen_k"])
+    return(resolved)
+
+def check_inputs(args, bc_set):
+    print("checking inputs")
+    assert len(bc_set) > 50, "Fewer than 50 barcodes in barcodes file? We expect 1 barcode per line."
+
+    assert not(not(args.known_genotypes == None) and not(args.common_variants == None)), "cannot set both know_genotypes and common_variants"
+    if args.assign_from:
+        assert args.known_genotypes == None and args.common_variants == None, "cannot set assign_from with known_genotypes or common_variants, the existing run's variants are used"
+        for fn in ["variants.done", "consensus.done", "cluster_genotypes.vcf", "ambient_rna.txt"]:
+            assert os.path.exists(args.assign_from + "/" + fn), "assign_from directory is missing " + fn + ", did that run finish?"
+    if args.topup_from:
+        assert args.assign_from == None, "cannot set both topup_from and assign_from"
+        for fn in ["variants.done", "vartrix.done", "ref.mtx", "alt.mtx"]:
+            assert os.path.exists(args.topup_from + "/" + fn), "topup_from directory is missing " + fn + ", did that run finish?"
+    if args.preview_from:
+        assert os.path.exists(args.preview_from + "/preview.json"), "preview_from directory has no preview.json, did the --preview run finish?"
+        assert args.known_genotypes == None, "cannot set preview_from with known_genotypes, clustering starts from the known genotypes"
+    if args.preview:
+        assert args.assign_from == None, "cannot set preview with assign_from, there is no clustering to preview"
+    if args.known_genotypes_sample_names:
+        assert not(args.known_genotypes == None), "if you specify known_genotype_sample_names, must specify known_genotypes option"
+        assert len(args.known_genotypes_sample_names) == int(args.clusters), "length of known genotype sample names should be equal to k/clusters"
+    if args.known_genotypes:
+        samples = preflight.vcf_samples(args.known_genotypes)
+        assert len(samples) >= int(args.clusters), "number of samples in known genotype vcfs is less than k/clusters"
+        for sample in known_sample_names(args):
+            assert sample in samples, "not all samples in known genotype sample names option are in the known genotype samples vcf?"
+
+    if not args.ignore == "True":
+        if args.skip_remap and args.common_variants == None and args.known_genotypes == None:
+            assert False, "WARNING: skip_remap enables without common_variants or known genotypes. Variant calls will be of poorer quality. Turn on --ignore True to ignore this warning"
+
+    # the input bam is only read again by the renamer (or by counting with --skip_remap), no need to recheck it once that is done
+    if args.skip_remap:
+        bam_done = os.path.exists(args.out_dir + "/vartrix.done")
+    else:
+        bam_done = os.path.exists(args.out_dir + "/fastqs.done")
+    bam_key = (os.path.abspath(args.bam), os.path.abspath(args.barcodes))
+    if not bam_done and not bam_key in checked_bams:
+        print("checking bam for expected tags")
+        checked_bams[bam_key] = preflight.sample_bam_tags(args.bam, bc_set)
+    if not bam_done:
+        (num_read_test, num_cb, num_cb_cb, num_umi) = checked_bams[bam_key]
+        assert num_read_test > 0, "no reads found in bam"
+        if not args.ignore == "True":
+            assert float(num_cb) / float(num_read_test) > 0.5, "Less than 50% of " + str(num_read_test) + " sampled reads have cell barcode tag (CB), turn on --ignore True to ignore"
+            assert float(num_umi) / float(num_read_test) > 0.5, "Less than 50% of " + str(num_read_test) + " sampled reads have UMI tag (UB), turn on --ignore True to ignore"
+            assert float(num_cb_cb) / float(num_read_test) > 0.05, "Less than 5% of " + str(num_read_test) + " sampled reads have cell barcodes from barcodes file, is this the correct barcode file? turn on --ignore True to ignore"
+
+def load_contigs(args):
+    key = os.path.abspath(args.fasta)
+    if not key in contig_tables:
+        print("checking fasta")
+        contig_tables[key] = reference.contigs(args.fasta)
+    return(contig_tables[key])
+
+def barcode_index_args(args):
+    # workers fall back to parsing the barcodes file themselves if it could not be packed
+    index_fn = args.out_dir + "/barcodes.idx.npy"
+    if os.path.exists(index_fn):
+        return(["--barcode_index", index_fn])
+    return([])
+
+def make_fastqs(args, intermediates):
+    if not os.path.isfile(args.bam + ".bai"):
+        print("no bam index found, creating")
+        subprocess.check_call(['samtools', 'index', args.bam])
+    reference.ensure_index(args.fasta)
+    import pysam
+    bam = pysam.AlignmentFile(args.bam)
+    print("creating chunks")
+    # regions have to be in the bam's own contig names and order, the reference only matters for remapping
+    bam_contigs = [(chrom, bam.get_reference_length(chrom)) for chrom in bam.references]
+    regions = reference.plan_regions(bam_contigs, int(args.threads))
+
+    region_fastqs = [[] for x in range(args.threads)]
+    all_fastqs = []
+    procs = []
+    # one long lived renamer per chunk works through all of the chunk's regions
+    print("generating fastqs with cell barcodes and umis in readname")
+    for (index, region) in enumerate(regions):
+        regions_file = intermediates.path("souporcell_regions_" + str(index) + ".tsv")
+        with open(regions_file, 'w') as out:
+            for (chrom, start, end) in region:
+                out.write(chrom + "\t" + str(start) + "\t" + str(end) + "\n")
+        fq_name = intermediates.path("souporcell_fastq_" + str(index) + ".fq")
+        # over the scratch budget, hold the next chunk back until a running renamer is done with its chunk
+        intermediates.wait_for_room(procs)
+        p = executor.popen(["renamer.py", "--bam", args.bam, "--barcodes", args.barcodes, "--out", fq_name,
+                "--regions", regions_file, "--threads", "1"] + barcode_index_args(args))
+        all_fastqs.append(fq_name)
+        region_fastqs[index].append(fq_name)
+        procs.append(p)
+    for p in procs:
+        p.wait()
+        assert not(p.returncode), "renamer subprocess terminated abnormally with code " + str(p.returncode)
+    for index in range(len(regions)):
+        intermediates.remove(intermediates.path("souporcell_regions_" + str(index) + ".tsv"))
+    with open(args.out_dir + "/fastqs.done", 'w') as done:
+        for fastqs in region_fastqs:
+            done.write("\t".join(fastqs) + "\n")
+    return((region_fastqs, all_fastqs))
+
+def remap(args, intermediates, region_fastqs, all_fastqs):
+    print("remapping with minimap2")
+    intermediates.track(all_fastqs)
+    # run minimap2
+    minimap_tmp_files = []
+    for index in range(args.threads):
+        if index > len(region_fastqs) or len(region_fastqs[index]) == 0:
+            continue
+        output = intermediates.path("souporcell_minimap_tmp_" + str(index) + ".sam")
+        minimap_tmp_files.append(output)
+        if len(region_fastqs[index]) == 1:
+            fastq = region_fastqs[index][0]
+        else:
+            fastq = intermediates.path("tmp.fq")
+            with open(fastq, 'w') as tmpfq:
+                subprocess.check_call(['cat'] + region_fastqs[index], stdout = tmpfq)
+        with open(output, 'w') as samfile:
+            with open(args.out_dir + "/minimap.err",'w') as minierr:
+                minierr.write("mapping\n")
+                #subprocess.check_call(["hisat2", "-p", str(args.threads), "-q", args.out_dir + "/tmp.fq", "-x", 
+                #args.fasta[:-3],
+                #"-S", output], stderr =minierr)
+                cmd = ["minimap2", "-ax", "splice", "-t", str(args.threads), "-G50k", "-k", "21",
+                    "-w", "11", "--sr", "-A2", "-B8", "-O12,32", "-E2,1", "-r200", "-p.5", "-N20", "-f1000,5000",
+                    "-n2", "-m20", "-s40", "-g2000", "-2K50m", "--secondary=no", args.mapping_index or args.fasta, fastq]
+                minierr.write(" ".join(cmd)+"\n")
+                executor.check_call(cmd, threads = args.threads, stdout = samfile, stderr = minierr)
+        # minimap2 was the only reader of this chunk's fastqs
+        intermediates.remove(*region_fastqs[index])
+        if len(region_fastqs[index]) > 1:
+            intermediates.remove(fastq)
+
+    with open(args.out_dir + '/remapping.done', 'w') as done:
+        for fn in minimap_tmp_files:
+            done.write(fn + "\n")
+    return(minimap_tmp_files)
+
+def retag(args, intermediates, minimap_tmp_files):
+    print("repopulating cell barcode and UMI tags and sorting")
+    intermediates.track(minimap_tmp_files)
+    # each chunk is retagged and then sorted on its own, so a chunk's sam is removed as soon as it is
+    # retagged and its unsorted bam as soon as it is sorted, instead of all of them lasting to the merge
+    pending_retags = list(range(len(minimap_tmp_files)))
+    pending_sorts = []
+    retag_files = [intermediates.path("souporcell_retag_tmp_" + str(index) + ".bam") for index in range(len(minimap_tmp_files))]
+    filenames = [intermediates.path("souporcell_retag_sorted_tmp_" + str(index) + ".bam") for index in range(len(minimap_tmp_files))]
+    running = []
+    with open(args.out_dir + "/retag.err", 'w') as retagerr:
+        while len(pending_retags) > 0 or len(pending_sorts) > 0 or len(running) > 0:
+            still_running = []
+            for (p, kind, index) in running:
+                if p.poll() == None:
+                    still_running.append((p, kind, index))
+                    continue
+                assert not(p.returncode), kind + " ended abnormally with code " + str(p.returncode)
+                if kind == "retag":
+                    intermediates.remove(minimap_tmp_files[index])
+                    pending_sorts.append(index)
+                else:
+                    intermediates.remove(retag_files[index])
+            running = still_running
+            # sorting holds a chunk twice over (temp files and output) until it is done, so a sort waits for
+            # room in the scratch budget while other jobs are still freeing some. retagging only shrinks a chunk
+            while len(running) < args.threads and len(pending_sorts) > 0:
+                index = pending_sorts[0]
+                if len(running) > 0 and not intermediates.room(2 * os.path.getsize(retag_files[index])):
+                    break
+                pending_sorts.pop(0)
+                p = executor.popen(["samtools", "sort", retag_files[index], '-o', filenames[index]], stderr = retagerr)
+                running.append((p, "samtools sort", index))
+            while len(running) < args.threads and len(pending_retags) > 0:
+                index = pending_retags.pop(0)
+                p = executor.popen(["retag.py", "--sam", minimap_tmp_files[index], "--out", retag_files[index]])
+                running.append((p, "retag", index))
+            time.sleep(0.5)
+
+    print("merging sorted bams")
+    final_bam = intermediates.path("souporcell_minimap_tagged_sorted.bam")
+    subprocess.check_call(["samtools", "merge", "-f", final_bam] + filenames)
+    intermediates.remove(*filenames)
+    subprocess.check_call(["samtools", "index", final_bam])
+    # the bam is kept in scratch as well while variant calling and counting read it
+    published = intermediates.publish(final_bam, keep = True)
+    intermediates.publish(final_bam + ".bai", keep = True)
+    subprocess.check_call(["touch", args.out_dir + "/retagging.done"])
+    return(published)
+
+def freebayes_overlapped(args, intermediates, bam, contigs):
+    # dataflow version of freebayes followed by allele counting: each variant shard is counted
+    # as soon as freebayes finishes it, while the remaining shards are still being called
+    import mtx
+    shards = []
+    for region in freebayes_regions(args, contigs):
+        for (chrom, start, end) in region:
+            shards.append((chrom, start, end))
+    pending_calls = list(range(len(shards)))
+    pending_counts = []
+    # with --max_depth a shard is capped into its own bam first (depth cap), then called from that bam
+    capped_calls = []
+    shard_records = [None for shard in shards]
+    running = []
+    print("running freebayes with allele counting as shards complete")
+    called = progress.Shards("freebayes", len(shards))
+    counted = progress.Shards("allele counting", len(shards))
+    while len(pending_calls) > 0 or len(capped_calls) > 0 or len(pending_counts) > 0 or len(running) > 0:
+        still_running = []
+        for (p, kind, shard, handles) in running:
+            if p.poll() == None:
+                still_running.append((p, kind, shard, handles))
+                continue
+            for handle in handles:
+                handle.close()
+            assert not(p.returncode), kind + " subprocess terminated abnormally with code " + str(p.returncode)
+            if kind == "freebayes":
+                called.ended(shard)
+            if kind == "allele counting":
+                counted.ended(shard)
+            if kind == "depth cap":
+                capped_calls.append(shard)
+            if kind == "freebayes":
+                if args.max_depth:
+                    capped_bam = intermediates.path("souporcell_capped_" + str(shard) + ".bam")
+                    intermediates.remove(capped_bam, capped_bam + ".bai")
+                vcf_name = intermediates.path("souporcell_" + str(shard) + ".vcf")
+                records = 0
+                with open(vcf_name) as vcf:
+                    for line in vcf:
+                        if not line.startswith("#"):
+                            records += 1
+                shard_records[shard] = records
+                if records > 0:
+                    pending_counts.append(shard)
+                else:
+                    counted.total -= 1
+        running = still_running
+        called.update(len([records for records in shard_records if not(records == None)]))
+        counted.update(len([records for records in shard_records if not(records == None) and records > 0]) -
+            len(pending_counts) - len([job for job in running if job[1] == "allele counting"]))
+        # counting jobs are short and unblock the final merge, so they take free slots first, then calls
+        # on capped shards, whose bams are removed as soon as freebayes is done with them
+        # new shards, whose capped bams and vcfs take scratch space, are held back while over the scratch budget
+        # and running jobs may still free some. counts and calls on capped shards go ahead, the calls free their bams
+        room = len(running) == 0 or intermediates.room()
+        while len(running) < args.threads and (len(pending_counts) > 0 or len(capped_calls) > 0 or (room and len(pending_calls) > 0)):
+            if len(pending_counts) > 0:
+                shard = pending_counts.pop(0)
+                prefix = intermediates.path("souporcell_" + str(shard) + "_")
+                err = open(prefix + "counts.err", 'w')
+                out = open(prefix + "counts.out", 'w')
+                cmd = count_alleles_cmd(args, intermediates.path("souporcell_" + str(shard) + ".vcf"), bam,
+                    prefix + "ref.mtx", prefix + "alt.mtx", 1)
+                running.append((executor.popen(cmd, stdout = out, stderr = err), "allele counting", shard, [out, err]))
+                counted.started(shard, region = region_name(*shards[shard]))
+            elif len(capped_calls) == 0 and args.max_depth:
+                shard = pending_calls.pop(0)
+                (chrom, start, end) = shards[shard]
+                err = open(args.out_dir + "/depth_cap.err", 'a')
+                cmd = depth_cap_cmd(args, bam, chrom, start, end, intermediates.path("souporcell_capped_" + str(shard) + ".bam"))
+                running.append((executor.popen(cmd, stderr = err), "depth cap", shard, [err]))
+            else:
+                shard = capped_calls.pop(0) if len(capped_calls) > 0 else pending_calls.pop(0)
+                (chrom, start, end) = shards[shard]
+                vcf_name = intermediates.path("souporcell_" + str(shard) + ".vcf")
+                out = open(vcf_name, 'w')
+                err = open(vcf_name + ".err", 'w')
+                called_bam = intermediates.path("souporcell_capped_" + str(shard) + ".bam") if args.max_depth else bam
+                cmd = freebayes_cmd(args, called_bam, chrom, start, end)
+                err.write(" ".join(cmd) + "\n")
+                err.flush()
+                running.append((executor.popen(cmd, stdout = out, stderr = err), "freebayes", shard, [out, err]))
+                called.started(shard, region = region_name(chrom, start, end))
+        time.sleep(0.5)
+
+    print("merging vcfs and allele counts")
+    # shards are contiguous and in reference (.fai) order (freebayes_regions), so concatenating them keeps the vcf
+    # sorted the same way the sorted merge of the other mode is, and a shard's loci start right after the loci of
+    # all earlier shards
+    all_vcfs = [intermediates.path("souporcell_" + str(shard) + ".vcf") for shard in range(len(shards))]
+    merged_vcf = intermediates.path("souporcell_merged_sorted_vcf.vcf")
+    with open(merged_vcf, 'w') as vcfout:
+        subprocess.check_call(["bcftools", "concat"] + all_vcfs, stdout = vcfout)
+    for vcf in all_vcfs:
+        intermediates.remove(vcf, vcf + ".err")
+    subprocess.check_call(['bgzip', '-f', merged_vcf])
+    subprocess.check_call(['tabix', '-f', '-p', 'vcf', intermediates.path("souporcell_merged_sorted_vcf.vcf.gz")])
+    final_vcf = intermediates.publish(intermediates.path("souporcell_merged_sorted_vcf.vcf.gz"))
+    intermediates.publish(intermediates.path("souporcell_merged_sorted_vcf.vcf.gz.tbi"))
+
+    with open(args.barcodes) as barcodes:
+        cells = len(barcodes.readlines())
+    parts = []
+    offset = 0
+    for shard in range(len(shards)):
+        if shard_records[shard] > 0:
+            prefix = intermediates.path("souporcell_" + str(shard) + "_")
+            (loci, shard_cells, locus, cell, ref, alt) = mtx.load_pair(prefix + "ref.mtx", prefix + "alt.mtx")
+            assert loci == shard_records[shard], "allele counts for shard " + str(shard) + " do not match its vcf"
+            parts.append((offset, locus, cell, ref, alt))
+            intermediates.remove(prefix + "ref.mtx", prefix + "alt.mtx", prefix + "allele_counts.npz",
+                prefix + "counts.out", prefix + "counts.err")
+        offset += shard_records[shard]
+    ref_mtx = args.out_dir + "/ref.mtx"
+    alt_mtx = args.out_dir + "/alt.mtx"
+    mtx.write_pair(ref_mtx, alt_mtx, *mtx.combine(parts, offset, cells))
+    with open(args.out_dir + "/variants.done", 'w') as done:
+        done.write(final_vcf + "\n")
+    subprocess.check_call(['touch', args.out_dir + "/vartrix.done"])
+    return(final_vcf)
+
+def existing_variants(args):
+    print("using variants from " + args.assign_from)
+    with open(args.assign_from + "/variants.done") as done:
+        final_vcf = done.readline().strip()
+    with open(args.out_dir + "/variants.done", 'w') as done:
+        done.write(final_vcf + "\n")
+    return(final_vcf)
+
+def freebayes_regions(args, contigs):
+    # shards in reference (.fai) order, the order bcftools sort leaves the merged vcf in, skipping the small unplaced contigs.
+    # the overlapped mode relies on it, its shards are concatenated without a sort to keep their loci in matrix row order
+    return(reference.plan_regions(contigs, int(args.threads), min_length = 250000))
+
+def freebayes_cmd(args, bam, chrom = None, start = None, end = None, targets = None):
+    # bam can also be a list of bams to call jointly (souporcell_batch.py --joint_variants, top up runs).
+    # calls one region, or the regions of a targets bed
+    cmd = ["freebayes", "-f", args.fasta, "-iXu", "-C", "2",
+        "-q", "20", "-n", "3", "-E", "1", "-m", "30", 
+        "--min-coverage", str(int(args.min_alt)+int(args.min_ref)), "--pooled-continuous", "--skip-coverage", "100000"]
+    if targets:
+        cmd.extend(["-t", targets])
+    else:
+        cmd.extend(["-r", region_name(chrom, start, end)])
+    cmd.extend(bam if isinstance(bam, list) else [bam])
+    return(cmd)
+
+def region_name(chrom, start, end):
+    return(chrom + ":" + str(start) + "-" + str(end))
+
+def depth_cap_cmd(args, bam, chrom, start, end, capped_bam):
+    return(["depth_cap.py", "-i", bam, "-r", region_name(chrom, start, end), "-o", capped_bam, "-d", str(args.max_depth)])
+
+def freebayes(args, intermediates, bam, contigs):
+    if not(args.common_variants == None) or not(args.known_genotypes == None):
+        if not(args.common_variants == None):
+            print("using common variants")
+            common_variants = args.common_variants
+        if not(args.known_genotypes == None):
+            print("using known genotypes")
+            common_variants = args.known_genotypes
+        depth_bed = intermediates.path("depth.bed")
+        depth_merged = intermediates.path("depth_merged.bed")
+        with open(depth_bed, 'w') as bed:
+            ps = subprocess.Popen(['samtools', 'depth', bam], stdout = subprocess.PIPE)
+            min_cov = int(args.min_ref)+int(args.min_alt)
+            #magic
+            subprocess.check_call(["awk '{ if ($3 >= " + str(min_cov) + " && $3 < 100000) { print $1 \"\t\" $2 \"\t\" $2+1 \"\t\" $3 } }'"], 
+                shell = True, stdin = ps.stdout, stdout = bed)
+        with open(depth_merged, 'w') as bed:
+            subprocess.check_call(["bedtools", "merge", "-i", depth_bed], stdout = bed)
+        intermediates.remove(depth_bed)
+        # only the covered loci of the panel, and only the sample columns souporcell will read, come out of
+        # what can be a large population vcf or bcf
+        samples = known_sample_names(args) if not(args.known_genotypes == None) else None
+        subprocess.check_call(known_genotypes.covered_cmd(common_variants, depth_merged,
+            args.out_dir + "/common_variants_covered.vcf", samples))
+        intermediates.remove(depth_merged)
+        with open(args.out_dir + "/variants.done", 'w') as done:
+            done.write(args.out_dir + "/common_variants_covered.vcf" + "\n")
+        return(args.out_dir + "/common_variants_covered.vcf")
+
+    regions = freebayes_regions(args, contigs)
+
+    region_vcfs = [[] for x in range(args.threads)]
+    all_vcfs = []
+    bed_files = []
+    procs = [None for x in range(args.threads)]
+    # with --max_depth each subregion is capped into its own bam first, which freebayes then reads instead
+    capping = [None for x in range(args.threads)]
+    reading = [None for x in range(args.threads)]
+    # the shard each lane's freebayes is on, for the progress events
+    calling = [None for x in range(args.threads)]
+    any_running = True
+    filehandles = []
+    errhandles = []
+    cap_err = open(args.out_dir + "/depth_cap.err", 'a')
+    # run renamer in parallel manner
+    print("running freebayes")
+    shards = progress.Shards("freebayes", sum([len(region) for region in regions]))
+    while any_running:
+        any_running = False
+        for (index, region) in enumerate(regions):
+            block = False
+            if procs[index]:
+                block = procs[index].poll() == None
+                if block:
+                    any_running = True
+                else:
+                    assert not(procs[index].returncode), "freebayes subprocess terminated abnormally with code " + str(procs[index].returncode)
+                    if not(calling[index] == None):
+                        shards.ended(calling[index])
+                        calling[index] = None
+            if not block and not(reading[index] == None):
+                intermediates.remove(reading[index], reading[index] + ".bai")
+                reading[index] = None
+            if len(region_vcfs[index]) == len(region):
+                block = True
+            # a lane starting a new subregion waits while over the scratch budget and other lanes may still free some,
+            # a lane with its subregion capped goes on to call it, which frees the capped bam
+            if not block and capping[index] == None and any([p and p.poll() == None for p in procs]) and not intermediates.room():
+                any_running = True
+                block = True
+            if not block:
+                sub_index = len(region_vcfs[index])
+                chrom = region[sub_index][0]
+                start = region[sub_index][1]
+                end = region[sub_index][2]
+                if args.max_depth and capping[index] == None:
+                    capping[index] = intermediates.path("souporcell_capped_" + str(index) + "_" + str(sub_index) + ".bam")
+                    procs[index] = executor.popen(depth_cap_cmd(args, bam, chrom, start, end, capping[index]), stderr = cap_err)
+                    any_running = True
+                    continue
+                vcf_name = intermediates.path("souporcell_" + str(index) + "_" + str(sub_index) + ".vcf")
+                filehandle = open(vcf_name, 'w')
+                filehandles.append(filehandle)
+                errhandle = open(vcf_name + ".err", 'w')
+                errhandles.append(errhandle)
+                    
+                cmd = freebayes_cmd(args, capping[index] or bam, chrom, start, end)
+                (reading[index], capping[index]) = (capping[index], None)
+                errhandle.write(" ".join(cmd) + "\n")
+                p = executor.popen(cmd, stdout = filehandle, stderr = errhandle)
+                calling[index] = str(index) + "_" + str(sub_index)
+                shards.started(calling[index], region = region_name(chrom, start, end))
+                all_vcfs.append(vcf_name)
+                procs[index] = p
+                region_vcfs[index].append(vcf_name)
+                any_running = True
+        shards.update(len(all_vcfs) - len([p for p in procs if p and p.poll() == None]))
+        time.sleep(1)
+    for filehandle in filehandles:
+        filehandle.close()
+    for errhandle in errhandles:
+        errhandle.close()
+    cap_err.close()
+    print("merging vcfs")
+    merged_vcf = intermediates.path("souporcell_merged_vcf.vcf")
+    sorted_vcf = intermediates.path("souporcell_merged_sorted_vcf.vcf")
+    with open(merged_vcf, 'w') as vcfout:
+        subprocess.check_call(["bcftools", "concat"] + all_vcfs, stdout = vcfout)
+    for vcf in all_vcfs:
+        intermediates.remove(vcf, vcf + ".err")
+    with open(args.out_dir + "/bcftools.err", 'w') as vcferr:
+        with open(sorted_vcf, 'w') as vcfout:
+            subprocess.check_call(['bcftools', 'sort', merged_vcf], stdout = vcfout, stderr = vcferr)
+    if not args.common_variants == None:
+        vcftmp = intermediates.path("vcftmp")
+        with open(args.out_dir + "/common.err", 'w') as err:
+            with open(vcftmp, 'w') as out:
+                subprocess.check_call(['bedtools', 'intersect', '-wa', 
+                    '-a', merged_vcf, '-b', args.common_variants], stdout = out, stderr = err)
+        subprocess.check_call(['mv', vcftmp, sorted_vcf])
+    intermediates.remove(merged_vcf)
+    subprocess.check_call(['bgzip', '-f', sorted_vcf])
+    subprocess.check_call(['tabix', '-f', '-p', 'vcf', sorted_vcf + ".gz"])
+    final_vcf = intermediates.publish(sorted_vcf + ".gz")
+    intermediates.publish(sorted_vcf + ".gz.tbi")
+    if len(bed_files) > 0:
+        for bed in bed_files:
+            subprocess.check_call(['rm', bed + ".bed"])
+        subprocess.check_call(['rm'] + bed_files)
+        
+    with open(args.out_dir + "/variants.done", 'w') as done:
+        done.write(final_vcf + "\n")
+    return(final_vcf)
+
+
+def vartrix_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, threads):
+    return(["vartrix", "--umi", "--mapq", "30", "-b", final_bam, "-c", args.barcodes, "--scoring-method", "coverage", "--threads", str(threads),
+        "--ref-matrix", ref_mtx, "--out-matrix", alt_mtx, "-v", final_vcf, "--fasta", args.fasta])
+
+def native_counts_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, threads):
+    # final_bam can be a list of bams to count together, each cell barcode and UMI once over all of them
+    store = alt_mtx[:-len("alt.mtx")] + "allele_counts.npz"
+    bams = final_bam if isinstance(final_bam, list) else [final_bam]
+    return(["allele_counter.py", "-b"] + bams + ["-c", args.barcodes, "-v", final_vcf, "--mapq", "30",
+        "-t", str(threads), "-o", store, "--ref_matrix", ref_mtx, "--alt_matrix", alt_mtx] + barcode_index_args(args))
+
+def count_alleles_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, threads):
+    if args.allele_counter == "native":
+        return(native_counts_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, threads))
+    return(vartrix_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, threads))
+
+def vartrix(args, final_vcf, final_bam, prefix = ""):
+    print("running vartrix")
+    ref_mtx = args.out_dir + "/" + prefix + "ref.mtx"
+    alt_mtx = args.out_dir + "/" + prefix + "alt.mtx"
+    with open(args.out_dir + "/" + prefix + "vartrix.err", 'w') as err:
+        with open(args.out_dir + "/" + prefix + "vartrix.out", 'w') as out:
+            executor.check_call(vartrix_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, args.threads), threads = args.threads,
+                stdout = out, stderr = err)
+    subprocess.check_call(['touch', args.out_dir + "/" + prefix + "vartrix.done"])
+    subprocess.check_call(['rm', args.out_dir + "/" + prefix + "vartrix.out", args.out_dir + "/" + prefix + "vartrix.err"])
+    return((ref_mtx, alt_mtx))
+
+def native_counts(args, final_vcf, final_bam, prefix = ""):
+    print("counting alleles")
+    ref_mtx = args.out_dir + "/" + prefix + "ref.mtx"
+    alt_mtx = args.out_dir + "/" + prefix + "alt.mtx"
+    with open(args.out_dir + "/" + prefix + "allele_counter.err", 'w') as err:
+        executor.check_call(native_counts_cmd(args, final_vcf, final_bam, ref_mtx, alt_mtx, args.threads), threads = args.threads,
+            stderr = err)
+    subprocess.check_call(['touch', args.out_dir + "/" + prefix + "vartrix.done"])
+    subprocess.check_call(['rm', args.out_dir + "/" + prefix + "allele_counter.err"])
+    return((ref_mtx, alt_mtx))
+
+def count_alleles(args, final_vcf, final_bam, prefix = ""):
+    if args.allele_counter == "native":
+        return(native_counts(args, final_vcf, final_bam, prefix = prefix))
+    return(vartrix(args, final_vcf, final_bam, prefix = prefix))
+
+def topup_variants(args, bam):
+    # keep every variant of the previous run, in the same order so its allele matrices stay valid,
+    # and only look for new variants where the top up reads bring coverage over the threshold
+    with open(args.topup_from + "/variants.done") as done:
+        previous_vcf = done.readline().strip()
+    previous_bam = args.topup_from + "/souporcell_minimap_tagged_sorted.bam"
+    new_vcf = args.out_dir + "/topup_new_variants.vcf"
+    min_cov = int(args.min_ref) + int(args.min_alt)
+    if os.path.exists(previous_bam):
+        print("finding regions newly covered by top up reads")
+        with open(args.out_dir + "/topup_depth.bed", 'w') as bed:
+            ps = subprocess.Popen(['samtools', 'depth', previous_bam, bam], stdout = subprocess.PIPE)
+            subprocess.check_call(["awk '{ if ($3 < " + str(min_cov) + " && $3 + $4 >= " + str(min_cov) + " && $3 + $4 < 100000) " +
+                "{ print $1 \"\t\" $2 - 1 \"\t\" $2 } }'"], shell = True, stdin = ps.stdout, stdout = bed)
+            ps.wait()
+            assert not(ps.returncode), "samtools depth ended abnormally with code " + str(ps.returncode)
+        with open(args.out_dir + "/topup_covered.bed", 'w') as bed:
+            subprocess.check_call(["bedtools", "merge", "-i", args.out_dir + "/topup_depth.bed"], stdout = bed)
+        subprocess.check_call(["rm", args.out_dir + "/topup_depth.bed"])
+        with open(new_vcf + ".tmp", 'w') as vcfout:
+            if not(args.common_variants == None) or not(args.known_genotypes == None):
+                print("intersecting common variants with newly covered regions")
+                common = args.common_variants if args.common_variants else args.known_genotypes
+                samples = known_sample_names(args) if not(args.known_genotypes == None) else None
+                subprocess.check_call(known_genotypes.covered_cmd(common, args.out_dir + "/topup_covered.bed", "-", samples),
+                    stdout = vcfout)
+            else:
+                print("running freebayes on newly covered regions")
+                with open(new_vcf + ".err", 'w') as err:
+                    subprocess.check_call(freebayes_cmd(args, [previous_bam, bam], targets = args.out_dir + "/topup_covered.bed"),
+                        stdout = vcfout, stderr = err)
+                subprocess.check_call(["rm", new_vcf + ".err"])
+    else:
+        print("no remapped bam in " + args.topup_from + ", reusing its variants without calling new ones")
+        with open(new_vcf + ".tmp", 'w') as vcfout:
+            vcfout.write("##fileformat=VCFv4.2\n")
+
+    previous_keys = set()
+    previous_header = []
+    previous_records = []
+    with (gzip.open(previous_vcf, 'rt') if previous_vcf.endswith(".gz") else open(previous_vcf)) as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                previous_header.append(line)
+            else:
+                previous_records.append(line)
+                toks = line.split("\t", 5)
+                previous_keys.add((toks[0], toks[1], toks[3], toks[4]))
+    new_records = []
+    with open(new_vcf + ".tmp") as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            toks = line.split("\t", 5)
+            if not (toks[0], toks[1], toks[3], toks[4]) in previous_keys:
+                new_records.append(line)
+    subprocess.check_call(["rm", new_vcf + ".tmp"])
+    print(str(len(new_records)) + " new variants in newly covered regions")
+    if len(new_records) > 0:
+        with open(new_vcf, 'w') as vcf:
+            for line in previous_header:
+                vcf.write(line)
+            for line in new_records:
+                vcf.write(line)
+        subprocess.check_call(["bgzip", "-f", new_vcf])
+        subprocess.check_call(["tabix", "-f", "-p", "vcf", new_vcf + ".gz"])
+
+    # previous records first and new records after them, matching the row order of the combined matrices. with new
+    # records this is no longer sorted and so cannot be indexed, it is the matrices' row list that clustering and
+    # consensus read in order. variants_sorted.vcf.gz is a sorted, indexed copy for anything wanting positions
+    final_vcf = args.out_dir + "/" + os.path.basename(previous_vcf)
+    plain_vcf = final_vcf[:-3] if final_vcf.endswith(".gz") else final_vcf
+    with open(plain_vcf, 'w') as vcf:
+        for line in previous_header:
+            vcf.write(line)
+        for line in previous_records:
+            vcf.write(line)
+        for line in new_records:
+            vcf.write(line)
+    sorted_vcf = args.out_dir + "/variants_sorted.vcf.gz"
+    subprocess.check_call(["bcftools", "sort", "-Oz", "-o", sorted_vcf, plain_vcf])
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", sorted_vcf])
+    if final_vcf.endswith(".gz"):
+        subprocess.check_call(["bgzip", "-f", plain_vcf])
+    with open(args.out_dir + "/variants.done", 'w') as done:
+        done.write(final_vcf + "\n")
+    return(final_vcf)
+
+def topup_vartrix(args, final_vcf, bam):
+    import mtx
+    previous_bam = args.topup_from + "/souporcell_minimap_tagged_sorted.bam"
+    if args.allele_counter == "native" and os.path.exists(previous_bam):
+        # one pass over the previous and the top up reads at every variant, so a cell barcode and UMI sequenced
+        # in both runs is counted once instead of once per run
+        print("counting alleles over the previous and top up reads together")
+        return(native_counts(args, final_vcf, [previous_bam, bam]))
+    print("WARNING: adding separately counted top up alleles to the previous counts. a cell barcode and UMI " +
+        "sequenced in both runs is counted in each, use --allele_counter native to count it once")
+    with open(args.topup_from + "/variants.done") as done:
+        previous_vcf = done.readline().strip()
+    new_vcf = args.out_dir + "/topup_new_variants.vcf.gz"
+    (loci, cells, locus, cell, ref, alt) = mtx.load_pair(args.topup_from + "/ref.mtx", args.topup_from + "/alt.mtx")
+    parts = [(0, locus, cell, ref, alt)]
+    if not os.path.exists(args.out_dir + "/topup_vartrix.done"):
+        count_alleles(args, previous_vcf, bam, prefix = "topup_")
+    (topup_loci, topup_cells, locus, cell, ref, alt) = mtx.load_pair(args.out_dir + "/topup_ref.mtx", args.out_dir + "/topup_alt.mtx")
+    assert topup_loci == loci and topup_cells == cells, "top up counts do not match the previous run, was the same barcodes file used?"
+    parts.append((0, locus, cell, ref, alt))
+    new_loci = 0
+    if os.path.exists(new_vcf):
+        # new variants need counts from the previous reads as well as the top up reads
+        if not os.path.exists(args.out_dir + "/topup_new_vartrix.done"):
+            count_alleles(args, new_vcf, bam, prefix = "topup_new_")
+        if not os.path.exists(args.out_dir + "/topup_previous_vartrix.done"):
+            count_alleles(args, new_vcf, previous_bam, prefix = "topup_previous_")
+        for prefix in ["topup_new_", "topup_previous_"]:
+            (new_loci, new_cells, locus, cell, ref, alt) = mtx.load_pair(args.out_dir + "/" + prefix + "ref.mtx",
+                args.out_dir + "/" + prefix + "alt.mtx")
+            assert new_cells == cells, "top up counts do not match the previous run, was the same barcodes file used?"
+            parts.append((loci, locus, cell, ref, alt))
+    print("adding top up allele counts to previous counts")
+    ref_mtx = args.out_dir + "/ref.mtx"
+    alt_mtx = args.out_dir + "/alt.mtx"
+    (total_loci, cells, locus, cell, ref, alt) = mtx.combine(parts, loci + new_loci, cells)
+    mtx.write_pair(ref_mtx, alt_mtx, total_loci, cells, locus, cell, ref, alt)
+    subprocess.check_call(['touch', args.out_dir + "/vartrix.done"])
+    return((ref_mtx, alt_mtx))
+
+def souporcell(args, ref_mtx, alt_mtx, final_vcf):
+    print("running souporcell clustering")
+    cluster_file = args.out_dir + "/clusters_tmp.tsv"
+    with open(cluster_file, 'w') as log:
+        with open(args.out_dir+"/clusters.err",'w') as err:
+            directory = os.path.dirname(os.path.realpath(__file__))
+            #cmd = ["souporcell.py", "-a", alt_mtx, "-r", ref_mtx, "-b", args.barcodes, "-k", args.clusters,"--restarts",str(args.restarts),
+            #    "-t", str(args.threads), "-l", args.max_loci, "--min_alt", args.min_alt, "--min_ref", args.min_ref,'--out',cluster_file]
+            cmd = [directory+"/souporcell/target/release/souporcell", "-k", str(args.clusters), "-a", alt_mtx, "-r", ref_mtx, 
+                "--restarts", str(args.restarts), "-b", args.barcodes, "--min_ref", str(args.min_ref), "--min_alt", str(args.min_alt), 
+                "--threads", str(args.threads)]
+            print(" ".join(cmd))
+            if not(args.known_genotypes == None):
+                # the binary starts its clusters from the decoded genotypes rather than parsing the vcf
+                known_fn = args.out_dir + "/known_genotypes.tsv"
+                known_genotypes.write_alt_fractions(final_vcf, known_sample_names(args), known_fn)
+                cmd.extend(['--known_genotypes', known_fn])
+                cmd.extend(['--known_genotypes_sample_names'] + known_sample_names(args))
+            if args.preview_from:
+                seeded = preview.seeds(preview.load(args.preview_from), args.clusters)
+                if seeded == None:
+                    print("the preview in " + args.preview_from + " did not try k = " + str(args.clusters) + ", clustering from random starts")
+                else:
+                    cmd.extend(["--known_cell_assignments", seeded[0], "--seed", str(seeded[1])])
+            executor.check_call(cmd, threads = args.threads, stdout = log, stderr = err)
+    subprocess.check_call(['touch', args.out_dir + "/clustering.done"])
+    return(cluster_file)
+
+def doublets(args, ref_mtx, alt_mtx, cluster_file):
+    print("running souporcell doublet detection")
+    doublet_file = args.out_dir + "/clusters.tsv"
+    with open(doublet_file, 'w') as dub:
+        executor.check_call(["troublet", "--alts", alt_mtx, "--refs", ref_mtx, "--clusters", cluster_file], stdout = dub)
+    import results
+    results.write_assignments(args.out_dir + "/results", doublet_file)
+    subprocess.check_call(['touch', args.out_dir + "/troublet.done"])
+    return(doublet_file)
+
+def consensus(args, ref_mtx, alt_mtx, doublet_file, final_vcf):
+    print("running co inference of ambient RNA and cluster genotypes")
+    ambient = args.out_dir + "/ambient_rna.txt"
+    genotypes = args.out_dir + "/cluster_genotypes.vcf"
+    executor.check_call(["consensus.py", "-c", doublet_file, "-a", alt_mtx, "-r", ref_mtx, "-p", str(args.ploidy),
+        "--soup_out", ambient, "--vcf_out", genotypes, "--vcf", final_vcf, "--store_dir", args.out_dir + "/results"])
+    subprocess.check_call(['touch', args.out_dir + "/consensus.done"])
+    return((ambient, genotypes))
+
+def assign(args, ref_mtx, alt_mtx, final_vcf):
+    print("assigning cells to the clusters of " + args.assign_from)
+    doublet_file = args.out_dir + "/clusters.tsv"
+    with open(args.out_dir + "/assign.err", 'w') as err:
+        executor.check_call(["assign.py", "-a", alt_mtx, "-r", ref_mtx, "-b", args.barcodes, "-v", final_vcf,
+            "-g", args.assign_from + "/cluster_genotypes.vcf", "--ambient_rna", args.assign_from + "/ambient_rna.txt",
+            "-o", doublet_file], stderr = err)
+    import results
+    results.write_assignments(args.out_dir + "/results", doublet_file)
+    results.write_ambient(args.out_dir + "/results", results.read_ambient(args.assign_from + "/ambient_rna.txt"))
+    subprocess.check_call(['touch', args.out_dir + "/assign.done"])
+    return(doublet_file)
+
+
+def cache_keys(args):
+    # each key is built on the key of the stage whose output it reads, so only the inputs are fingerprinted
+    references = [artifacts.fingerprint(args.fasta), artifacts.fingerprint(args.barcodes)]
+    if args.skip_remap:
+        bam_key = artifacts.fingerprint(args.bam)
+    else:
+        bam_key = artifacts.key("retag", [artifacts.fingerprint(args.bam)] + references,
+            {"minimap2": artifacts.tool_version("minimap2"), "samtools": artifacts.tool_version("samtools"),
+            "renamer": artifacts.script_version("renamer.py"), "retag": artifacts.script_version("retag.py")})
+    known = args.known_genotypes or args.common_variants
+    if known:
+        variants_params = {"known": artifacts.fingerprint(known), "bcftools": artifacts.tool_version("bcftools"),
+            "samples": known_sample_names(args)}
+    else:
+        # freebayes shards follow -t and calls near shard edges can differ between shardings
+        variants_params = {"freebayes": artifacts.tool_version("freebayes"), "threads": int(args.threads),
+            "max_depth": args.max_depth, "depth_cap": artifacts.script_version("depth_cap.py") if args.max_depth else None}
+    variants_params.update({"min_alt": args.min_alt, "min_ref": args.min_ref})
+    variants_key = artifacts.key("variants", [bam_key] + references, variants_params)
+    if args.allele_counter == "native":
+        counter = artifacts.script_version("allele_counter.py")
+    else:
+        counter = artifacts.tool_version("vartrix")
+    counts_key = artifacts.key("counts", [bam_key, variants_key] + references, {"allele_counter": args.allele_counter, "version": counter})
+    return({"retag": bam_key, "variants": variants_key, "counts": counts_key})
+
+def stop_after(args, stage):
+    if args.stop_after == stage:
+        print("stopping after " + stage)
+        return(True)
+    return(False)
+
+def recover_lost_intermediates(args, intermediates):
+    # intermediates are removed as soon as they are used and a scratch dir may have been wiped since the last run,
+    # so go back to the last stage whose outputs are all still there
+    for done_fn in ["remapping.done", "fastqs.done"]:
+        if not os.path.exists(args.out_dir + "/" + done_fn):
+            continue
+        with open(args.out_dir + "/" + done_fn) as done:
+            listed = [fn for line in done for fn in line.strip().split("\t") if len(fn) > 0]
+        if not intermediates.lost(listed):
+            break
+        print("intermediate files of " + done_fn[:-len(".done")] + " are gone, redoing it")
+        os.remove(args.out_dir + "/" + done_fn)
+
+def read_done_lists(done_fn):
+    with open(done_fn) as done:
+        return([line.strip().split("\t") for line in done])
+
+def remapped_bam(args, intermediates, cache, keys):
+    # fastqs, remap and retag, returns the tagged bam or None when stopped part way
+    tagged_bam = args.out_dir + "/souporcell_minimap_tagged_sorted.bam"
+    if not os.path.exists(args.out_dir + "/retagging.done") and cache and cache.fetch(keys["retag"], args.out_dir):
+        subprocess.check_call(["touch", args.out_dir + "/retagging.done"])
+    if not os.path.exists(args.out_dir + "/retagging.done"):
+        artifacts.unshare([tagged_bam, tagged_bam + ".bai"])
+        recover_lost_intermediates(args, intermediates)
+        if not os.path.exists(args.out_dir + "/fastqs.done"):
+            (region_fastqs, all_fastqs) = make_fastqs(args, intermediates)
+        else:
+            region_fastqs = read_done_lists(args.out_dir + "/fastqs.done")
+            all_fastqs = [fq for fastqs in region_fastqs for fq in fastqs]
+        if stop_after(args, "fastqs"):
+            return(None)
+        if not os.path.exists(args.out_dir + "/remapping.done"):
+            minimap_tmp_files = remap(args, intermediates, region_fastqs, all_fastqs)
+        else:
+            minimap_tmp_files = [sams[0] for sams in read_done_lists(args.out_dir + "/remapping.done")]
+        if stop_after(args, "remap"):
+            return(None)
+        retag(args, intermediates, minimap_tmp_files)
+    if cache:
+        cache.store(keys["retag"], "retag", [tagged_bam, tagged_bam + ".bai"])
+    if args.stop_after in ["fastqs", "remap"]:
+        stop_after(args, args.stop_after)
+        return(None)
+    return(intermediates.local(tagged_bam))
+
+def own_variants(args, final_vcf):
+    # the cache keys only fingerprint this run's inputs, so a vcf written by another run (souporcell_batch.py
+    # --joint_variants fills in variants.done) must not be cached under them, nor the counts made from it
+    return(os.path.dirname(os.path.abspath(final_vcf)) == os.path.abspath(args.out_dir))
+
+def call_variants(args, intermediates, cache, keys, bam):
+    # returns the vcf of the loci to count, in the run's own out_dir or the one it takes them from
+    variants_outputs = [args.out_dir + "/" + name for name in
+        ["souporcell_merged_sorted_vcf.vcf.gz", "souporcell_merged_sorted_vcf.vcf.gz.tbi", "common_variants_covered.vcf"]]
+    if not os.path.exists(args.out_dir + "/variants.done"):
+        files = cache.fetch(keys["variants"], args.out_dir) if cache else None
+        if files:
+            with open(args.out_dir + "/variants.done", 'w') as done:
+                done.write(args.out_dir + "/" + files[0] + "\n")
+        else:
+            artifacts.unshare(variants_outputs)
+    overlap = args.overlap and args.common_variants == None and args.known_genotypes == None and \
+        args.assign_from == None and args.topup_from == None
+    if not os.path.exists(args.out_dir + "/variants.done"):
+        # make_fastqs is skipped with --skip_remap or on a resumed run, freebayes and vartrix want the .fai regardless
+        reference.ensure_index(args.fasta)
+    if overlap and not os.path.exists(args.out_dir + "/variants.done"):
+        final_vcf = freebayes_overlapped(args, intermediates, bam, load_contigs(args))
+    elif not os.path.exists(args.out_dir + "/variants.done"):
+        if args.assign_from:
+            final_vcf = existing_variants(args)
+        elif args.topup_from:
+            final_vcf = topup_variants(args, bam)
+        elif not(args.common_variants == None) or not(args.known_genotypes == None):
+            final_vcf = freebayes(args, intermediates, bam, None)
+        else:
+            final_vcf = freebayes(args, intermediates, bam, load_contigs(args))
+    else:
+        with open(args.out_dir + "/variants.done") as done:
+            final_vcf = done.readline().strip()
+    if cache and own_variants(args, final_vcf):
+        cache.store(keys["variants"], "variants", [fn for fn in [final_vcf, final_vcf + ".tbi"] if os.path.exists(fn)])
+    return(final_vcf)
+
+def allele_counts(args, cache, keys, final_vcf, bam):
+    ref_mtx = args.out_dir + "/ref.mtx"
+    alt_mtx = args.out_dir + "/alt.mtx"
+    counts_outputs = [ref_mtx, alt_mtx, args.out_dir + "/allele_counts.npz"]
+    if cache and not own_variants(args, final_vcf):
+        cache = None
+    if not os.path.exists(args.out_dir + "/vartrix.done") and cache and cache.fetch(keys["counts"], args.out_dir):
+        subprocess.check_call(['touch', args.out_dir + "/vartrix.done"])
+    if not os.path.exists(args.out_dir + "/vartrix.done"):
+        artifacts.unshare(counts_outputs)
+        reference.ensure_index(args.fasta)
+        if args.topup_from:
+            topup_vartrix(args, final_vcf, bam)
+        else:
+            count_alleles(args, final_vcf, bam)
+    if cache:
+        cache.store(keys["counts"], "counts", [fn for fn in counts_outputs if os.path.exists(fn)])
+    return((ref_mtx, alt_mtx))
+
+def run(args):
+    # runs, or resumes, one souporcell run and returns the outputs it has got to:
+    # bam, vcf, ref_mtx, alt_mtx, clusters, results, ambient_rna, cluster_genotypes (or plan with --plan, preview with --preview)
+    args = resolve_clusters(args)
+    (bc_table, bc_set) = load_barcodes(args.barcodes)
+    check_inputs(args, bc_set)
+    if args.queue_dir:
+        executor.create_queue(args.queue_dir)
+        os.environ[executor.env_var] = os.path.abspath(args.queue_dir)
+    if args.plan:
+        import json
+        import planner
+        run_plan = planner.plan(args, len(bc_set), planner.load_model(args.cost_model))
+        print(planner.describe(run_plan))
+        if args.plan_json:
+            with open(args.plan_json, 'w') as out:
+                json.dump(run_plan, out, indent = 1)
+        return({"plan": run_plan})
+
+    if os.path.isdir(args.out_dir):
+        print("restarting pipeline in existing directory " + args.out_dir)
+    else:
+        subprocess.check_call(["mkdir", args.out_dir])
+    os.environ[progress.env_var] = os.path.abspath(args.out_dir + "/progress.ndjson")
+    intermediates = scratch.Scratch(args.out_dir, scratch_dir = args.scratch_dir,
+        max_bytes = None if args.max_scratch == None else int(args.max_scratch * 1e9))
+    # rebuilt whenever the barcodes file differs from the one the saved index was built from
+    import barcode_index
+    index_fn = args.out_dir + "/barcodes.idx.npy"
+    if bc_table is None:
+        for fn in [index_fn, index_fn + ".md5"]:
+            if os.path.exists(fn):
+                os.remove(fn)
+    elif not barcode_index.current(index_fn, args.barcodes):
+        barcode_index.save(bc_table, index_fn, args.barcodes)
+    cache = None
+    keys = None
+    if args.cache_dir and args.assign_from == None and args.topup_from == None:
+        cache = artifacts.ArtifactCache(args.cache_dir, int(args.cache_max * 1e9))
+        keys = cache_keys(args)
+
+    outputs = {}
+    if not args.skip_remap:
+        bam = remapped_bam(args, intermediates, cache, keys)
+        if bam == None or stop_after(args, "retag"):
+            return(outputs)
+    else:
+        bam = args.bam
+    outputs["bam"] = bam
+    outputs["vcf"] = final_vcf = call_variants(args, intermediates, cache, keys, bam)
+    if stop_after(args, "variants"):
+        return(outputs)
+    (ref_mtx, alt_mtx) = allele_counts(args, cache, keys, final_vcf, bam)
+    outputs["ref_mtx"] = ref_mtx
+    outputs["alt_mtx"] = alt_mtx
+    if not(bam == args.bam) and not(bam == args.out_dir + "/souporcell_minimap_tagged_sorted.bam"):
+        # counting was the last reader of the scratch copy
+        intermediates.remove(bam, bam + ".bai")
+        outputs["bam"] = args.out_dir + "/souporcell_minimap_tagged_sorted.bam"
+    if stop_after(args, "counts"):
+        return(outputs)
+    if args.preview:
+        ks = args.preview_k or range(2, max(2 * int(args.clusters), 3) + 1)
+        outputs["preview"] = preview.sweep(ref_mtx, alt_mtx, args.barcodes, args.out_dir + "/preview", ks, args.threads,
+            args.preview_restarts, args.preview_cells, args.preview_loci, int(args.min_ref), int(args.min_alt))
+        return(outputs)
+    if args.assign_from:
+        outputs["clusters"] = args.out_dir + "/clusters.tsv"
+        if not(os.path.exists(args.out_dir + "/assign.done")):
+            assign(args, ref_mtx, alt_mtx, final_vcf)
+        outputs["results"] = args.out_dir + "/results"
+        intermediates.clean()
+        print("done")
+        return(outputs)
+    cluster_file = args.out_dir + "/clusters_tmp.tsv"
+    if not(os.path.exists(args.out_dir + "/clustering.done")):
+        souporcell(args, ref_mtx, alt_mtx, final_vcf)
+    if stop_after(args, "clustering"):
+        return(outputs)
+    outputs["clusters"] = doublet_file = args.out_dir + "/clusters.tsv"
+    if not(os.path.exists(args.out_dir + "/troublet.done")):
+        doublets(args, ref_mtx, alt_mtx, cluster_file)
+    import results
+    if not results.has_assignments(args.out_dir + "/results"):
+        # finished before the results store was written
+        results.write_assignments(args.out_dir + "/results", doublet_file)
+    outputs["results"] = args.out_dir + "/results"
+    if stop_after(args, "doublets"):
+        return(outputs)
+    outputs["ambient_rna"] = args.out_dir + "/ambient_rna.txt"
+    outputs["cluster_genotypes"] = args.out_dir + "/cluster_genotypes.vcf"
+    if not(os.path.exists(args.out_dir + "/consensus.done")):
+        consensus(args, ref_mtx, alt_mtx, doublet_file, final_vcf)
+    elif not "ambient_rna" in results.load_meta(args.out_dir + "/results"):
+        results.write_ambient(args.out_dir + "/results", results.read_ambient(outputs["ambient_rna"]))
+    intermediates.clean()
+    print("done")
+    return(outputs)
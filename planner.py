@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import json
+import os
+
+import reference
+
+# resource estimates for a souporcell_pipeline.py run before it is started (--plan), and the fit of the cost model
+# behind them to measured runs (planner.py --fit on benchmark/run_benchmark.py results).
+# every stage's time, peak memory and peak intermediate disk is modelled as intercept + slope * x, with x a
+# stage specific amount of work worked out from the run's inputs:
+#   reads       mapped reads in the bam index
+#   cells       barcodes
+#   reference   reference length in bases
+#   clusters, restarts, threads, max_loci as given to the pipeline
+
+stages = ["fastqs", "remap", "retag", "variants", "counts", "clustering", "doublets", "consensus"]
+
+def work(stage, inputs):
+    # (x for seconds, x for peak rss, x for peak intermediate disk) of one stage
+    reads = float(inputs["reads"])
+    cells = float(inputs["cells"])
+    threads = float(inputs["threads"])
+    loci = float(inputs["max_loci"])
+    clusters = float(inputs["clusters"])
+    if stage == "fastqs":
+        return((reads / threads, threads, reads))
+    if stage == "remap":
+        # minimap2 runs on one chunk at a time with every thread and loads the index each time
+        return((reads / threads, inputs["reference"], reads))
+    if stage == "retag":
+        return((reads / threads, threads, reads))
+    if stage == "variants":
+        return((reads / threads, threads, reads))
+    if stage == "counts":
+        return((reads / threads, cells, 0.0))
+    if stage == "clustering":
+        return((inputs["restarts"] * cells * loci * clusters / threads, cells * loci, 0.0))
+    if stage == "doublets":
+        return((cells * loci * clusters * clusters, cells * loci, 0.0))
+    return((cells * clusters, cells * loci, 0.0))
+
+# [intercept, slope] for seconds, peak rss in MB and peak intermediate disk in MB, rough figures from
+# runs on 8 threads. planner.py --fit replaces them with a fit to the machines they will run on
+default_model = {
+    "fastqs": {"seconds": [30.0, 7e-6], "rss_mb": [100.0, 150.0], "disk_mb": [0.0, 3e-4]},
+    "remap": {"seconds": [120.0, 3e-5], "rss_mb": [500.0, 7.7e-6], "disk_mb": [0.0, 5e-4]},
+    "retag": {"seconds": [30.0, 1e-5], "rss_mb": [100.0, 800.0], "disk_mb": [0.0, 5e-4]},
+    "variants": {"seconds": [60.0, 5e-5], "rss_mb": [200.0, 500.0], "disk_mb": [0.0, 2e-5]},
+    "counts": {"seconds": [60.0, 2e-5], "rss_mb": [1000.0, 0.05], "disk_mb": [0.0, 0.0]},
+    "clustering": {"seconds": [10.0, 5e-7], "rss_mb": [100.0, 4e-5], "disk_mb": [0.0, 0.0]},
+    "doublets": {"seconds": [5.0, 3e-8], "rss_mb": [100.0, 4e-5], "disk_mb": [0.0, 0.0]},
+    "consensus": {"seconds": [60.0, 3e-3], "rss_mb": [300.0, 1e-4], "disk_mb": [0.0, 0.0]},
+}
+measures = ["seconds", "rss_mb", "disk_mb"]
+
+def load_model(fn = None):
+    model = json.loads(json.dumps(default_model))
+    if fn:
+        with open(fn) as model_file:
+            fitted = json.load(model_file)
+        for stage in fitted:
+            model.setdefault(stage, {}).update(fitted[stage])
+    return(model)
+
+def bam_reads(bam_fn):
+    # mapped reads per contig from the bam index, without reading the bam itself
+    import pysam
+    bam = pysam.AlignmentFile(bam_fn)
+    lengths = dict([(chrom, bam.get_reference_length(chrom)) for chrom in bam.references])
+    if bam.has_index():
+        counts = dict([(stat.contig, stat.mapped) for stat in bam.get_index_statistics()])
+    else:
+        # about 60 bytes a read in a compressed 10x bam, spread over the contigs by length
+        total = os.path.getsize(bam_fn) / 60.0
+        length = float(sum(lengths.values()))
+        counts = dict([(chrom, int(total * lengths[chrom] / length)) for chrom in lengths])
+    return([(chrom, lengths[chrom], counts.get(chrom, 0)) for chrom in bam.references])
+
+def region_reads(regions, contig_reads):
+    # reads in each chunk of regions, assuming reads are spread evenly along each contig
+    per_contig = dict([(chrom, (length, reads)) for (chrom, length, reads) in contig_reads])
+    chunks = []
+    for region in regions:
+        reads = 0.0
+        bases = 0
+        for (chrom, start, end) in region:
+            (length, contig_total) = per_contig.get(chrom, (1, 0))
+            reads += contig_total * (end - start + 1) / float(max(length, 1))
+            bases += end - start + 1
+        chunks.append({"regions": len(region), "bases": bases, "reads": int(reads)})
+    return(chunks)
+
+def plan(args, cells, model = None):
+    model = model or load_model()
+    contig_reads = bam_reads(args.bam)
+    contigs = reference.contigs(args.fasta)
+    inputs = {"reads": sum([reads for (chrom, length, reads) in contig_reads]), "cells": cells,
+        "reference": sum([length for (name, length) in contigs]), "clusters": int(args.clusters),
+        "restarts": int(args.restarts), "threads": int(args.threads), "max_loci": int(args.max_loci)}
+    # the same shard plans make_fastqs and freebayes work from
+    renamer_chunks = reference.plan_regions([(chrom, length) for (chrom, length, reads) in contig_reads], inputs["threads"])
+    freebayes_chunks = reference.plan_regions(contigs, inputs["threads"], min_length = 250000)
+    shards = {"fastqs": region_reads(renamer_chunks, contig_reads), "variants": region_reads(freebayes_chunks, contig_reads)}
+    run_stages = list(stages)
+    if args.skip_remap:
+        run_stages = [stage for stage in run_stages if not stage in ["fastqs", "remap", "retag"]]
+    estimates = []
+    for stage in run_stages:
+        x = work(stage, inputs)
+        estimate = {"stage": stage}
+        for (measure, value) in zip(measures, x):
+            (intercept, slope) = model[stage][measure]
+            estimate[measure] = round(intercept + slope * value, 1)
+        # a stage takes as long as its slowest chunk, not the average one
+        if stage in shards and len(shards[stage]) > 0:
+            most = max([chunk["reads"] for chunk in shards[stage]])
+            mean = sum([chunk["reads"] for chunk in shards[stage]]) / float(len(shards[stage]))
+            if mean > 0:
+                (intercept, slope) = model[stage]["seconds"]
+                estimate["seconds"] = round(intercept + slope * x[0] * most / mean, 1)
+        estimates.append(estimate)
+    return({"inputs": inputs, "shards": shards, "stages": estimates,
+        "total_seconds": round(sum([estimate["seconds"] for estimate in estimates]), 1),
+        "peak_rss_mb": max([estimate["rss_mb"] for estimate in estimates]),
+        "peak_disk_mb": max([estimate["disk_mb"] for estimate in estimates])})
+
+def describe(run_plan):
+    inputs = run_plan["inputs"]
+    lines = ["inputs: " + ", ".join([name + " " + str(value) for (name, value) in inputs.items()])]
+    for (stage, chunks) in run_plan["shards"].items():
+        reads = [chunk["reads"] for chunk in chunks]
+        mean = sum(reads) / float(max(len(reads), 1))
+        lines.append(stage + " shards: " + str(len(chunks)) + " chunks of " +
+            str(sum([chunk["regions"] for chunk in chunks])) + " regions, largest chunk " + str(max(reads + [0])) +
+            " reads (" + str(round(max(reads + [0]) / max(mean, 1.0), 2)) + "x the mean)")
+    lines.append("stage\tminutes\tpeak_rss_gb\tscratch_gb")
+    for estimate in run_plan["stages"]:
+        lines.append("\t".join([estimate["stage"], str(round(estimate["seconds"] / 60.0, 1)),
+            str(round(estimate["rss_mb"] / 1024.0, 2)), str(round(estimate["disk_mb"] / 1024.0, 2))]))
+    lines.append("\t".join(["total", str(round(run_plan["total_seconds"] / 60.0, 1)),
+        str(round(run_plan["peak_rss_mb"] / 1024.0, 2)), str(round(run_plan["peak_disk_mb"] / 1024.0, 2))]))
+    return("\n".join(lines))
+
+def fit(results, model = None):
+    # least squares intercept and slope per stage and measure over benchmark results that recorded their plan
+    # inputs. with a single run, or runs that all did the same amount of work, only the slope is refitted
+    import numpy as np
+    model = model or load_model()
+    for stage in stages:
+        for (index, measure) in enumerate(measures):
+            key = {"seconds": "seconds", "rss_mb": "peak_rss_mb", "disk_mb": "peak_disk_mb"}[measure]
+            points = []
+            for result in results:
+                for timing in result["stages"]:
+                    if timing["stage"] == stage and key in timing:
+                        points.append((work(stage, result["plan"]["inputs"])[index], timing[key]))
+            if len(points) == 0:
+                continue
+            x = np.array([point[0] for point in points], dtype = float)
+            y = np.array([point[1] for point in points], dtype = float)
+            (intercept, slope) = model[stage][measure]
+            if x.max() == 0:
+                model[stage][measure] = [round(float(y.mean()), 3), slope]
+                continue
+            if len(set(x.tolist())) > 1:
+                (slope, intercept) = np.linalg.lstsq(np.vstack([x, np.ones(len(x))]).T, y, rcond = None)[0]
+            if intercept < 0 or len(set(x.tolist())) == 1:
+                intercept = max(min(intercept, float(y.min())), 0.0)
+                slope = float(((y - intercept) * x).sum() / max((x * x).sum(), 1e-12))
+            model[stage][measure] = [round(float(intercept), 3), float("%.4g" % max(slope, 0.0))]
+    return(model)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="fit the souporcell_pipeline.py --plan cost model to benchmark/run_benchmark.py results from your own machines")
+    parser.add_argument("--fit", required = True, nargs = '+', help = "benchmark.json files")
+    parser.add_argument("-m", "--model", required = False, default = None, help = "cost model to start from, default = the built in one")
+    parser.add_argument("-o", "--out", required = True, help = "fitted cost model json, give it to souporcell_pipeline.py --cost_model")
+    args = parser.parse_args()
+    results = []
+    for fn in args.fit:
+        with open(fn) as result_file:
+            result = json.load(result_file)
+        assert "plan" in result, fn + " has no plan inputs, rerun it with the current benchmark/run_benchmark.py"
+        results.append(result)
+    model = fit(results, load_model(args.model))
+    with open(args.out, 'w') as out:
+        json.dump(model, out, indent = 1)
+    print("cost model written to " + args.out)
@@ -0,0 +1,54 @@
+import gzip
+import subprocess
+
+# quick input checks for souporcell_pipeline.py, kept free of heavy imports so a resumed run gets
+# to its first unfinished stage in about a second
+
+def vcf_samples(fn):
+    # sample names from the #CHROM header line, without reading any records
+    if fn.endswith(".bcf"):
+        output = subprocess.check_output(["bcftools", "query", "-l", fn], universal_newlines = True)
+        return output.split()
+    with (gzip.open(fn, 'rt') if fn.endswith(".gz") else open(fn)) as vcf:
+        for line in vcf:
+            if line.startswith("#CHROM"):
+                return line.strip().split("\t")[9:]
+            if not line.startswith("#"):
+                break
+    return []
+
+def sample_bam_tags(bam_fn, barcodes, num_reads = 20000, max_contigs = 16, windows = 4):
+    # count reads with CB, CB in barcodes and UB over a sample spread across the busiest contigs
+    # using the bam index, falling back to the start of the bam if it is not indexed
+    import pysam
+    bam = pysam.AlignmentFile(bam_fn)
+    starts = []
+    if bam.has_index():
+        contigs = [stat for stat in bam.get_index_statistics() if stat.mapped > 0]
+        contigs = sorted(contigs, key = lambda stat: stat.mapped, reverse = True)[:max_contigs]
+        for stat in contigs:
+            length = bam.get_reference_length(stat.contig)
+            for window in range(windows):
+                starts.append((stat.contig, length * (2 * window + 1) // (2 * windows)))
+    reads_per_start = num_reads // max(len(starts), 1)
+    num_sampled = 0
+    num_cb = 0
+    num_cb_cb = 0 # num reads with barcodes from barcodes.tsv file
+    num_umi = 0
+    def count(reads, limit):
+        nonlocal num_sampled, num_cb, num_cb_cb, num_umi
+        for (index, read) in enumerate(reads):
+            if index >= limit:
+                break
+            num_sampled += 1
+            if read.has_tag("CB"):
+                num_cb += 1
+                if read.get_tag("CB") in barcodes:
+                    num_cb_cb += 1
+            if read.has_tag("UB"):
+                num_umi += 1
+    for (contig, start) in starts:
+        count(bam.fetch(contig, start), reads_per_start)
+    if num_sampled == 0:
+        count(bam.fetch(until_eof = True), num_reads)
+    return (num_sampled, num_cb, num_cb_cb, num_umi)
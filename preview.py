@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import gzip
+import json
+import os
+import re
+import time
+
+import executor
+
+# a quick look at a library before the full clustering run (souporcell_pipeline.py --preview). clustering and
+# troublet are run for a range of k on a subsample of the cells, stratified by how many alleles each cell has,
+# and the loci covered by the most of those cells, with few restarts. the sweep reports cluster sizes, the
+# doublet rate and the log likelihood for each k, and suggests a k. the singlet assignments of each k are kept
+# so a full run with --preview_from starts its clustering from them (souporcell --known_cell_assignments)
+
+strata = 10
+# a k whose log likelihood gain over the k before it is below this fraction of the largest gain adds little
+elbow_fraction = 0.1
+# nor does one whose smallest cluster holds less than this fraction of the singlets
+min_cluster_fraction = 0.01
+
+def read_barcodes(fn):
+    with (gzip.open(fn, 'rt') if fn.endswith(".gz") else open(fn)) as barcodes:
+        return([line.strip() for line in barcodes if line.strip()])
+
+def subsample(ref_mtx, alt_mtx, barcodes, out_dir, max_cells, max_loci, min_ref = 4, min_alt = 4, seed = 4):
+    # writes ref.mtx, alt.mtx and barcodes.tsv for the subsample to out_dir, returns (cells, loci) kept
+    import numpy as np
+    import mtx
+    (loci, cells, locus, cell, ref, alt) = mtx.load_pair(ref_mtx, alt_mtx)
+    cell_barcodes = read_barcodes(barcodes)
+    assert len(cell_barcodes) == cells, "barcodes file does not match the matrices"
+    rng = np.random.RandomState(seed)
+    # the same share of cells from each coverage stratum, so low and high coverage cells are both represented
+    alleles = np.bincount(cell, weights = ref + alt, minlength = cells)
+    order = np.argsort(alleles, kind = "stable")
+    keep_cells = []
+    for stratum in np.array_split(order, strata):
+        take = int(round(len(stratum) * min(1.0, max_cells / float(max(cells, 1)))))
+        keep_cells.extend(rng.choice(stratum, size = take, replace = False).tolist())
+    keep_cells = np.array(sorted(keep_cells), dtype = np.int64)
+    cell_map = np.full(cells, -1, dtype = np.int64)
+    cell_map[keep_cells] = np.arange(len(keep_cells))
+    in_cells = cell_map[cell] >= 0
+    (locus, cell, ref, alt) = (locus[in_cells], cell_map[cell[in_cells]], ref[in_cells], alt[in_cells])
+    # loci that clustering would use on the subsample, the ones covered by the most cells first
+    ref_cells = np.bincount(locus[ref > 0], minlength = loci)
+    alt_cells = np.bincount(locus[alt > 0], minlength = loci)
+    covering = np.bincount(locus, minlength = loci)
+    usable = np.nonzero((ref_cells >= min_ref) & (alt_cells >= min_alt))[0]
+    keep_loci = np.sort(usable[np.argsort(-covering[usable], kind = "stable")][:max_loci])
+    locus_map = np.full(loci, -1, dtype = np.int64)
+    locus_map[keep_loci] = np.arange(len(keep_loci))
+    in_loci = locus_map[locus] >= 0
+    os.makedirs(out_dir, exist_ok = True)
+    mtx.write_pair(out_dir + "/ref.mtx", out_dir + "/alt.mtx", len(keep_loci), len(keep_cells),
+        locus_map[locus[in_loci]], cell[in_loci], ref[in_loci], alt[in_loci])
+    with open(out_dir + "/barcodes.tsv", 'w') as out:
+        for index in keep_cells:
+            out.write(cell_barcodes[index] + "\n")
+    return((len(keep_cells), len(keep_loci)))
+
+def log_likelihood(err_fn):
+    # the souporcell binary ends its stderr with the best restart's total log probability
+    best = None
+    with open(err_fn) as err:
+        for line in err:
+            found = re.match(r"best total log probability = (\S+)", line)
+            if found:
+                best = float(found.group(1))
+    return(best)
+
+def summarize(doublet_fn, k):
+    sizes = [0] * k
+    statuses = {"singlet": 0, "doublet": 0, "unassigned": 0}
+    with open(doublet_fn) as clusters:
+        clusters.readline()
+        for line in clusters:
+            toks = line.rstrip("\n").split("\t")
+            statuses[toks[1]] = statuses.get(toks[1], 0) + 1
+            if toks[1] == "singlet":
+                sizes[int(toks[2])] += 1
+    total = float(max(sum(statuses.values()), 1))
+    return({"cluster_sizes": sizes, "doublet_rate": round(statuses["doublet"] / total, 4),
+        "unassigned_rate": round(statuses["unassigned"] / total, 4)})
+
+def write_seeds(doublet_fn, seeds_fn):
+    # singlet barcode and cluster, what souporcell --known_cell_assignments reads
+    with open(doublet_fn) as clusters:
+        with open(seeds_fn, 'w') as out:
+            clusters.readline()
+            for line in clusters:
+                toks = line.rstrip("\n").split("\t")
+                if toks[1] == "singlet":
+                    out.write(toks[0] + "\t" + toks[2] + "\n")
+
+def choose(sweep):
+    # the elbow of the log likelihood curve, stepping down from it past any k with a cluster too small to be a donor
+    scored = [entry for entry in sweep if not(entry["log_likelihood"] == None)]
+    if len(scored) == 0:
+        return(None)
+    gains = [entry["gain"] for entry in scored[1:] if not(entry["gain"] == None)]
+    largest = max(gains + [0.0])
+    chosen = len(scored) - 1
+    for index in range(len(scored) - 1):
+        if scored[index + 1]["gain"] == None or scored[index + 1]["gain"] < elbow_fraction * largest:
+            chosen = index
+            break
+    while chosen > 0:
+        sizes = scored[chosen]["cluster_sizes"]
+        if min(sizes) >= min_cluster_fraction * max(sum(sizes), 1):
+            break
+        chosen -= 1
+    return(scored[chosen]["k"])
+
+def sweep(ref_mtx, alt_mtx, barcodes, out_dir, ks, threads, restarts = 8, max_cells = 2000, max_loci = 4000,
+        min_ref = 4, min_alt = 4, seed = 4):
+    directory = os.path.dirname(os.path.realpath(__file__))
+    start = time.time()
+    (cells, loci) = subsample(ref_mtx, alt_mtx, barcodes, out_dir, max_cells, max_loci, min_ref, min_alt, seed)
+    print("preview on " + str(cells) + " cells and " + str(loci) + " loci")
+    results = []
+    for k in sorted(set([int(k) for k in ks])):
+        k_start = time.time()
+        prefix = out_dir + "/k" + str(k)
+        with open(prefix + "_clusters_tmp.tsv", 'w') as log:
+            with open(prefix + "_clusters.err", 'w') as err:
+                executor.check_call([directory + "/souporcell/target/release/souporcell", "-k", str(k),
+                    "-a", out_dir + "/alt.mtx", "-r", out_dir + "/ref.mtx", "-b", out_dir + "/barcodes.tsv",
+                    "--restarts", str(restarts), "--min_ref", str(min_ref), "--min_alt", str(min_alt),
+                    "--threads", str(threads), "--seed", str(seed)], threads = threads, stdout = log, stderr = err)
+        with open(prefix + "_clusters.tsv", 'w') as dub:
+            executor.check_call(["troublet", "--alts", out_dir + "/alt.mtx", "--refs", out_dir + "/ref.mtx",
+                "--clusters", prefix + "_clusters_tmp.tsv"], stdout = dub)
+        write_seeds(prefix + "_clusters.tsv", prefix + "_seeds.tsv")
+        entry = {"k": k, "log_likelihood": log_likelihood(prefix + "_clusters.err"), "seconds": round(time.time() - k_start, 1),
+            "seeds": os.path.abspath(prefix + "_seeds.tsv")}
+        entry.update(summarize(prefix + "_clusters.tsv", k))
+        previous = results[-1]["log_likelihood"] if len(results) > 0 else None
+        entry["gain"] = None if previous == None or entry["log_likelihood"] == None else entry["log_likelihood"] - previous
+        results.append(entry)
+        print("k " + str(k) + ": log likelihood " + str(entry["log_likelihood"]) + ", doublet rate " +
+            str(entry["doublet_rate"]) + ", cluster sizes " + ",".join([str(size) for size in entry["cluster_sizes"]]))
+    summary = {"cells": cells, "loci": loci, "restarts": restarts, "seed": seed, "sweep": results,
+        "chosen_k": choose(results), "seconds": round(time.time() - start, 1)}
+    with open(out_dir + "/preview.json", 'w') as out:
+        json.dump(summary, out, indent = 1)
+    with open(out_dir + "/preview.tsv", 'w') as out:
+        out.write("k\tlog_likelihood\tgain\tdoublet_rate\tunassigned_rate\tcluster_sizes\n")
+        for entry in results:
+            out.write("\t".join([str(entry["k"]), str(entry["log_likelihood"]), str(entry["gain"]), str(entry["doublet_rate"]),
+                str(entry["unassigned_rate"]), ",".join([str(size) for size in entry["cluster_sizes"]])]) + "\n")
+    print("suggested k " + str(summary["chosen_k"]) + ", rerun with -k auto --preview_from " + out_dir + " to use it")
+    return(summary)
+
+def load(preview_dir):
+    with open(os.path.join(preview_dir, "preview.json")) as summary:
+        return(json.load(summary))
+
+def seeds(summary, k):
+    # (assignments file, seed) to start a full run with k clusters from, None if the preview did not try k
+    for entry in summary["sweep"]:
+        if entry["k"] == int(k) and os.path.exists(entry["seeds"]):
+            return((entry["seeds"], summary["seed"]))
+    return(None)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="quick k sweep on a subsample of cells and loci from ref.mtx/alt.mtx, to pick k before a full clustering run")
+    parser.add_argument("-r", "--ref_matrix", required = True, help = "ref matrix from vartrix")
+    parser.add_argument("-a", "--alt_matrix", required = True, help = "alt matrix from vartrix")
+    parser.add_argument("-b", "--barcodes", required = True, help = "barcodes.tsv the matrices were counted for")
+    parser.add_argument("-o", "--out_dir", required = True, help = "directory for the subsample, the per k clusters and preview.json")
+    parser.add_argument("-k", "--clusters", required = True, type = int, nargs = '+', help = "values of k to try")
+    parser.add_argument("-t", "--threads", required = False, default = 8, type = int, help = "threads to use")
+    parser.add_argument("--restarts", required = False, default = 8, type = int, help = "clustering restarts per k, default = 8")
+    parser.add_argument("--cells", required = False, default = 2000, type = int, help = "cells to subsample, default = 2000")
+    parser.add_argument("--loci", required = False, default = 4000, type = int, help = "loci to keep, default = 4000")
+    parser.add_argument("--min_ref", required = False, default = 4, type = int, help = "min ref cells to use locus, default = 4")
+    parser.add_argument("--min_alt", required = False, default = 4, type = int, help = "min alt cells to use locus, default = 4")
+    parser.add_argument("--seed", required = False, default = 4, type = int, help = "random seed, 0-255, default = 4")
+    args = parser.parse_args()
+    sweep(args.ref_matrix, args.alt_matrix, args.barcodes, args.out_dir, args.clusters, args.threads, args.restarts,
+        args.cells, args.loci, args.min_ref, args.min_alt, args.seed)
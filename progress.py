@@ -0,0 +1,96 @@
+import json
+import os
+import time
+
+# newline delimited json progress events, appended by every stage to the file named in SOUPORCELL_PROGRESS
+# (souporcell_pipeline.py sets it to out_dir/progress.ndjson) so a run can be followed with tail -f.
+# each event is one write to a file opened for append, so lines from parallel shards do not interleave.
+# the Rust souporcell binary writes the same format for clustering
+
+env_var = "SOUPORCELL_PROGRESS"
+
+def emit(stage, event, **fields):
+    fn = os.environ.get(env_var)
+    if not fn:
+        return
+    record = {"time": round(time.time(), 3), "stage": stage, "event": event, "pid": os.getpid()}
+    record.update(fields)
+    line = (json.dumps(record) + "\n").encode()
+    try:
+        fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # progress is best effort, never fail a stage over it
+
+class Throughput:
+    # reads per second for a streaming stage, reported at most every interval seconds
+    def __init__(self, stage, interval = 10.0, **fields):
+        self.stage = stage
+        self.interval = interval
+        self.fields = fields
+        self.start = time.time()
+        self.last = self.start
+        self.last_count = 0
+        emit(stage, "start", **fields)
+
+    def update(self, count, **fields):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        fields.update(self.fields)
+        emit(self.stage, "progress", reads = count, reads_per_second = round((count - self.last_count) / (now - self.last), 1),
+            elapsed = round(now - self.start, 1), **fields)
+        self.last = now
+        self.last_count = count
+
+    def done(self, count, **fields):
+        elapsed = time.time() - self.start
+        fields.update(self.fields)
+        emit(self.stage, "done", reads = count, reads_per_second = round(count / max(elapsed, 1e-6), 1), elapsed = round(elapsed, 1), **fields)
+
+class Shards:
+    # shards done out of total with an eta from the mean time per finished shard. shards reported through started()
+    # and ended() get a shard_start event, and while any are running a heartbeat event lists them with their elapsed
+    # time every heartbeat seconds, so a long shard shows up before it finishes
+    def __init__(self, stage, total, heartbeat = 30.0):
+        self.stage = stage
+        self.total = total
+        self.finished = 0
+        self.start = time.time()
+        self.heartbeat_seconds = heartbeat
+        self.last_heartbeat = self.start
+        self.running = {} # shard -> (start time, fields)
+        emit(stage, "start", shards_total = total)
+
+    def started(self, shard, **fields):
+        self.running[shard] = (time.time(), fields)
+        emit(self.stage, "shard_start", shard = shard, shards_running = len(self.running), **fields)
+
+    def ended(self, shard):
+        self.running.pop(shard, None)
+
+    def heartbeat(self):
+        now = time.time()
+        if len(self.running) == 0 or now - self.last_heartbeat < self.heartbeat_seconds:
+            return
+        self.last_heartbeat = now
+        running = []
+        for (shard, (start, fields)) in self.running.items():
+            entry = {"shard": shard, "elapsed": round(now - start, 1)}
+            entry.update(fields)
+            running.append(entry)
+        emit(self.stage, "heartbeat", shards_done = self.finished, shards_total = self.total, elapsed = round(now - self.start, 1),
+            running = running)
+
+    def update(self, finished):
+        self.heartbeat()
+        if finished == self.finished:
+            return
+        self.finished = finished
+        elapsed = time.time() - self.start
+        eta = elapsed / finished * (self.total - finished) if finished > 0 else None
+        emit(self.stage, "done" if finished >= self.total else "progress", shards_done = finished, shards_total = self.total,
+            elapsed = round(elapsed, 1), eta_seconds = None if eta == None else round(eta, 1))
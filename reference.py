@@ -0,0 +1,113 @@
+import hashlib
+import os
+import subprocess
+
+# reference contig names and lengths from the fasta index (.fai) instead of pyfasta, which flattens
+# the whole genome next to the fasta the first time it is opened. without a .fai the tables are cached
+# per fasta checksum so a read only reference is only scanned once per node
+
+cache_dir = os.environ.get("SOUPORCELL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "souporcell"))
+checksum_bytes = 1 << 20
+
+def fasta_checksum(fasta_fn):
+    # md5 of the whole fasta. hashing a genome takes as long as scanning it, so the sum is kept in the cache
+    # under the path, size and mtime and only worked out again once the file changes
+    stat = os.stat(fasta_fn)
+    stamp = os.path.realpath(fasta_fn) + "\t" + str(stat.st_size) + "\t" + str(stat.st_mtime_ns)
+    cached = os.path.join(cache_dir, hashlib.md5(stamp.encode()).hexdigest() + ".md5")
+    if os.path.exists(cached):
+        with open(cached) as saved:
+            return saved.read().strip()
+    md5 = hashlib.md5()
+    with open(fasta_fn, 'rb') as fasta:
+        for block in iter(lambda: fasta.read(checksum_bytes), b""):
+            md5.update(block)
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        with open(cached + ".tmp", 'w') as out:
+            out.write(md5.hexdigest() + "\n")
+        os.rename(cached + ".tmp", cached)
+    except OSError:
+        pass # the cache is only an optimization
+    return md5.hexdigest()
+
+def read_table(fn):
+    contigs = []
+    with open(fn) as table:
+        for line in table:
+            toks = line.rstrip("\n").split("\t")
+            contigs.append((toks[0], int(toks[1])))
+    return contigs
+
+def scan_fasta(fasta_fn):
+    contigs = []
+    with open(fasta_fn) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                contigs.append([line[1:].split()[0], 0])
+            else:
+                contigs[-1][1] += len(line.strip())
+    return [(name, length) for (name, length) in contigs]
+
+def ensure_index(fasta_fn):
+    # makes the .fai that minimap2, freebayes and vartrix want next to the fasta, returns whether there is one.
+    # separate from contigs(), which can answer from its cache without the .fai ever being made
+    fai = fasta_fn + ".fai"
+    if not os.path.isfile(fai):
+        print("fasta index not found, creating")
+        if subprocess.call(['samtools', 'faidx', fasta_fn]) != 0:
+            print("could not create fasta index (read only reference?)")
+    return os.path.isfile(fai)
+
+def contigs(fasta_fn):
+    # [(name, length)] in fasta order
+    fai = fasta_fn + ".fai"
+    if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(fasta_fn):
+        return read_table(fai)
+    cached = os.path.join(cache_dir, fasta_checksum(fasta_fn) + ".contigs.tsv")
+    if os.path.exists(cached):
+        return read_table(cached)
+    if not ensure_index(fasta_fn):
+        print("reading contig lengths from the fasta")
+    table = read_table(fai) if os.path.isfile(fai) else scan_fasta(fasta_fn)
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        with open(cached + ".tmp", 'w') as out:
+            for (name, length) in table:
+                out.write(name + "\t" + str(length) + "\n")
+        os.rename(cached + ".tmp", cached)
+    except OSError:
+        pass # the cache is only an optimization
+    return table
+
+def plan_regions(contigs, chunks, min_length = 0):
+    # split [(name, length)] into at most chunks lists of (name, start, end) covering about equal lengths
+    contigs = [(name, length) for (name, length) in contigs if length >= min_length]
+    total_reference_length = 0
+    for (chrom, chrom_length) in contigs:
+        total_reference_length += chrom_length
+    step_length = max(1, -(-total_reference_length // chunks))
+    regions = []
+    region = []
+    region_so_far = 0
+    chrom_so_far = 0
+    for (chrom, chrom_length) in contigs:
+        while True:
+            if region_so_far + (chrom_length - chrom_so_far) <= step_length:
+                region.append((chrom, chrom_so_far, chrom_length))
+                region_so_far += chrom_length - chrom_so_far
+                chrom_so_far = 0
+                break
+            else:
+                end = chrom_so_far + step_length - region_so_far
+                region.append((chrom, chrom_so_far, end))
+                regions.append(region)
+                region = []
+                chrom_so_far = end + 1
+                region_so_far = 0
+    if len(region) > 0:
+        if len(regions) == chunks:
+            regions[-1] = regions[-1] + region
+        else:
+            regions.append(region)
+    return regions
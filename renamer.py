@@ -2,59 +2,134 @@
 
 import pysam
 import argparse
+import collections
+import subprocess
+import sys
+import progress
 
 parser = argparse.ArgumentParser(description='make fastq from possorted_genome_bam.bam from cellranger')
 
 parser.add_argument('-f', '--bam', required=True, help="cellranger bam")
 parser.add_argument('-b', '--barcodes', required=True, help="cellranger barcodes.tsv")
-parser.add_argument('-o', '--out', required=True, help="output fastq name")
+parser.add_argument('--barcode_index', required = False, help="barcode index built from the barcodes file (barcode_index.py), memory mapped instead of parsing the barcodes")
+parser.add_argument('-o', '--out', required=True, help="output fastq name, ending in .gz to gzip it or - for stdout")
 parser.add_argument('-c', '--chrom', required = False, help="chrom")
 parser.add_argument('-s', '--start', required = False, help="start")
 parser.add_argument('-e', '--end', required = False, help="end")
+parser.add_argument('-r', '--regions', required = False, help="tsv of chrom, start, end regions to process in order in this one process")
+parser.add_argument('-t', '--threads', required = False, default = 1, type = int, help="extra bam decompression threads")
+parser.add_argument('--block_reads', required = False, default = 100000, type = int, help="reads to buffer between writes")
+parser.add_argument('--keep_duplicates', required = False, default = False, action = "store_true",
+    help="write every read instead of collapsing reads with the same cell barcode, UMI and position")
+parser.add_argument('--dedup_window', required = False, default = 0, type = int,
+    help="also collapse a cell barcode and UMI seen this many bases upstream, default = 0 (exact position)")
+parser.add_argument('--max_dedup_entries', required = False, default = 1000000, type = int,
+    help="hard cap on remembered cell barcode/UMI/position entries, oldest are dropped first")
 args = parser.parse_args()
 
 assert (not(args.chrom) and not(args.start) and not(args.end)) or (args.chrom and args.start and args.end), "if specifying region, must specify chrom, start, and end"
+assert not(args.chrom and args.regions), "cannot specify both a region and a regions file"
 
 fn = args.bam#"possorted_genome_bam.bam"#files[0]
-bam = pysam.AlignmentFile(fn, "rb")
+bam = pysam.AlignmentFile(fn, "rb", threads = args.threads)
 
-cell_barcodes = set([])
-with open(args.barcodes) as barcodes:
-    for line in barcodes:
-        tokens=line.strip().split()
-        cell_barcodes.add(tokens[0])
+if args.barcode_index:
+    import barcode_index
+    cell_barcodes = barcode_index.BarcodeIndex(args.barcode_index)
+else:
+    cell_barcodes = set([])
+    with open(args.barcodes) as barcodes:
+        for line in barcodes:
+            tokens=line.strip().split()
+            cell_barcodes.add(tokens[0])
 
+regions = []
 if args.chrom:
-    bam = bam.fetch(args.chrom, int(args.start), int(args.end))
+    regions.append((args.chrom, int(args.start), int(args.end)))
+elif args.regions:
+    with open(args.regions) as region_file:
+        for line in region_file:
+            tokens = line.strip().split("\t")
+            regions.append((tokens[0], int(tokens[1]), int(tokens[2])))
 
+def reads():
+    if len(regions) == 0:
+        for read in bam:
+            yield read
+    for (chrom, start, end) in regions:
+        for read in bam.fetch(chrom, start, end):
+            yield read
+
+compressor = None
+if args.out == "-":
+    fastq = sys.stdout
+elif args.out.endswith(".gz"):
+    out = open(args.out, 'wb')
+    compressor = subprocess.Popen(["gzip", "-1", "-c"], stdin = subprocess.PIPE, stdout = out, universal_newlines = True)
+    fastq = compressor.stdin
+else:
+    fastq = open(args.out, 'w', buffering = 1 << 22)
+
+# reads come in coordinate order, so a cell barcode/UMI/position can only repeat while the stream
+# is still within dedup_window of that position. recent_umis holds just that window, in the same order as
+# the window deque, and is emptied as the stream moves on so memory stays flat over whole chromosomes
 recent_umis = {}
-with open(args.out,'w') as fastq:
-    for (index,read) in enumerate(bam):
-        if not read.has_tag("CB"):
-            continue
+window = collections.deque()
+window_chrom = None
+total_reads = 0
+collapsed = 0
+cap_evictions = 0
+
+skip_flags = 0x100 | 0x800 # secondary, supplementary
+block = []
+processed = 0
+throughput = progress.Throughput("renamer", out = args.out)
+for read in reads():
+    processed += 1
+    if processed & 0xffff == 0:
+        throughput.update(processed, kept = total_reads, chrom = read.reference_name)
+    if read.flag & skip_flags:
+        continue
+    try:
         cell_barcode = read.get_tag("CB")
-        if read.is_secondary or read.is_supplementary:
-            continue
-        if not read.has_tag("UB"):
-            continue
         UMI = read.get_tag("UB")
-        pos = read.pos
-        full_umi = cell_barcode + UMI + str(pos)
-        if full_umi in recent_umis:
+    except KeyError:
+        continue
+    if not cell_barcode in cell_barcodes:
+        continue
+    total_reads += 1
+    if not args.keep_duplicates:
+        pos = read.reference_start
+        if read.reference_id != window_chrom:
+            recent_umis.clear()
+            window.clear()
+            window_chrom = read.reference_id
+        while len(window) > 0 and window[0][0] < pos - args.dedup_window:
+            (old_pos, old_umi) = window.popleft()
+            if recent_umis.get(old_umi) == old_pos:
+                del recent_umis[old_umi]
+        umi = (cell_barcode, UMI)
+        if umi in recent_umis and (args.dedup_window > 0 or recent_umis[umi] == pos):
+            collapsed += 1
             continue
-        #recent_umis[full_umi] = pos
-        #if index % 10000 == 0:
-        #    keys_to_remove = []
-        #    for (key, val) in recent_umis.items():
-        #        if val - pos > 200:
-        #            keys_to_remove.append(key)
-        #    for key in keys_to_remove:
-        #        del recent_umis[key]
-    
-        readname = read.qname
-        if read.has_tag("CB") and read.get_tag("CB") in cell_barcodes:
-            fastq.write("@"+read.qname+";"+cell_barcode+";"+UMI+"\n")
-            fastq.write(read.seq+"\n")
-            fastq.write("+\n")
-            fastq.write(read.qual+"\n")
-
+        recent_umis[umi] = pos
+        window.append((pos, umi))
+        if len(window) > args.max_dedup_entries:
+            (old_pos, old_umi) = window.popleft()
+            if recent_umis.get(old_umi) == old_pos:
+                del recent_umis[old_umi]
+            cap_evictions += 1
+    block.append("@%s;%s;%s\n%s\n+\n%s\n" % (read.query_name, cell_barcode, UMI, read.query_sequence, read.qual))
+    if len(block) >= args.block_reads:
+        fastq.write("".join(block))
+        block = []
+fastq.write("".join(block))
+if not args.out == "-":
+    fastq.close()
+if compressor:
+    compressor.wait()
+    out.close()
+    assert not(compressor.returncode), "gzip ended abnormally with code " + str(compressor.returncode)
+throughput.done(processed, kept = total_reads, duplicates = collapsed)
+sys.stderr.write("renamer " + args.out + ": " + str(total_reads) + " reads, " + str(collapsed) + " duplicates collapsed (" +
+    str(round(100.0 * collapsed / max(total_reads, 1), 2)) + "%), " + str(cap_evictions) + " dedup entries dropped at the memory cap\n")
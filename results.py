@@ -0,0 +1,127 @@
+import json
+import os
+
+import numpy as np
+
+import barcode_index
+
+# the results of a run as arrays in out_dir/results, next to the text outputs, for notebooks and services that
+# would otherwise parse clusters.tsv, cluster_genotypes.vcf and ambient_rna.txt. every array is its own .npy
+# so load() can memory map it, scalars and the meaning of the codes are in meta.json
+#   barcodes.npy           fixed width bytes, one per cell in clusters.tsv order
+#   barcodes.idx.npy       barcode_index table over those rows (missing if a barcode cannot be packed)
+#   status.npy             uint8 index into meta["statuses"]
+#   assignment.npy         int16 cluster, -1 where the assignment is a doublet pair
+#   doublet_pair.npy       int16 cells x 2 pair of clusters, -1 where the assignment is a single cluster
+#   log_prob_singleton.npy, log_prob_doublet.npy    float32 per cell
+#   cluster_log_probs.npy  float32 cells x k, the per cluster columns of clusters.tsv
+#   doublet_pairs.npy      int32 k x k count of doublets called for each pair of clusters
+#   locus.npy, chrom.npy, pos.npy    0 based vcf record, chromosome and position of each genotyped locus
+#   genotype_posteriors.npy    float32 loci x k x genotypes, genotypes in meta["genotypes"] order
+# meta.json also has ambient_rna as a fraction
+
+format_version = 1
+statuses = ["singlet", "doublet", "unassigned"]
+# the order consensus.py models genotypes in
+genotype_names = {1: ["0", "1"], 2: ["0/0", "1/1", "0/1"]}
+
+def save(store_dir, name, array):
+    os.makedirs(store_dir, exist_ok = True)
+    fn = os.path.join(store_dir, name + ".npy")
+    with open(fn + ".tmp", 'wb') as out:
+        np.save(out, array)
+    os.rename(fn + ".tmp", fn)
+
+def update_meta(store_dir, **fields):
+    meta = load_meta(store_dir)
+    meta.update(fields)
+    meta["format"] = format_version
+    os.makedirs(store_dir, exist_ok = True)
+    fn = os.path.join(store_dir, "meta.json")
+    with open(fn + ".tmp", 'w') as out:
+        json.dump(meta, out, indent = 1)
+    os.rename(fn + ".tmp", fn)
+
+def load_meta(store_dir):
+    try:
+        with open(os.path.join(store_dir, "meta.json")) as meta:
+            return(json.load(meta))
+    except FileNotFoundError:
+        return({})
+
+def has_assignments(store_dir):
+    return("clusters" in load_meta(store_dir))
+
+def write_assignments(store_dir, clusters_fn):
+    # from clusters.tsv as troublet or assign.py wrote it
+    barcodes = []
+    status = []
+    assignments = []
+    log_probs = []
+    with open(clusters_fn) as clusters:
+        header = clusters.readline().rstrip("\n").split("\t")
+        k = len(header) - 5
+        for line in clusters:
+            toks = line.rstrip("\n").split("\t")
+            barcodes.append(toks[0])
+            status.append(statuses.index(toks[1]))
+            assignments.append(toks[2])
+            log_probs.append(toks[3:5 + k])
+    cells = len(barcodes)
+    values = np.array(log_probs, dtype = np.float32).reshape((cells, k + 2))
+    assignment = np.full(cells, -1, dtype = np.int16)
+    pair = np.full((cells, 2), -1, dtype = np.int16)
+    for (cell, value) in enumerate(assignments):
+        if "/" in value:
+            pair[cell] = [int(x) for x in value.split("/")]
+        else:
+            assignment[cell] = int(value)
+    status = np.array(status, dtype = np.uint8)
+    doublets = (status == statuses.index("doublet")) & (pair[:, 0] >= 0)
+    pairs = np.zeros((k, k), dtype = np.int32)
+    np.add.at(pairs, (pair[doublets, 0], pair[doublets, 1]), 1)
+    save(store_dir, "barcodes", np.array(barcodes, dtype = "S"))
+    index = barcode_index.table(barcodes)
+    if index is None:
+        try:
+            os.remove(os.path.join(store_dir, "barcodes.idx.npy"))
+        except FileNotFoundError:
+            pass
+    else:
+        save(store_dir, "barcodes.idx", index)
+    save(store_dir, "status", status)
+    save(store_dir, "assignment", assignment)
+    save(store_dir, "doublet_pair", pair)
+    save(store_dir, "log_prob_singleton", values[:, 0])
+    save(store_dir, "log_prob_doublet", values[:, 1])
+    save(store_dir, "cluster_log_probs", values[:, 2:])
+    save(store_dir, "doublet_pairs", pairs)
+    update_meta(store_dir, cells = cells, clusters = k, statuses = statuses,
+        status_counts = dict([(name, int((status == code).sum())) for (code, name) in enumerate(statuses)]))
+
+def write_genotypes(store_dir, locus, chrom, pos, posteriors, ploidy):
+    # posteriors loci x k x genotypes from consensus.py
+    save(store_dir, "locus", np.asarray(locus, dtype = np.int64))
+    save(store_dir, "chrom", np.array(chrom, dtype = "S"))
+    save(store_dir, "pos", np.asarray(pos, dtype = np.int64))
+    save(store_dir, "genotype_posteriors", np.asarray(posteriors, dtype = np.float32))
+    update_meta(store_dir, loci = len(locus), ploidy = int(ploidy), genotypes = genotype_names[int(ploidy)])
+
+def write_ambient(store_dir, fraction):
+    update_meta(store_dir, ambient_rna = float(fraction))
+
+def read_ambient(ambient_fn):
+    # the fraction from ambient_rna.txt, "ambient RNA estimated as 4.2%"
+    with open(ambient_fn) as ambient:
+        return(float(ambient.read().strip().split()[-1].rstrip("%")) / 100.0)
+
+def load(store_dir, mmap_mode = 'r'):
+    # every array in the store by name, memory mapped unless mmap_mode is None, with "meta" and, if the
+    # barcodes could be packed, "index", a barcode_index.BarcodeIndex giving a barcode's row
+    store = {"meta": load_meta(store_dir)}
+    for name in os.listdir(store_dir):
+        if name.endswith(".npy") and not name == "barcodes.idx.npy":
+            store[name[:-len(".npy")]] = np.load(os.path.join(store_dir, name), mmap_mode = mmap_mode)
+    if os.path.exists(os.path.join(store_dir, "barcodes.idx.npy")):
+        store["index"] = barcode_index.BarcodeIndex(os.path.join(store_dir, "barcodes.idx.npy"))
+    return(store)
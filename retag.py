@@ -2,6 +2,7 @@
 
 import pysam
 import argparse
+import progress
 
 
 parser = argparse.ArgumentParser(description='Retag reads with their cell barcodes and UMIs')
@@ -14,7 +15,12 @@ bam = pysam.AlignmentFile(args.sam)
 
 bamout = pysam.AlignmentFile(args.out,'wb', template=bam)
 
+throughput = progress.Throughput("retag", out = args.out)
+reads = 0
 for read in bam:
+    reads += 1
+    if reads & 0xffff == 0:
+        throughput.update(reads)
     qname = read.qname
     tokens = qname.split(";")
     #assert(len(tokens) == 3)
@@ -23,3 +29,4 @@ for read in bam:
     bamout.write(read)
 
 bamout.close()
+throughput.done(reads)
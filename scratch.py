@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import time
+
+# where a run's intermediate files live (souporcell_pipeline.py --scratch_dir) and how much room they may take
+# (--max_scratch). intermediates are the renamed fastqs, minimap2 sams, retag and sort bams, per shard vcfs and
+# bed files. each is named through path() so its bytes count against the budget, and removed with remove() as
+# soon as the last job reading it has finished. final artifacts are published into out_dir.
+# without a scratch dir intermediates stay in out_dir as before and the budget still applies to them
+
+poll_seconds = 0.5
+
+def run_dir(scratch_dir, out_dir):
+    # one directory per output directory, so a restarted run finds the intermediates of the last one
+    out_dir = os.path.abspath(out_dir)
+    digest = hashlib.md5(out_dir.encode()).hexdigest()[:8]
+    return(os.path.join(scratch_dir, "souporcell_" + os.path.basename(out_dir) + "_" + digest))
+
+class Scratch:
+    def __init__(self, out_dir, scratch_dir = None, max_bytes = None):
+        self.out_dir = out_dir
+        self.root = run_dir(scratch_dir, out_dir) if scratch_dir else out_dir
+        self.separate = not(scratch_dir == None)
+        self.max_bytes = max_bytes
+        self.files = set()
+        os.makedirs(self.root, exist_ok = True)
+
+    def path(self, name):
+        fn = os.path.join(self.root, name)
+        self.track([fn])
+        return(fn)
+
+    def track(self, fns):
+        # files named by an earlier run of the pipeline (fastqs.done, remapping.done) count too
+        for fn in fns:
+            self.files.add(fn)
+
+    def used(self):
+        # also counts files that tools make next to their outputs, samtools sort temp files and freebayes .err logs
+        prefixes = tuple(self.files)
+        total = 0
+        if len(prefixes) == 0:
+            return(total)
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.path.startswith(prefixes):
+                    try:
+                        total += entry.stat().st_size
+                    except OSError:
+                        pass # removed since the listing
+        return(total)
+
+    def room(self, expected = 0):
+        return(self.max_bytes == None or self.used() + expected <= self.max_bytes)
+
+    def wait_for_room(self, jobs, expected = 0):
+        # holds off a job that would take the intermediates over budget while running jobs may still free some.
+        # with nothing running waiting frees nothing, so the job then goes ahead over budget
+        while not self.room(expected) and any([job.poll() == None for job in jobs]):
+            time.sleep(poll_seconds)
+
+    def remove(self, *fns):
+        for fn in fns:
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            self.files.discard(fn)
+
+    def lost(self, fns):
+        return(any([not os.path.exists(fn) for fn in fns]))
+
+    def publish(self, fn, keep = False):
+        # copy a final artifact from scratch into out_dir, the copy appears there complete or not at all
+        if not self.separate:
+            return(fn)
+        dest = os.path.join(self.out_dir, os.path.basename(fn))
+        shutil.copyfile(fn, dest + ".tmp")
+        os.rename(dest + ".tmp", dest)
+        if not keep:
+            self.remove(fn)
+        return(dest)
+
+    def local(self, fn):
+        # the scratch copy of a published file if it is still there, reads from local disk are cheaper
+        if self.separate:
+            local_fn = os.path.join(self.root, os.path.basename(fn))
+            if os.path.exists(local_fn):
+                return(local_fn)
+        return(fn)
+
+    def clean(self):
+        if self.separate:
+            shutil.rmtree(self.root, ignore_errors = True)
@@ -2,224 +2,164 @@
 
 import argparse
 import gzip
+import hashlib
 import os
 
 
-parser = argparse.ArgumentParser(description = "determine which clusters are the shared clusters between two souporcell runs with shared samples")
-parser.add_argument("-1","--experiment1", required = True, help = "souporcell directory for experiment 1")
-parser.add_argument("-2","--experiment2", required = True, help = "souporcell directory for experiment 2")
-parser.add_argument("-n","--shared", required= True, type = int, help = "how many samples should these experiments share?")
+parser = argparse.ArgumentParser(description = "determine which clusters are the shared clusters between souporcell runs with shared samples")
+parser.add_argument("-1","--experiment1", required = False, help = "souporcell directory for experiment 1")
+parser.add_argument("-2","--experiment2", required = False, help = "souporcell directory for experiment 2")
+parser.add_argument("-e","--experiments", required = False, nargs = '+', default = [],
+    help = "souporcell directories of any number of experiments, compared all against all")
+parser.add_argument("-n","--shared", required= False, default = None, type = int,
+    help = "how many samples should each pair of experiments share? default = clusters that are each other's clear best match")
+parser.add_argument("--match_ratio", required = False, default = 0.5, type = float,
+    help = "without --shared, a best match also needs a loss below this fraction of the pair's median loss, default = 0.5")
+parser.add_argument("--min_depth", required = False, default = 8, type = int,
+    help = "min reads per cluster at a locus, in every cluster of both experiments, to use the locus, default = 8")
+parser.add_argument("-o", "--donors_out", required = False, default = "shared_donors.tsv",
+    help = "output tsv mapping every experiment's clusters to a global donor id")
 args = parser.parse_args()
 
-if os.path.isfile(args.experiment1+"/souporcell_merged_sorted_vcf.vcf.gz"):
-    vcf1 = gzip.open(args.experiment1+"/souporcell_merged_sorted_vcf.vcf.gz",'rt')
-    vcf2 = gzip.open(args.experiment2+"/souporcell_merged_sorted_vcf.vcf.gz",'rt')
-elif os.path.isfile(args.experiment1+"/common_variants_covered.vcf"):
-    vcf1 = open(args.experiment1+"/common_variants_covered.vcf")
-    vcf2 = open(args.experiment2+"/common_variants_covered.vcf")
-    
-
-line1 = "#"
-while line1.startswith("#"):
-    line1 = vcf1.readline()
-(chr1, pos1, ref1, alt1) = line1.strip().split()[0:4]
-line2 = "#"
-while line2.startswith("#"):
-    line2 = vcf2.readline()
-(chr2, pos2, ref2, alt2) = line2.strip().split()[0:4]
-assert chr1 == chr2, "vcfs dont start with same chromosome, are you sure you used the same reference?"
-last_chr1 = chr1
-last_chr2 = chr2
-locus1 = 1
-locus2 = 1
-locus1_matches = []
-locus2_matches = []
-locus1_matchset = {}
-locus2_matchset = {}
-save_loci1 = {locus2: (chr1,pos1)}
-save_loci2 = {locus2: (chr2,pos2)}
-breakme = False
-while not breakme:
-    if pos1 == None:
-        try:
-            (chr1, pos1, ref1, alt1) = vcf1.readline().strip().split()[0:4] 
-            locus1 += 1
-            save_loci1[locus1] = (chr1, pos1)
-        except:
-            break
-    if pos2 == None:
-        try:
-            (chr2, pos2, ref2, alt2) = vcf2.readline().strip().split()[0:4]
-            locus2 += 1
-            save_loci2[locus2] = (chr2, pos2)
-        except:
+import numpy as np
+import mtx
+
+experiments = args.experiments + [exp for exp in [args.experiment1, args.experiment2] if exp]
+assert len(experiments) >= 2, "need at least two experiments, use -1/-2 or --experiments"
+
+def experiment_vcf(directory):
+    # the run's own record of its variants first, then the freebayes and common variants layouts
+    candidates = []
+    if os.path.isfile(directory + "/variants.done"):
+        with open(directory + "/variants.done") as done:
+            recorded = done.readline().strip()
+        candidates.extend([recorded, directory + "/" + os.path.basename(recorded)])
+    candidates.extend([directory + "/souporcell_merged_sorted_vcf.vcf.gz", directory + "/common_variants_covered.vcf"])
+    for fn in candidates:
+        if os.path.isfile(fn):
+            return fn
+    assert False, "no variants vcf found in " + directory
+
+def locus_key(chrom, pos, ref, alt):
+    return int.from_bytes(hashlib.blake2b((chrom + "\t" + ref + "\t" + alt).encode(), digest_size = 4).digest(), "little") << 32 | pos
+
+def locus_index(directory):
+    # one uint64 key per locus in the run's locus order: 32 bit hash of chrom, ref and alt above the numeric
+    # position. cached as locus_index.npy and rebuilt when the vcf is newer
+    vcf_fn = experiment_vcf(directory)
+    cache = directory + "/locus_index.npy"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(vcf_fn):
+        return np.load(cache)
+    keys = []
+    with (gzip.open(vcf_fn, 'rt') if vcf_fn.endswith(".gz") else open(vcf_fn)) as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            (chrom, pos, name, ref, alt) = line.split("\t", 5)[0:5]
+            keys.append(locus_key(chrom, int(pos), ref, alt))
+    keys = np.array(keys, dtype = np.uint64)
+    np.save(cache, keys)
+    return keys
+
+def match_loci(keys1, keys2):
+    # 0 based locus indexes of the loci in both runs, in the first run's order
+    (shared, loci1, loci2) = np.intersect1d(keys1, keys2, assume_unique = False, return_indices = True)
+    order = np.argsort(loci1, kind = "stable")
+    return (loci1[order].astype(np.int64), loci2[order].astype(np.int64))
+
+def cluster_counts(directory):
+    # (clusters, loci, 2) ref and alt counts summed over each cluster's singlets, cached next to the
+    # matrices as cluster_allele_counts.npy and rebuilt when clusters.tsv or the matrices are newer
+    cache = directory + "/cluster_allele_counts.npy"
+    inputs = [directory + "/clusters.tsv", directory + "/ref.mtx", directory + "/alt.mtx"]
+    if os.path.exists(cache) and os.path.getmtime(cache) >= max([os.path.getmtime(fn) for fn in inputs]):
+        return np.load(cache)
+    (loci, cells, locus, cell, ref, alt) = mtx.load_pair(directory + "/ref.mtx", directory + "/alt.mtx")
+    cell_cluster = np.full(cells, -1, dtype = np.int64)
+    with open(directory + "/clusters.tsv") as clust:
+        clust.readline()
+        for (celldex, line) in enumerate(clust):
+            toks = line.strip().split()
+            if toks[1] == "singlet":
+                cell_cluster[celldex] = int(toks[2])
+    clusters = int(cell_cluster.max()) + 1
+    assert clusters > 0, "no singlets in " + directory + "/clusters.tsv"
+    cluster = cell_cluster[cell]
+    keep = cluster >= 0
+    keys = cluster[keep] * loci + locus[keep]
+    counts = np.zeros((clusters, loci, 2), dtype = np.uint32)
+    counts[:, :, 0] = np.bincount(keys, weights = ref[keep], minlength = clusters * loci).reshape(clusters, loci)
+    counts[:, :, 1] = np.bincount(keys, weights = alt[keep], minlength = clusters * loci).reshape(clusters, loci)
+    np.save(cache, counts)
+    return counts
+
+def distances(counts1, counts2, loci1, loci2):
+    # squared difference of ref allele fractions summed over the matched loci with enough depth
+    # in every cluster of both experiments, for all cluster pairs at once
+    counts1 = counts1[:, loci1, :].astype(np.float64)
+    counts2 = counts2[:, loci2, :].astype(np.float64)
+    depth1 = counts1.sum(axis = 2)
+    depth2 = counts2.sum(axis = 2)
+    use = (depth1.min(axis = 0) >= args.min_depth) & (depth2.min(axis = 0) >= args.min_depth)
+    af1 = counts1[:, use, 0] / depth1[:, use]
+    af2 = counts2[:, use, 0] / depth2[:, use]
+    loss = (af1 ** 2).sum(axis = 1)[:, None] + (af2 ** 2).sum(axis = 1)[None, :] - 2.0 * af1.dot(af2.T)
+    return (np.maximum(loss, 0.0), int(use.sum()))
+
+def pair_matches(loss):
+    # one to one matches taken greedily from the smallest loss, either the best args.shared of them
+    # or the pairs that are each other's best match and well below the typical (unrelated) loss,
+    # so a cluster whose donor is missing from the other experiment is left unmatched
+    threshold = args.match_ratio * np.median(loss)
+    matches = []
+    used1 = set()
+    used2 = set()
+    for flat in np.argsort(loss, axis = None, kind = "stable"):
+        (cluster1, cluster2) = np.unravel_index(flat, loss.shape)
+        if cluster1 in used1 or cluster2 in used2:
+            continue
+        if args.shared == None and not(loss[cluster1].argmin() == cluster2 and loss[:, cluster2].argmin() == cluster1 and
+                loss[cluster1, cluster2] < threshold):
+            continue
+        matches.append((int(cluster1), int(cluster2)))
+        used1.add(cluster1)
+        used2.add(cluster2)
+        if not(args.shared == None) and len(matches) == args.shared:
             break
-    if chr1 == chr2:
-        if pos1 == pos2:
-            if alt1 == alt2:
-                locus1_matches.append(locus1)
-                locus2_matches.append(locus2)
-                locus1_matchset[locus1] = len(locus1_matches) - 1
-                locus2_matchset[locus2] = len(locus2_matches) - 1
-                #print("we have a match chr"+chr1+" "+str(pos1)+" respective loci "+str(locus1)+" "+str(locus2))
-            pos1 = None
-            pos2 = None
-        elif pos1 < pos2:
-            pos1 = None
-        else:
-            pos2 = None
-    elif not(chr1 == last_chr1):
-        while not(chr2 == chr1):
-            try:
-                (chr2, pos2, ref2, alt2) = vcf2.readline().strip().split()[0:4]
-            except:
-                breakme = True
-                break
-            locus2 += 1
-        last_chr1 = chr1
-        last_chr2 = chr2
-    elif not(chr2 == last_chr2):
-        while not(chr1 == chr2):
-            try:
-                (chr1, pos1, ref1, alt1) = vcf1.readline().strip().split()[0:4]
-            except:
-                breakme = True
-                break
-            locus1 += 1
-        last_chr1 = chr1
-        last_chr2 = chr2
-    last_chr1 = chr1
-    last_chr2 = chr2
-
-print("locus1 matchset "+str(len(locus1_matchset)))
-
-cell_clusters1 = {}
-with open(args.experiment1+"/clusters.tsv") as clust:
-    clust.readline()
-    for (celldex, line) in enumerate(clust):
-        toks = line.strip().split()
-        if toks[1] == "singlet":
-            cell_clusters1[celldex + 1] = int(toks[2])
-
-print("cell clusters "+str(len(cell_clusters1)))
-cell_clusters2 = {}
-with open(args.experiment2+"/clusters.tsv") as clust:
-    clust.readline()
-    for (celldex, line) in enumerate(clust):
-        toks = line.strip().split()
-        if toks[1] == "singlet":
-            cell_clusters2[celldex + 1] = int(toks[2]) 
-
-print("cell clusters "+str(len(cell_clusters2)))
-cluster1_locus_counts = {} # cluster to locus to count tuple
-total_locus_counts1 = {}
-with open(args.experiment1+"/alt.mtx") as alts:
-    with open(args.experiment1+"/ref.mtx") as refs:
-        alts.readline()
-        alts.readline()
-        alts.readline()
-        refs.readline()
-        refs.readline()
-        refs.readline()
-        for (altline, refline) in zip(alts, refs):
-            (locus1, cell1, altcount) = altline.strip().split()
-            (locus2, cell2, refcount) = refline.strip().split()
-            locus1 = int(locus1)
-            locus2 = int(locus2)
-            cell1 = int(cell1)
-            cell2 = int(cell2)
-            assert locus1 == locus2, "ref and alt mtx for experiment 1 dont match?"
-            assert cell1 == cell2, "ref and alt mtx for experiment 1 dont match?"
-            if locus1 in locus1_matchset:
-                if cell1 in cell_clusters1:
-                    cluster = cell_clusters1[cell1]
-                    matchlocus = locus1_matchset[locus1]
-                    if not(cluster in cluster1_locus_counts):
-                        cluster1_locus_counts[cluster] = [[0,0] for x in range(len(locus1_matchset))]
-                    locus_counts = cluster1_locus_counts[cluster] #cluster1_locus_counts.setdefault(cluster, [[0,0] for x in range(len(locus1_matchset))])
-                    counts = locus_counts[matchlocus]
-                    counts[0] += int(refcount)
-                    counts[1] += int(altcount)
-                    total_locus_counts1.setdefault(matchlocus, 0)
-                    total_locus_counts1[matchlocus] += int(refcount) + int(altcount)
-                    #print(total_locus_counts1[matchlocus])
-print("clusters for experiment1 "+str(len(cluster1_locus_counts)))
-cluster2_locus_counts = {}
-total_locus_counts2 = {}
-with open(args.experiment2+"/alt.mtx") as alts:
-    with open(args.experiment2+"/ref.mtx") as refs:
-        alts.readline()
-        alts.readline()
-        alts.readline()
-        refs.readline()
-        refs.readline()
-        refs.readline()
-        for (altline, refline) in zip(alts, refs):
-            (locus1, cell1, altcount) = altline.strip().split()
-            (locus2, cell2, refcount) = refline.strip().split()
-            locus1 = int(locus1)
-            locus2 = int(locus2)
-            cell1 = int(cell1)
-            cell2 = int(cell2)
-            assert locus1 == locus2, "ref and alt mtx for experiment 1 dont match?"
-            assert cell1 == cell2, "ref and alt mtx for experiment 1 dont match?"
-            if locus1 in locus2_matchset:
-                if cell1 in cell_clusters2:
-                    cluster = cell_clusters2[cell1]
-                    matchlocus = locus2_matchset[locus1]
-                    if not(cluster in cluster2_locus_counts):
-                        cluster2_locus_counts[cluster] = [[0,0] for x in range(len(locus2_matchset))]
-                    locus_counts = cluster2_locus_counts[cluster]#cluster2_locus_counts.setdefault(cluster, [[0,0] for x in range(len(locus2_matchset))])
-                    counts = locus_counts[matchlocus]
-                    counts[0] += int(refcount)
-                    counts[1] += int(altcount)
-                    total_locus_counts2.setdefault(matchlocus, 0)
-                    #print(matchlocus)
-                    total_locus_counts2[matchlocus] += int(refcount) + int(altcount)
-
-print("clusters for experiment2 "+str(len(cluster2_locus_counts)))
-            
-distances = {}
-loci_to_use = set()
-for locus in range(len(cluster1_locus_counts[0])):
-    has_enough = True
-    for cluster in cluster1_locus_counts.keys():
-        locus_counts = cluster1_locus_counts[cluster]
-        if locus_counts[locus][0] + locus_counts[locus][1] < 8:
-            has_enough = False
-    for cluster in cluster2_locus_counts.keys():
-        locus_counts = cluster1_locus_counts[cluster]
-        if locus_counts[locus][0] + locus_counts[locus][1] < 8:
-            has_enough = False
-    if has_enough:
-        loci_to_use.add(locus)
-
-for cluster1 in cluster1_locus_counts.keys():
-    locus_counts1 = cluster1_locus_counts[cluster1]
-    for cluster2 in cluster2_locus_counts.keys():
-        locus_counts2 = cluster2_locus_counts[cluster2]
-        loss = 0
-        for locus in range(len(locus_counts1)):
-            #print("are we")
-            locusname = locus
-            #if locusname in total_locus_counts1 and total_locus_counts1[locusname] > 20 and locusname in total_locus_counts2 and total_locus_counts2[locusname] > 20:
-            if locus in loci_to_use:
-                counts1 = locus_counts1[locus]
-                counts2 = locus_counts2[locus]
-                if counts1[0] + counts1[1] > 0:
-                    af1 = counts1[0]/(counts1[0] + counts1[1])
-                else:
-                    af1 = 1.0
-                if counts2[0] + counts2[1] > 0:
-                    af2 = counts2[0]/(counts2[0] + counts2[1])
-                else:
-                    af2 = 1.0
-                loss += (af1 - af2)**2
-        distances[(cluster1, cluster2)] = loss
-
-distances_sorted = sorted(distances.items(), key=lambda kv: kv[1])
-print("experiment1_cluster\texperiment2_cluster\tloss")
-for (index, ((cluster1, cluster2), loss)) in enumerate(distances_sorted):
-    if index >= args.shared*2:
-        break
-    print("\t".join([str(cluster1), str(cluster2), str(loss)]))
+    return matches
+
+all_counts = [cluster_counts(directory) for directory in experiments]
+all_keys = [locus_index(directory) for directory in experiments]
+for (directory, counts) in zip(experiments, all_counts):
+    print("clusters for " + directory + " " + str(counts.shape[0]))
+
+# union find over (experiment, cluster) so clusters matched through any chain of experiments share a donor
+parent = {}
+def find(node):
+    parent.setdefault(node, node)
+    while not(parent[node] == node):
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+print("experiment1\texperiment1_cluster\texperiment2\texperiment2_cluster\tloss\tloci")
+for exp1 in range(len(experiments)):
+    for exp2 in range(exp1 + 1, len(experiments)):
+        (loci1, loci2) = match_loci(all_keys[exp1], all_keys[exp2])
+        (loss, used_loci) = distances(all_counts[exp1], all_counts[exp2], loci1, loci2)
+        for (cluster1, cluster2) in pair_matches(loss):
+            print("\t".join([experiments[exp1], str(cluster1), experiments[exp2], str(cluster2), str(loss[cluster1, cluster2]), str(used_loci)]))
+            parent[find((exp1, cluster1))] = find((exp2, cluster2))
+
+donors = {}
+with open(args.donors_out, 'w') as out:
+    out.write("experiment\tcluster\tdonor\n")
+    for (exp, counts) in enumerate(all_counts):
+        for cluster in range(counts.shape[0]):
+            donor = donors.setdefault(find((exp, cluster)), len(donors))
+            out.write("\t".join([experiments[exp], str(cluster), str(donor)]) + "\n")
+for (exp, counts) in enumerate(all_counts):
+    exp_donors = [donors[find((exp, cluster))] for cluster in range(counts.shape[0])]
+    if len(set(exp_donors)) < len(exp_donors):
+        print("warning: clusters of " + experiments[exp] + " were matched to the same donor through other experiments")
+print(str(len(donors)) + " donors written to " + args.donors_out)
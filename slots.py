@@ -0,0 +1,63 @@
+import fcntl
+import os
+import subprocess
+import time
+
+# one worker pool shared by every souporcell_pipeline.py of a batch (souporcell_batch.py): a directory
+# with one lock file per core. a job is started holding flocks on as many slot files as it uses threads
+# and the child inherits those locks, so its slots free up when it exits however the parent ends.
+# with SOUPORCELL_SLOTS unset jobs start right away as before
+
+env_var = "SOUPORCELL_SLOTS"
+
+def create(slots_dir, slots):
+    os.makedirs(slots_dir, exist_ok = True)
+    for name in os.listdir(slots_dir):
+        if name.startswith("slot_"):
+            os.remove(os.path.join(slots_dir, name))
+    for slot in range(slots):
+        open(os.path.join(slots_dir, "slot_" + str(slot)), 'a').close()
+    open(os.path.join(slots_dir, "mutex"), 'a').close()
+
+def acquire(threads = 1):
+    # returns the locked file descriptors, the caller passes them to the job and then closes its copies
+    slots_dir = os.environ.get(env_var)
+    if not slots_dir:
+        return([])
+    names = [os.path.join(slots_dir, name) for name in sorted(os.listdir(slots_dir)) if name.startswith("slot_")]
+    threads = max(1, min(int(threads), len(names)))
+    # a job wanting several slots takes all of them or none under the mutex, so two such jobs never each
+    # hold part of what they need and wait on each other forever. the mutex is let go between tries so
+    # a job waiting on many slots does not hold up the jobs that would fit in the slots free now
+    while True:
+        held = []
+        with open(os.path.join(slots_dir, "mutex")) as mutex:
+            fcntl.flock(mutex, fcntl.LOCK_EX)
+            for name in names:
+                if len(held) == threads:
+                    break
+                fd = os.open(name, os.O_RDONLY)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    held.append(fd)
+                except BlockingIOError:
+                    os.close(fd)
+            if len(held) == threads:
+                return(held)
+            for fd in held:
+                os.close(fd)
+        time.sleep(0.2)
+
+def popen(cmd, threads = 1, **kwargs):
+    fds = acquire(threads)
+    try:
+        return(subprocess.Popen(cmd, pass_fds = fds, **kwargs))
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+def check_call(cmd, threads = 1, **kwargs):
+    p = popen(cmd, threads = threads, **kwargs)
+    p.wait()
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
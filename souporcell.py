@@ -3,7 +3,8 @@
 import numpy as np
 import argparse
 import tensorflow as tf
-import vcf
+import known_genotypes
+import preflight
 
 parser = argparse.ArgumentParser(
     description="single cell RNAseq mixed genotype clustering using sparse mixture model clustering with tensorflow.")
@@ -78,33 +79,16 @@ used_loci_indices = {locus:i for (i, locus) in enumerate(used_loci)}
 loci = len(used_loci)
 
 if not(args.known_genotypes == None):
-    reader = vcf.Reader(open(args.known_genotypes))
     if args.known_genotypes_sample_names == None:
-        args.known_genotypes_sample_names = reader.samples
+        args.known_genotypes_sample_names = preflight.vcf_samples(args.known_genotypes)
     assert int(args.num_clusters) == len(args.known_genotypes_sample_names), "clusters must equal samples for known_genotypes"
-    sample_index = {samp: index for (index, samp) in enumerate(args.known_genotypes_sample_names)}
-    sample_genotypes = np.random.random((len(args.known_genotypes_sample_names), loci))#[[np.random.random() for x in range(loci)] for y in range(len(args.known_genotypes_sample_names))]
-    filled = 0
-    unfilled = 0
-    for (index, rec) in enumerate(reader):
-        if index in used_loci_set:
-            for sample in args.known_genotypes_sample_names:
-                gt = rec.genotype(sample).data.GT
-                if gt == '0|0' or gt == '0/0':
-                    freq = 1.0
-                    filled += 1
-                elif gt == '0|1' or gt == '1|0' or gt == '0/1':
-                    freq = 0.5
-                    filled += 1
-                elif gt == '1|1' or gt == '1/1':
-                    freq = 0.0
-                    filled += 1
-                else:
-                    freq = np.random.random()
-                    unfilled += 1
-                sampledex = sample_index[sample]
-
-                sample_genotypes[sampledex][used_loci_indices[index]] = freq
+    # loci x samples reference fractions for just the used loci, decoded in bulk, nan where a genotype is missing
+    known = known_genotypes.genotype_matrix(args.known_genotypes, args.known_genotypes_sample_names, used_loci).T
+    sample_genotypes = np.random.random((len(args.known_genotypes_sample_names), loci))
+    called = np.isfinite(known)
+    sample_genotypes[called] = known[called]
+    filled = int(called.sum())
+    unfilled = called.size - filled
 
 
 print("loci being used based on min_alt, min_ref, and max_loci "+str(loci))
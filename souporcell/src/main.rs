@@ -18,16 +18,20 @@ use std::f32;
 use std::io::BufReader;
 use std::io::BufRead;
 use std::io::Read;
+use std::io::Write;
 use std::fs::File;
+use std::fs::OpenOptions;
+use std::sync::Mutex;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::time::{SystemTime, UNIX_EPOCH};
 
-use hashbrown::{HashMap,HashSet};
-use itertools::izip;
+use hashbrown::HashMap;
 
 fn main() {
     let params = load_params();
     let cell_barcodes = load_barcodes(&params); 
     let (loci_used, total_cells, cell_data, index_to_locus, locus_to_index) = load_cell_data(&params);
-    souporcell_main(loci_used, cell_data, &params, cell_barcodes);
+    souporcell_main(loci_used, cell_data, &params, cell_barcodes, &locus_to_index);
 }
 
 struct ThreadData {
@@ -50,7 +54,7 @@ impl ThreadData {
     }
 }
 
-fn souporcell_main(loci_used: usize, cell_data: Vec<CellData>, params: &Params, barcodes: Vec<String>) {
+fn souporcell_main(loci_used: usize, cell_data: Vec<CellData>, params: &Params, barcodes: Vec<String>, locus_to_index: &HashMap<usize, usize>) {
     let seed = [params.seed; 32];
     let mut rng: StdRng = SeedableRng::from_seed(seed);
     let mut threads: Vec<ThreadData> = Vec::new();
@@ -58,9 +62,16 @@ fn souporcell_main(loci_used: usize, cell_data: Vec<CellData>, params: &Params,
     for i in 0..params.threads {
         threads.push(ThreadData::from_seed(new_seed(&mut rng), solves_per_thread, i));
     }
+    let known_cells = load_known_cell_assignments(params, &barcodes);
+    let known_genotypes = load_known_genotypes(params, locus_to_index);
+    let total_restarts = solves_per_thread * params.threads;
+    progress_event(params, "start", format!("\"cells\":{},\"loci\":{},\"clusters\":{},\"restarts_total\":{},\"threads\":{}",
+        cell_data.len(), loci_used, params.num_clusters, total_restarts, params.threads));
+    let restarts_done = AtomicUsize::new(0);
+    let best_so_far = Mutex::new(f32::NEG_INFINITY);
     threads.par_iter_mut().for_each(|thread_data| {
         for iteration in 0..thread_data.solves_per_thread {
-            let cluster_centers: Vec<Vec<f32>> = init_cluster_centers(loci_used, &cell_data, params, &mut thread_data.rng);
+            let cluster_centers: Vec<Vec<f32>> = init_cluster_centers(loci_used, &cell_data, params, &known_cells, &known_genotypes, &mut thread_data.rng);
             let (log_loss, log_probabilities) = EM(loci_used, cluster_centers, &cell_data ,params, iteration, thread_data.thread_num);
             if log_loss > thread_data.best_total_log_probability {
                 thread_data.best_total_log_probability = log_loss;
@@ -68,6 +79,14 @@ fn souporcell_main(loci_used: usize, cell_data: Vec<CellData>, params: &Params,
             }
             eprintln!("thread {} iteration {} done with {}, best so far {}", 
                 thread_data.thread_num, iteration, log_loss, thread_data.best_total_log_probability);
+            let done = restarts_done.fetch_add(1, Ordering::SeqCst) + 1;
+            let best = {
+                let mut best = best_so_far.lock().unwrap();
+                if log_loss > *best { *best = log_loss; }
+                *best
+            };
+            progress_event(params, "restart", format!("\"thread\":{},\"restart\":{},\"restarts_done\":{},\"restarts_total\":{},\"log_loss\":{},\"best_log_loss\":{}",
+                thread_data.thread_num, iteration, done, total_restarts, json_number(log_loss), json_number(best)));
         }
     });
     let mut best_log_probability = f32::NEG_INFINITY;
@@ -79,6 +98,7 @@ fn souporcell_main(loci_used: usize, cell_data: Vec<CellData>, params: &Params,
         }
     }
     eprintln!("best total log probability = {}", best_log_probability);
+    progress_event(params, "done", format!("\"best_log_loss\":{}", json_number(best_log_probability)));
     //println!("here");
     //fin
     // SHOW YOURSELF!
@@ -166,6 +186,8 @@ fn EM(loci: usize, mut cluster_centers: Vec<Vec<f32>>, cell_data: &Vec<CellData>
             iterations += 1;
             eprintln!("binomial\t{}\t{}\t{}\t{}\t{}\t{}", thread_num, epoch, iterations, temp_step, log_binom_loss, log_loss_change);//, cluster_cells_weighted);
         }
+        progress_event(params, "temp_step", format!("\"thread\":{},\"restart\":{},\"temp_step\":{},\"temp_steps\":{},\"iterations\":{},\"log_loss\":{}",
+            thread_num, epoch, temp_step + 1, temp_steps, iterations, json_number(total_log_loss)));
     }
     //for (celldex, probabilities) in cell_probabilities.iter().enumerate() {
     //    println!("cell {} with {} loci, cluster probabilities {:?}", celldex, cell_data[celldex].loci.len(), probabilities);
@@ -281,11 +303,11 @@ fn update_centers_average(sums: &mut Vec<Vec<f32>>, denoms: &mut Vec<Vec<f32>>,
     }
 }
 
-fn init_cluster_centers(loci_used: usize, cell_data: &Vec<CellData>, params: &Params, rng: &mut StdRng) -> Vec<Vec<f32>> {
-    if let Some(known_genotypes) = &params.known_genotypes {
-        return init_cluster_centers_known_genotypes(loci_used, params, rng);
+fn init_cluster_centers(loci_used: usize, cell_data: &Vec<CellData>, params: &Params, known_cells: &Vec<Option<usize>>, known_genotypes: &Vec<Vec<Option<f32>>>, rng: &mut StdRng) -> Vec<Vec<f32>> {
+    if params.known_genotypes.is_some() {
+        return init_cluster_centers_known_genotypes(loci_used, params, known_genotypes, rng);
     } else if let Some(assigned_cells) = &params.known_cell_assignments {
-        return init_cluster_centers_known_cells(loci_used, &cell_data, params, rng);
+        return init_cluster_centers_known_cells(loci_used, &cell_data, params, known_cells, rng);
     } else {
         match params.initialization_strategy {
             ClusterInit::KmeansPP => init_cluster_centers_kmeans_pp(loci_used, &cell_data, params, rng),
@@ -296,14 +318,121 @@ fn init_cluster_centers(loci_used: usize, cell_data: &Vec<CellData>, params: &Pa
     }
 }
 
-fn init_cluster_centers_known_genotypes(loci: usize, params: &Params, rng: &mut StdRng) -> Vec<Vec<f32>> {
-    assert!(false, "known genotypes not yet implemented");
-    Vec::new()
+// alt allele fraction of each known donor at each used locus, None where the genotype is missing. the file is
+// the tsv souporcell_pipeline.py writes from the known genotypes vcf: a header of sample names, then one line per
+// matrix row with each sample's fraction, "." where missing. donors are the named samples or the first k
+fn load_known_genotypes(params: &Params, locus_to_index: &HashMap<usize, usize>) -> Vec<Vec<Option<f32>>> {
+    let mut known: Vec<Vec<Option<f32>>> = Vec::new();
+    if let Some(ref path) = params.known_genotypes {
+        let reader = BufReader::new(File::open(path).expect("cannot open known genotypes file"));
+        let mut lines = reader.lines();
+        let header = lines.next().expect("known genotypes file is empty").expect("cannot read known genotypes");
+        let samples: Vec<&str> = header.split('\t').collect();
+        let mut columns: Vec<usize> = Vec::new();
+        if params.known_genotypes_sample_names.len() > 0 {
+            for name in params.known_genotypes_sample_names.iter() {
+                let column = samples.iter().position(|sample| *sample == name.as_str());
+                columns.push(column.expect("known genotypes sample name not in the known genotypes file"));
+            }
+        } else {
+            columns = (0..samples.len()).collect();
+        }
+        columns.truncate(params.num_clusters);
+        for _ in 0..columns.len() {
+            known.push(vec![None; locus_to_index.len()]);
+        }
+        let mut found = 0;
+        for (locus, line) in lines.enumerate() {
+            let line = line.expect("cannot read known genotypes");
+            if let Some(index) = locus_to_index.get(&locus) {
+                let tokens: Vec<&str> = line.split('\t').collect();
+                for (cluster, column) in columns.iter().enumerate() {
+                    known[cluster][*index] = tokens.get(*column).and_then(|token| token.parse::<f32>().ok());
+                }
+                found += 1;
+            }
+        }
+        eprintln!("known genotypes for {} donors at {} of {} used loci", columns.len(), found, locus_to_index.len());
+    }
+    known
 }
 
-fn init_cluster_centers_known_cells(loci: usize, cell_data: &Vec<CellData>, params: &Params, rng: &mut StdRng) -> Vec<Vec<f32>> {
-    assert!(false, "known cell assignments not yet implemented");
-    Vec::new()
+// each donor's known genotypes with a small jitter so restarts search around them rather than repeat them.
+// loci where a donor's genotype is missing, and clusters beyond the known donors, start random
+fn init_cluster_centers_known_genotypes(loci: usize, params: &Params, known_genotypes: &Vec<Vec<Option<f32>>>, rng: &mut StdRng) -> Vec<Vec<f32>> {
+    let mut centers: Vec<Vec<f32>> = Vec::new();
+    for cluster in 0..params.num_clusters {
+        centers.push(Vec::new());
+        for locus in 0..loci {
+            let center = match known_genotypes.get(cluster).and_then(|known| known[locus]) {
+                Some(fraction) => fraction + (rng.gen::<f32>()/10.0 - 0.05),
+                None => rng.gen::<f32>(),
+            };
+            centers[cluster].push(center.min(0.9999).max(0.0001));
+        }
+    }
+    centers
+}
+
+// cluster of each cell from a tsv of barcode and cluster, such as the singlets of a preview run (preview.py).
+// cells that are missing, or whose cluster is not a number below k (doublets, unassigned), have none
+fn load_known_cell_assignments(params: &Params, barcodes: &Vec<String>) -> Vec<Option<usize>> {
+    let mut assignments: Vec<Option<usize>> = vec![None; barcodes.len()];
+    if let Some(ref path) = params.known_cell_assignments {
+        let mut barcode_index: HashMap<&str, usize> = HashMap::new();
+        for (index, barcode) in barcodes.iter().enumerate() {
+            barcode_index.insert(barcode.trim(), index);
+        }
+        let reader = BufReader::new(File::open(path).expect("cannot open known cell assignments file"));
+        let mut assigned = 0;
+        for line in reader.lines() {
+            let line = line.expect("cannot read known cell assignments");
+            let tokens: Vec<&str> = line.split_whitespace().collect();
+            if tokens.len() < 2 { continue; }
+            if let (Some(cell), Ok(cluster)) = (barcode_index.get(tokens[0]), tokens[1].parse::<usize>()) {
+                if cluster < params.num_clusters {
+                    assignments[*cell] = Some(cluster);
+                    assigned += 1;
+                }
+            }
+        }
+        eprintln!("{} cells with known cluster assignments", assigned);
+    }
+    assignments
+}
+
+// like random_cell_assignment but with the known cells only, and a small jitter so restarts search around
+// the known solution rather than repeat it. loci none of a cluster's cells cover start random
+fn init_cluster_centers_known_cells(loci: usize, cell_data: &Vec<CellData>, params: &Params, known_cells: &Vec<Option<usize>>, rng: &mut StdRng) -> Vec<Vec<f32>> {
+    let mut sums: Vec<Vec<f32>> = Vec::new();
+    let mut denoms: Vec<Vec<f32>> = Vec::new();
+    for cluster in 0..params.num_clusters {
+        sums.push(Vec::new());
+        denoms.push(Vec::new());
+        for _ in 0..loci {
+            sums[cluster].push(rng.gen::<f32>()*0.01);
+            denoms[cluster].push(0.01);
+        }
+    }
+    for (cell, known) in cell_data.iter().zip(known_cells.iter()) {
+        if let Some(cluster) = known {
+            for locus in 0..cell.loci.len() {
+                let alt_c = cell.alt_counts[locus] as f32;
+                let total = alt_c + (cell.ref_counts[locus] as f32);
+                let locus_index = cell.loci[locus];
+                sums[*cluster][locus_index] += alt_c;
+                denoms[*cluster][locus_index] += total;
+            }
+        }
+    }
+    for cluster in 0..params.num_clusters {
+        for locus in 0..loci {
+            sums[cluster][locus] = sums[cluster][locus]/denoms[cluster][locus] + (rng.gen::<f32>()/10.0 - 0.05);
+            sums[cluster][locus] = sums[cluster][locus].min(0.9999).max(0.0001);
+        }
+    }
+    let centers = sums;
+    centers
 }
 
 fn init_cluster_centers_kmeans_pp(loci: usize, cell_data: &Vec<CellData>, params: &Params, rng: &mut StdRng) -> Vec<Vec<f32>> {
@@ -358,86 +487,140 @@ fn init_cluster_centers_middle_variance(loci: usize, cell_data: &Vec<CellData>,
     Vec::new()
 }
 
+// a ref/alt matrix entry, 0 based locus and cell
+struct Entry {
+    locus: usize,
+    cell: usize,
+    ref_count: u32,
+    alt_count: u32,
+}
+
+const LINES_PER_BATCH: usize = 1 << 20;
+
+// both matrices just past their 3 header lines, with the loci and cells the header gives
+fn open_mtx_pair(params: &Params) -> (BufReader<File>, BufReader<File>, usize, usize) {
+    let mut alt_reader = BufReader::new(File::open(params.alt_mtx.to_string()).expect("cannot open alt mtx file"));
+    let mut ref_reader = BufReader::new(File::open(params.ref_mtx.to_string()).expect("cannot open ref mtx file"));
+    let mut alt_line = String::new();
+    let mut ref_line = String::new();
+    for _ in 0..3 {
+        alt_line.clear();
+        ref_line.clear();
+        alt_reader.read_line(&mut alt_line).expect("cannot read alt mtx");
+        ref_reader.read_line(&mut ref_line).expect("cannot read ref mtx");
+    }
+    let tokens: Vec<&str> = alt_line.split_whitespace().collect();
+    let total_loci = tokens[0].to_string().parse::<usize>().unwrap();
+    let total_cells = tokens[1].to_string().parse::<usize>().unwrap();
+    (alt_reader, ref_reader, total_loci, total_cells)
+}
+
+fn parse_entry(alt_line: &[u8], ref_line: &[u8]) -> Option<Entry> {
+    let alt_line = std::str::from_utf8(alt_line).expect("alt mtx is not text");
+    let ref_line = std::str::from_utf8(ref_line).expect("ref mtx is not text");
+    let mut alt_tokens = alt_line.split_whitespace();
+    let mut ref_tokens = ref_line.split_whitespace();
+    let locus = match alt_tokens.next() {
+        Some(token) => token.parse::<usize>().unwrap(),
+        None => return None,
+    };
+    let cell = alt_tokens.next().expect("alt mtx line without a cell").parse::<usize>().unwrap();
+    let alt_count = alt_tokens.next().expect("alt mtx line without a count").parse::<u32>().unwrap();
+    let ref_locus = ref_tokens.next().expect("ref mtx has fewer entries than alt mtx").parse::<usize>().unwrap();
+    let ref_cell = ref_tokens.next().expect("ref mtx line without a cell").parse::<usize>().unwrap();
+    let ref_count = ref_tokens.next().expect("ref mtx line without a count").parse::<u32>().unwrap();
+    assert!(ref_locus == locus && ref_cell == cell, "ref and alt matrices do not list the same entries in the same order");
+    Some(Entry { locus: locus - 1, cell: cell - 1, ref_count: ref_count, alt_count: alt_count })
+}
+
+// streams the paired matrix lines a batch at a time, the lines of a batch parsed in parallel with more than one thread,
+// and hands each batch of entries to handle in file order. only a batch of text and entries is held at once
+fn for_each_entry_batch<F: FnMut(&Vec<Entry>)>(params: &Params, mut handle: F) {
+    let (mut alt_reader, mut ref_reader, _, _) = open_mtx_pair(params);
+    let mut alt_buffer: Vec<u8> = Vec::new();
+    let mut ref_buffer: Vec<u8> = Vec::new();
+    loop {
+        alt_buffer.clear();
+        ref_buffer.clear();
+        let mut lines = 0;
+        while lines < LINES_PER_BATCH {
+            let alt_read = alt_reader.read_until(b'\n', &mut alt_buffer).expect("cannot read alt mtx");
+            let ref_read = ref_reader.read_until(b'\n', &mut ref_buffer).expect("cannot read ref mtx");
+            if alt_read == 0 || ref_read == 0 { break; }
+            lines += 1;
+        }
+        if lines == 0 { break; }
+        let alt_lines: Vec<&[u8]> = alt_buffer.split(|byte| *byte == b'\n').collect();
+        let ref_lines: Vec<&[u8]> = ref_buffer.split(|byte| *byte == b'\n').collect();
+        let entries: Vec<Entry> = if params.threads > 1 {
+            alt_lines.par_iter().zip(ref_lines.par_iter())
+                .filter_map(|(alt_line, ref_line)| parse_entry(alt_line, ref_line)).collect()
+        } else {
+            alt_lines.iter().zip(ref_lines.iter())
+                .filter_map(|(alt_line, ref_line)| parse_entry(alt_line, ref_line)).collect()
+        };
+        handle(&entries);
+        if lines < LINES_PER_BATCH { break; }
+    }
+}
+
+// two passes over the matrices. the first counts cells and umis per locus into arrays sized from the header,
+// which picks the loci used, and each cell's nonzero entries. the second fills cell arrays allocated for that
+// many entries, which are shrunk to the entries at the used loci once filled
 fn load_cell_data(params: &Params) -> (usize, usize, Vec<CellData>, Vec<usize>, HashMap<usize, usize>) {
-    let alt_reader = File::open(params.alt_mtx.to_string()).expect("cannot open alt mtx file");
+    let (_, _, total_loci, total_cells) = open_mtx_pair(params);
+    let mut seen: Vec<bool> = vec![false; total_loci];
+    let mut locus_cell_counts: Vec<[u32; 2]> = vec![[0; 2]; total_loci];
+    let mut locus_umi_counts: Vec<[u32; 2]> = vec![[0; 2]; total_loci];
+    let mut cell_entries: Vec<usize> = vec![0; total_cells];
+    for_each_entry_batch(params, |entries| {
+        for entry in entries {
+            assert!(entry.locus < total_loci);
+            assert!(entry.cell < total_cells);
+            seen[entry.locus] = true;
+            if entry.ref_count + entry.alt_count > 0 { cell_entries[entry.cell] += 1; }
+            if entry.ref_count > 0 { locus_cell_counts[entry.locus][0] += 1; locus_umi_counts[entry.locus][0] += entry.ref_count; }
+            if entry.alt_count > 0 { locus_cell_counts[entry.locus][1] += 1; locus_umi_counts[entry.locus][1] += entry.alt_count; }
+        }
+    });
 
-    let alt_reader = BufReader::new(alt_reader);
-    let ref_reader = File::open(params.ref_mtx.to_string()).expect("cannot open ref mtx file");
-    
-    let ref_reader = BufReader::new(ref_reader);
-    let mut used_loci: HashSet<usize> = HashSet::new();
-    let mut line_number = 0;
-    let mut total_loci = 0;
-    let mut total_cells = 0;
-    let mut all_loci: HashSet<usize> = HashSet::new();
-    let mut locus_cell_counts: HashMap<usize, [u32; 2]> = HashMap::new();
-    let mut locus_umi_counts: HashMap<usize, [u32; 2]> = HashMap::new();
-    let mut locus_counts: HashMap<usize, HashMap<usize, [u32; 2]>> = HashMap::new();
-    for (alt_line, ref_line) in izip!(alt_reader.lines(), ref_reader.lines()) {
-        let alt_line = alt_line.expect("cannot read alt mtx");
-        let ref_line = ref_line.expect("cannot read ref mtx");
-        if line_number > 2 {
-            let alt_tokens: Vec<&str> = alt_line.split_whitespace().collect();
-            let ref_tokens: Vec<&str> = ref_line.split_whitespace().collect();
-            let locus = alt_tokens[0].to_string().parse::<usize>().unwrap() - 1;
-            all_loci.insert(locus);
-            let cell = alt_tokens[1].to_string().parse::<usize>().unwrap() - 1;
-            let ref_count = ref_tokens[2].to_string().parse::<u32>().unwrap();
-            let alt_count = alt_tokens[2].to_string().parse::<u32>().unwrap();
-            assert!(locus < total_loci);
-            assert!(cell < total_cells);
-            let cell_counts = locus_cell_counts.entry(locus).or_insert([0; 2]);
-            let umi_counts = locus_umi_counts.entry(locus).or_insert([0; 2]);
-            if ref_count > 0 { cell_counts[0] += 1; umi_counts[0] += ref_count; }
-            if alt_count > 0 { cell_counts[1] += 1; umi_counts[1] += alt_count; }
-            let cell_counts = locus_counts.entry(locus).or_insert(HashMap::new());
-            cell_counts.insert(cell, [ref_count, alt_count]);
-        } else if line_number == 2 {
-            let tokens: Vec<&str> = alt_line.split_whitespace().collect();
-            total_loci = tokens[0].to_string().parse::<usize>().unwrap();
-            total_cells = tokens[1].to_string().parse::<usize>().unwrap();
-        }
-        line_number += 1;
-    }
-    let mut all_loci2: Vec<usize> = Vec::new();
-    for loci in all_loci {
-        all_loci2.push(loci);
-    }
-    let mut all_loci = all_loci2;
-
-    all_loci.sort();
     let mut index_to_locus: Vec<usize> = Vec::new();
     let mut locus_to_index: HashMap<usize, usize> = HashMap::new();
-    let mut cell_data: Vec<CellData> = Vec::new();
-    for _cell in 0..total_cells {
-        cell_data.push(CellData::new());
-    }
-    let mut locus_index = 0;
-    for locus in all_loci {
-        let cell_counts = locus_cell_counts.get(&locus).unwrap();
-        let umi_counts = locus_umi_counts.get(&locus).unwrap();
+    let mut used_index: Vec<usize> = vec![usize::MAX; total_loci];
+    for locus in 0..total_loci {
+        if !seen[locus] { continue; }
+        let cell_counts = locus_cell_counts[locus];
+        let umi_counts = locus_umi_counts[locus];
         if cell_counts[0] >= params.min_ref && cell_counts[1] >= params.min_alt && umi_counts[0] >= params.min_ref_umis && umi_counts[1] >= params.min_alt_umis {
-            used_loci.insert(locus);
+            used_index[locus] = index_to_locus.len();
+            locus_to_index.insert(locus, index_to_locus.len());
             index_to_locus.push(locus);
-            locus_to_index.insert(locus, locus_index);
-            for (cell, counts) in locus_counts.get(&locus).unwrap() {
-                if counts[0]+counts[1] == 0 { continue; }
-                cell_data[*cell].alt_counts.push(counts[1]);
-                cell_data[*cell].ref_counts.push(counts[0]);
-                cell_data[*cell].loci.push(locus_index);
-                cell_data[*cell].allele_fractions.push((counts[1] as f32)/((counts[0] + counts[1]) as f32));
-                cell_data[*cell].log_binomial_coefficient.push(
-                     statrs::function::factorial::ln_binomial((counts[1]+counts[0]) as u64, counts[1] as u64) as f32);
-                cell_data[*cell].total_alleles += (counts[0] + counts[1]) as f32;
-                //println!("cell {} locus {} alt {} ref {} fraction {}",*cell, locus_index, counts[1], counts[0], 
-                //    (counts[1] as f32)/((counts[0] + counts[1]) as f32));
-            }
-            locus_index += 1;
         }
     }
-    eprintln!("total loci used {}",used_loci.len());
-    
-    (used_loci.len(), total_cells, cell_data, index_to_locus, locus_to_index)
+    drop(seen);
+    drop(locus_cell_counts);
+    drop(locus_umi_counts);
+
+    let mut cell_data: Vec<CellData> = cell_entries.iter().map(|entries| CellData::with_capacity(*entries)).collect();
+    drop(cell_entries);
+    for_each_entry_batch(params, |entries| {
+        for entry in entries {
+            let locus_index = used_index[entry.locus];
+            if locus_index == usize::MAX || entry.ref_count + entry.alt_count == 0 { continue; }
+            let cell = &mut cell_data[entry.cell];
+            cell.alt_counts.push(entry.alt_count);
+            cell.ref_counts.push(entry.ref_count);
+            cell.loci.push(locus_index);
+            cell.allele_fractions.push((entry.alt_count as f32)/((entry.ref_count + entry.alt_count) as f32));
+            cell.log_binomial_coefficient.push(
+                 statrs::function::factorial::ln_binomial((entry.alt_count + entry.ref_count) as u64, entry.alt_count as u64) as f32);
+            cell.total_alleles += (entry.ref_count + entry.alt_count) as f32;
+        }
+    });
+    for cell in cell_data.iter_mut() { cell.shrink_to_fit(); }
+    eprintln!("total loci used {}",index_to_locus.len());
+
+    (index_to_locus.len(), total_cells, cell_data, index_to_locus, locus_to_index)
 }
 
 struct CellData {
@@ -450,16 +633,24 @@ struct CellData {
 }
 
 impl CellData {
-    fn new() -> CellData {
+    fn with_capacity(entries: usize) -> CellData {
         CellData{
-            allele_fractions: Vec::new(),
-            log_binomial_coefficient: Vec::new(),
-            alt_counts: Vec::new(),
-            ref_counts: Vec::new(),
-            loci: Vec::new(),
+            allele_fractions: Vec::with_capacity(entries),
+            log_binomial_coefficient: Vec::with_capacity(entries),
+            alt_counts: Vec::with_capacity(entries),
+            ref_counts: Vec::with_capacity(entries),
+            loci: Vec::with_capacity(entries),
             total_alleles: 0.0,
         }
     }
+
+    fn shrink_to_fit(&mut self) {
+        self.allele_fractions.shrink_to_fit();
+        self.log_binomial_coefficient.shrink_to_fit();
+        self.alt_counts.shrink_to_fit();
+        self.ref_counts.shrink_to_fit();
+        self.loci.shrink_to_fit();
+    }
 }
 
 fn load_barcodes(params: &Params) -> Vec<String> {
@@ -491,6 +682,7 @@ struct Params {
     initialization_strategy: ClusterInit,
     threads: usize,
     seed: u8,
+    progress: Option<String>,
 }
 
 #[derive(Clone)]
@@ -579,9 +771,30 @@ fn load_params() -> Params {
         seed: seed,
         min_alt_umis: min_alt_umis,
         min_ref_umis: min_ref_umis,
+        progress: std::env::var("SOUPORCELL_PROGRESS").ok(),
+    }
+}
+
+// newline delimited json progress events appended to $SOUPORCELL_PROGRESS, same format as progress.py.
+// each event is a single write to a file opened for append so threads and other processes do not interleave
+fn progress_event(params: &Params, event: &str, fields: String) {
+    if let Some(ref path) = params.progress {
+        let time = match SystemTime::now().duration_since(UNIX_EPOCH) {
+            Ok(elapsed) => elapsed.as_secs() as f64 + (elapsed.subsec_millis() as f64) / 1000.0,
+            Err(_) => 0.0,
+        };
+        let line = format!("{{\"time\":{:.3},\"stage\":\"clustering\",\"event\":\"{}\",\"pid\":{},{}}}\n",
+            time, event, std::process::id(), fields);
+        if let Ok(mut file) = OpenOptions::new().create(true).append(true).open(path) {
+            let _ = file.write_all(line.as_bytes());
+        }
     }
 }
 
+fn json_number(value: f32) -> String {
+    if value.is_finite() { format!("{}", value) } else { "null".to_string() }
+}
+
 fn new_seed(rng: &mut StdRng) -> [u8; 32] {
     let mut seed = [0; 32];
     for i in 0..32 {
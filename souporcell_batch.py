@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="run souporcell_pipeline.py on many channels of the same donor pool with one shared pool of worker threads. " +
+    "arguments not listed here are passed on to every channel's souporcell_pipeline.py")
+parser.add_argument("-m", "--manifest", required = True, help = "tab separated bam, barcodes.tsv and out_dir, one channel per line")
+parser.add_argument("-f", "--fasta", required = True, help = "reference fasta file")
+parser.add_argument("-t", "--threads", required = True, type = int, help = "max threads to use across all channels")
+parser.add_argument("-k", "--clusters", required = True, help = "number cluster")
+parser.add_argument("-o", "--out_dir", required = True, help = "directory for files shared by the batch (mapping index, joint variants, logs)")
+parser.add_argument("--joint_variants", required = False, default = False, action = "store_true",
+    help = "call variants once on all channels' remapped bams together and count every channel on that one variant set")
+parser.add_argument("--min_alt", required = False, default = "4", help = "min alt to use locus, default = 4.")
+parser.add_argument("--min_ref", required = False, default = "4", help = "min ref to use locus, default = 4.")
+parser.add_argument("--queue_dir", required = False, default = None,
+    help = "run all channels' shard jobs through this job queue directory on shared storage (see souporcell_worker.py)")
+(args, pipeline_args) = parser.parse_known_args()
+
+import os
+import subprocess
+import reference
+import slots
+import executor
+import pipeline
+
+channels = []
+with open(args.manifest) as manifest:
+    for line in manifest:
+        if line.startswith("#") or len(line.strip()) == 0:
+            continue
+        toks = line.strip().split("\t")
+        assert len(toks) == 3, "manifest lines should be bam, barcodes and out_dir separated by tabs: " + line.strip()
+        channels.append((toks[0], toks[1], toks[2]))
+assert len(channels) > 0, "no channels in manifest"
+assert len(set([out_dir for (bam, barcodes, out_dir) in channels])) == len(channels), "channels need their own out_dir"
+for (bam, barcodes, out_dir) in channels:
+    assert os.path.exists(bam), "bam not found " + bam
+    assert os.path.exists(barcodes), "barcodes not found " + barcodes
+skip_remap = "--skip_remap" in pipeline_args
+if args.joint_variants:
+    assert not("--common_variants" in pipeline_args) and not("--known_genotypes" in pipeline_args), \
+        "joint_variants calls the variants itself, cannot set common_variants or known_genotypes"
+
+if os.path.isdir(args.out_dir):
+    print("restarting batch in existing directory " + args.out_dir)
+else:
+    subprocess.check_call(["mkdir", args.out_dir])
+
+# reference metadata and the mapping index are made once here instead of by every channel
+reference.ensure_index(args.fasta)
+contigs = reference.contigs(args.fasta)
+mapping_index = args.out_dir + "/reference.mmi"
+if not skip_remap and not os.path.exists(mapping_index):
+    print("building minimap2 index")
+    # -k and -w have to match the remapping options in souporcell_pipeline.py, an index fixes them
+    with open(args.out_dir + "/minimap_index.err", 'w') as err:
+        subprocess.check_call(["minimap2", "-x", "splice", "-k", "21", "-w", "11", "-t", str(args.threads),
+            "-d", mapping_index + ".tmp", args.fasta], stderr = err)
+    os.rename(mapping_index + ".tmp", mapping_index)
+
+slots_dir = args.out_dir + "/slots"
+slots.create(slots_dir, args.threads)
+os.environ[slots.env_var] = slots_dir
+if args.queue_dir:
+    executor.create_queue(args.queue_dir)
+    os.environ[executor.env_var] = os.path.abspath(args.queue_dir)
+
+# a job takes as many slots as its channel's -t, and one waiting on all of the pool would hold up
+# every smaller job behind it, so each channel gets its share of the threads. the share is fixed when the
+# channels start: a channel that finishes early leaves its cores to jobs the others queue, it does not re-plan them
+channel_threads = max(1, args.threads // len(channels))
+
+def run_channels(extra_args):
+    # every channel runs at once, their jobs queue for the shared slots
+    procs = []
+    for (index, (bam, barcodes, out_dir)) in enumerate(channels):
+        cmd = ["souporcell_pipeline.py", "-i", bam, "-b", barcodes, "-f", args.fasta, "-t", str(channel_threads),
+            "-o", out_dir, "-k", args.clusters, "--min_alt", args.min_alt, "--min_ref", args.min_ref] + pipeline_args + extra_args
+        if not skip_remap:
+            cmd.extend(["--mapping_index", mapping_index])
+        log_fn = args.out_dir + "/channel_" + str(index) + ".log"
+        log = open(log_fn, 'w')
+        log.write(" ".join(cmd) + "\n")
+        log.flush()
+        procs.append((subprocess.Popen(cmd, stdout = log, stderr = subprocess.STDOUT), log, log_fn))
+    failed = []
+    for (p, log, log_fn) in procs:
+        p.wait()
+        log.close()
+        if p.returncode:
+            failed.append(log_fn)
+    assert len(failed) == 0, "souporcell_pipeline.py failed for " + str(len(failed)) + " channels, see " + " ".join(failed)
+
+def joint_variants(bams):
+    print("calling variants jointly on " + str(len(bams)) + " channels")
+    shards = []
+    for region in pipeline.freebayes_regions(args, contigs):
+        for (chrom, start, end) in region:
+            shards.append((chrom, start, end))
+    jobs = []
+    all_vcfs = []
+    for (index, (chrom, start, end)) in enumerate(shards):
+        vcf_name = args.out_dir + "/joint_" + str(index) + ".vcf"
+        all_vcfs.append(vcf_name)
+        out = open(vcf_name, 'w')
+        err = open(vcf_name + ".err", 'w')
+        cmd = pipeline.freebayes_cmd(args, bams, chrom, start, end)
+        err.write(" ".join(cmd) + "\n")
+        err.flush()
+        jobs.append((executor.popen(cmd, stdout = out, stderr = err), out, err))
+    for (p, out, err) in jobs:
+        p.wait()
+        out.close()
+        err.close()
+        assert not(p.returncode), "freebayes subprocess terminated abnormally with code " + str(p.returncode)
+    # shards are in reference order so the concatenation is sorted
+    final_vcf = args.out_dir + "/joint_variants.vcf"
+    with open(final_vcf, 'w') as vcfout:
+        subprocess.check_call(["bcftools", "concat"] + all_vcfs, stdout = vcfout)
+    subprocess.check_call(["bgzip", "-f", final_vcf])
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", final_vcf + ".gz"])
+    for vcf in all_vcfs:
+        subprocess.check_call(["rm", vcf, vcf + ".err"])
+    with open(args.out_dir + "/joint_variants.done", 'w') as done:
+        done.write(os.path.abspath(final_vcf + ".gz") + "\n")
+
+if args.joint_variants:
+    if not skip_remap:
+        run_channels(["--stop_after", "retag"])
+        bams = [out_dir + "/souporcell_minimap_tagged_sorted.bam" for (bam, barcodes, out_dir) in channels]
+    else:
+        bams = [bam for (bam, barcodes, out_dir) in channels]
+    if not os.path.exists(args.out_dir + "/joint_variants.done"):
+        joint_variants(bams)
+    with open(args.out_dir + "/joint_variants.done") as done:
+        final_vcf = done.readline().strip()
+    # channels pick the shared variants up as if they had called them, and go on to count alleles
+    for (bam, barcodes, out_dir) in channels:
+        os.makedirs(out_dir, exist_ok = True)
+        if not os.path.exists(out_dir + "/variants.done"):
+            with open(out_dir + "/variants.done", 'w') as done:
+                done.write(final_vcf + "\n")
+run_channels([])
+print("done")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="run souporcell shard jobs from a job queue directory on shared storage (souporcell_pipeline.py --queue_dir). " +
+    "start one on each host that should take part")
+parser.add_argument("-q", "--queue_dir", required = True, help = "job queue directory, the same path the pipeline was given")
+parser.add_argument("-t", "--threads", required = True, type = int, help = "threads this worker may use for jobs at once")
+parser.add_argument("--idle_exit", required = False, default = None, type = float,
+    help = "exit after this many seconds without a job, default = run until killed")
+args = parser.parse_args()
+
+import json
+import os
+import socket
+import subprocess
+import time
+import executor
+
+executor.create_queue(args.queue_dir)
+(pending_dir, running_dir, done_dir, log_dir) = executor.queue_dirs(args.queue_dir)
+host = socket.gethostname()
+heartbeat_seconds = 10.0
+
+def output(path, append, log):
+    # a job's own outputs are written from the start, so a job requeued after a lost host does not leave the
+    # first attempt's partial output in front of its own. logs that several jobs share are appended to
+    if not path:
+        return(open(log, 'ab'))
+    return(open(path, 'ab' if append else 'wb'))
+
+def start(job_id, job):
+    log = os.path.join(log_dir, job_id + ".log")
+    stdout = output(job["stdout"], job.get("stdout_append", False), log)
+    if job["stderr"] == "stdout":
+        stderr = subprocess.STDOUT
+    else:
+        stderr = output(job["stderr"], job.get("stderr_append", False), log)
+    env = dict(os.environ)
+    env.update(job.get("env", {}))
+    p = subprocess.Popen(job["cmd"], cwd = job["cwd"], stdout = stdout, stderr = stderr, env = env)
+    handles = [stdout] if stderr == subprocess.STDOUT else [stdout, stderr]
+    return((p, handles))
+
+def finish(job_id, returncode):
+    result = os.path.join(done_dir, job_id + ".json")
+    with open(result + ".tmp", 'w') as out:
+        json.dump({"returncode": returncode, "host": host}, out)
+    os.rename(result + ".tmp", result)
+    try:
+        os.remove(os.path.join(running_dir, job_id + ".json"))
+    except OSError:
+        pass
+
+running = {} # job id -> (process, handles, threads)
+last_heartbeat = time.time()
+idle_since = time.time()
+print("worker " + host + " taking jobs from " + args.queue_dir)
+while True:
+    for job_id in list(running.keys()):
+        (p, handles, threads) = running[job_id]
+        if p.poll() == None:
+            continue
+        for handle in handles:
+            handle.close()
+        finish(job_id, p.returncode)
+        print(job_id + " exited with " + str(p.returncode))
+        del running[job_id]
+    if time.time() - last_heartbeat > heartbeat_seconds:
+        for job_id in running:
+            try:
+                os.utime(os.path.join(running_dir, job_id + ".json"))
+            except OSError:
+                pass
+        last_heartbeat = time.time()
+    used = sum([threads for (p, handles, threads) in running.values()])
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith(".json"):
+            continue
+        if used >= args.threads:
+            break
+        job_id = name[:-len(".json")]
+        claimed = os.path.join(running_dir, name)
+        try:
+            # rename is atomic, the one worker whose rename succeeds owns the job
+            os.rename(os.path.join(pending_dir, name), claimed)
+            # a requeued job keeps the stale time that got it requeued, the submitter would take it back again
+            os.utime(claimed)
+        except OSError:
+            continue
+        with open(claimed) as job_file:
+            job = json.load(job_file)
+        # a job wanting more threads than this worker has still runs, just on its own
+        threads = min(max(job["threads"], 1), args.threads)
+        if used > 0 and used + threads > args.threads:
+            os.rename(claimed, os.path.join(pending_dir, name))
+            break
+        try:
+            (p, handles) = start(job_id, job)
+        except OSError as error:
+            print(job_id + " could not start: " + str(error))
+            finish(job_id, 127)
+            continue
+        print(job_id + " started: " + " ".join(job["cmd"]))
+        running[job_id] = (p, handles, threads)
+        used += threads
+    if len(running) > 0:
+        idle_since = time.time()
+    elif not(args.idle_exit == None) and time.time() - idle_since > args.idle_exit:
+        print("no jobs for " + str(args.idle_exit) + " seconds, exiting")
+        break
+    time.sleep(executor.poll_seconds)
@@ -0,0 +1,78 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+repo = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo)
+
+import allele_counter
+import mtx
+
+# what vartrix --umi --scoring-method coverage writes for the reads in write_bam below: only the substitution at
+# chr1:101 has reads, cell 1 has one ref UMI (read twice), cell 2 one ref and one alt UMI
+vartrix_ref = "%%MatrixMarket matrix coordinate real general\n% written by vartrix\n3 2 2\n1 1 1\n1 2 1\n"
+vartrix_alt = "%%MatrixMarket matrix coordinate real general\n% written by vartrix\n3 2 1\n1 2 1\n"
+
+variants = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n" + \
+    "chr1\t101\t.\tA\tG\t50\t.\t.\nchr1\t201\t.\tAT\tA\t50\t.\t.\nchr2\t50\t.\tC\tT\t50\t.\t.\n"
+
+def write_fixture(tmp_path):
+    with open(str(tmp_path / "vartrix_ref.mtx"), 'w') as out:
+        out.write(vartrix_ref)
+    with open(str(tmp_path / "vartrix_alt.mtx"), 'w') as out:
+        out.write(vartrix_alt)
+    return((str(tmp_path / "vartrix_ref.mtx"), str(tmp_path / "vartrix_alt.mtx")))
+
+def test_compare_reports_identical_and_differing_entries(tmp_path):
+    (ref_fn, alt_fn) = write_fixture(tmp_path)
+    counts = mtx.load_pair(ref_fn, alt_fn)
+    assert allele_counter.compare(counts, ref_fn, alt_fn) == (2, 2)
+    (loci, cells, locus, cell, ref, alt) = counts
+    assert allele_counter.compare((loci, cells, locus, cell, ref + 1, alt), ref_fn, alt_fn) == (0, 2)
+
+def write_bam(fn):
+    pysam = pytest.importorskip("pysam")
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 1000}]}
+    # (barcode, UMI, base at chr1:101, mapping quality, flag) for 50 base reads starting at chr1:81. the mapq 5 read
+    # and the duplicate (0x400) are dropped, as vartrix drops them
+    reads = [("AAAC-1", "UMIA", "A", 60, 0), ("AAAC-1", "UMIA", "A", 60, 0), ("AAAG-1", "UMIB", "G", 60, 0),
+        ("AAAG-1", "UMIC", "A", 60, 0), ("TTTT-1", "UMID", "G", 60, 0), ("AAAC-1", "UMIE", "G", 5, 0),
+        ("AAAC-1", "UMIF", "G", 60, 0x400)]
+    with pysam.AlignmentFile(fn, 'wb', header = header) as out:
+        for (index, (barcode, umi, base, mapq, flag)) in enumerate(reads):
+            read = pysam.AlignedSegment()
+            read.query_name = "read" + str(index)
+            read.query_sequence = "C" * 20 + base + "C" * 29
+            read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = 80
+            read.mapping_quality = mapq
+            read.cigartuples = [(0, 50)]
+            read.set_tag("CB", barcode)
+            read.set_tag("UB", umi)
+            out.write(read)
+    pysam.index(fn)
+
+def test_counts_match_vartrix(tmp_path):
+    bam = str(tmp_path / "in.bam")
+    write_bam(bam)
+    with open(str(tmp_path / "variants.vcf"), 'w') as out:
+        out.write(variants)
+    (total_loci, chrom_variants) = allele_counter.load_variants(str(tmp_path / "variants.vcf"))
+    allele_counter.init_worker([bam], {"AAAC-1": 0, "AAAG-1": 1}, 30, 0)
+    parts = []
+    not_snv = 0
+    missing = 0
+    for job in sorted(chrom_variants.items()):
+        (chrom, loci, cells, refs, alts, chrom_not_snv, chrom_missing) = allele_counter.count_chrom(job)
+        parts.append((0, np.array(loci, dtype = np.int64), np.array(cells, dtype = np.int64),
+            np.array(refs, dtype = np.int64), np.array(alts, dtype = np.int64)))
+        not_snv += chrom_not_snv
+        missing += chrom_missing
+    assert (not_snv, missing) == (1, 1)
+    (ref_fn, alt_fn) = write_fixture(tmp_path)
+    assert allele_counter.compare(mtx.combine(parts, total_loci, 2), ref_fn, alt_fn) == (2, 2)
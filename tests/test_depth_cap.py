@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pysam = pytest.importorskip("pysam")
+
+repo = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def write_bam(fn, reads_at):
+    # reads_at is [(position, barcode)], 50 base matches on a 1000 base contig
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 1000}]}
+    with pysam.AlignmentFile(fn, 'wb', header = header) as out:
+        for (index, (position, barcode)) in enumerate(sorted(reads_at)):
+            read = pysam.AlignedSegment()
+            read.query_name = "read" + str(index)
+            read.query_sequence = "A" * 50
+            read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+            read.flag = 0
+            read.reference_id = 0
+            read.reference_start = position
+            read.mapping_quality = 60
+            read.cigartuples = [(0, 50)]
+            read.set_tag("CB", barcode)
+            out.write(read)
+    pysam.index(fn)
+
+def cap(tmp_path, region, max_depth):
+    capped = str(tmp_path / "capped.bam")
+    subprocess.check_call([sys.executable, os.path.join(repo, "depth_cap.py"), "-i", str(tmp_path / "in.bam"),
+        "-r", region, "-o", capped, "-d", str(max_depth)])
+    with pysam.AlignmentFile(capped) as bam:
+        return([(read.reference_start, read.get_tag("CB")) for read in bam.fetch("chr1", 0, 1000)])
+
+def test_shard_starting_at_zero(tmp_path):
+    # the pipeline's first shard of a contig starts at 0, freebayes -r style
+    write_bam(str(tmp_path / "in.bam"), [(0, "AAAC-1"), (10, "AAAG-1"), (500, "AAAT-1")])
+    assert [start for (start, barcode) in cap(tmp_path, "chr1:0-999", 100)] == [0, 10, 500]
+
+def test_region_end_included(tmp_path):
+    write_bam(str(tmp_path / "in.bam"), [(0, "AAAC-1"), (500, "AAAG-1"), (700, "AAAT-1")])
+    assert [start for (start, barcode) in cap(tmp_path, "chr1:0-500", 100)] == [0, 500]
+
+def test_hotspot_capped_over_barcodes(tmp_path):
+    depths = {"CELL0-1": 1, "CELL1-1": 3, "CELL2-1": 50, "CELL3-1": 50}
+    reads = [(200, barcode) for (barcode, depth) in depths.items() for copy in range(depth)]
+    write_bam(str(tmp_path / "in.bam"), reads)
+    capped = cap(tmp_path, "chr1:0-999", 20)
+    assert 0 < len(capped) <= 20
+    kept = dict([(barcode, 0) for barcode in depths])
+    for (start, barcode) in capped:
+        kept[barcode] += 1
+    # every barcode keeps all of its reads up to an equal share of what was kept, the share being the highest
+    # level that the kept reads fill
+    share = max([level for level in range(max(depths.values()) + 1)
+        if sum([min(depth, level) for depth in depths.values()]) <= len(capped)])
+    for (barcode, depth) in depths.items():
+        assert abs(kept[barcode] - min(depth, share)) <= 1, barcode
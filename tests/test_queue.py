@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import time
+
+repo = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo)
+
+import executor
+
+def start_workers(queue_dir, workers, threads = 2):
+    return([subprocess.Popen([sys.executable, os.path.join(repo, "souporcell_worker.py"), "-q", queue_dir,
+        "-t", str(threads), "--idle_exit", "3"], stdout = subprocess.DEVNULL) for worker in range(workers)])
+
+def wait_all(jobs, timeout = 60):
+    deadline = time.time() + timeout
+    while any([job.poll() == None for job in jobs]):
+        assert time.time() < deadline, "queued jobs did not finish"
+        time.sleep(executor.poll_seconds)
+
+def test_workers_share_queue_and_requeue_lost_job(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    executor.create_queue(queue_dir)
+    # a job claimed by a worker that then died, after writing part of its output
+    lost_out = str(tmp_path / "lost.out")
+    with open(lost_out, 'w') as out:
+        lost = executor.QueuedJob(queue_dir, [sys.executable, "-c", "print('complete')"], 1, stdout = out)
+    with open(lost_out, 'w') as out:
+        out.write("partial\n")
+    name = lost.job_id + ".json"
+    claimed = os.path.join(queue_dir, "running", name)
+    os.rename(os.path.join(queue_dir, "pending", name), claimed)
+    stale = time.time() - executor.lost_after - 1
+    os.utime(claimed, (stale, stale))
+
+    jobs = []
+    for index in range(12):
+        with open(str(tmp_path / ("job_" + str(index) + ".out")), 'w') as out:
+            jobs.append(executor.QueuedJob(queue_dir, [sys.executable, "-c", "print(" + str(index) + ")"], 1, stdout = out))
+    # a log opened for append by the submitter is shared by jobs, each adds its own line
+    with open(str(tmp_path / "shared.err"), 'a') as err:
+        for index in range(3):
+            jobs.append(executor.QueuedJob(queue_dir,
+                [sys.executable, "-c", "import sys; sys.stderr.write('err " + str(index) + "\\n')"], 1, stderr = err))
+    workers = start_workers(queue_dir, 3)
+    try:
+        wait_all(jobs + [lost])
+    finally:
+        for worker in workers:
+            worker.wait()
+    assert all([job.returncode == 0 for job in jobs + [lost]])
+    for index in range(12):
+        with open(str(tmp_path / ("job_" + str(index) + ".out"))) as out:
+            assert out.read() == str(index) + "\n"
+    with open(lost_out) as out:
+        assert out.read() == "complete\n"
+    with open(str(tmp_path / "shared.err")) as err:
+        assert sorted(err.read().splitlines()) == ["err 0", "err 1", "err 2"]
+    for sub in ["pending", "running", "done"]:
+        assert os.listdir(os.path.join(queue_dir, sub)) == []